@@ -1,16 +1,16 @@
 #!/usr/bin/python3.5
 import argparse
+import codecs
 import collections
 import datetime
+import email.utils
 import itertools
 import json
 import logging
 import pathlib
 import pprint
 import re
-import subprocess
-import tempfile
-import time
+import sqlite3
 
 import apt_pkg
 import requests
@@ -53,102 +53,237 @@ parser.add_argument('--templates', nargs='+', default={
     'desktop-inmate-amc-library',
     'desktop-staff-amc',
 })
+parser.add_argument('--fleet', action='store_true',
+                    help='instead of old vs. new, print a CVE x image matrix for'
+                    ' EVERY image in /srv/netboot/images (ignores the other version/template options)')
+parser.add_argument('--cache-dir', type=lambda s: pathlib.Path(s).expanduser(),
+                    default=pathlib.Path('~/.cache/bootstrap2020').expanduser(),
+                    help='where to keep an index of the security tracker data between runs')
 args = parser.parse_args()
 
 # NOTE: set() cannot hash types.SimpleNamespace, so
 #       use named tuples instead.
 Package = collections.namedtuple('Package', 'name version')
+# NOTE: no installed version here, so
+#       "same CVE, same source package" is the same Vuln in old and new images.
+Vuln = collections.namedtuple('Vuln', 'cve package urgency fixed_version sid_fixed_version')
 
 
-# FIXME: when tweak is Debian 11,
-#          1. remove .mkdir() line;
-#          2. no str() around Paths.
-#          3. f'' not .format().
+# Same as
+#     dpkg-query --show --showformat='${source:Package}\t${source:Version}\n'
+# but without a tempdir and a fork per image.
+# "Source:" is "name" or "name (version)", and is omitted if it's the same as "Package:".
+# Ref. https://manpages.debian.org/deb-control
+# FIXME: when tweak is Debian 11, no str() around Paths and f'' not .format().
 def get_packages_one(status_path):
-    with tempfile.TemporaryDirectory() as td:
-        td = pathlib.Path(td)
-        (td / 'updates').mkdir()  # for old dpkg-query
-        (td / 'status').write_bytes(
-            status_path.read_bytes())
-        stdout = subprocess.check_output(
-            ['dpkg-query', '--show', '--admindir=.',
-             '--showformat=${source:Package}\t${source:Version}\n'],
-            universal_newlines=True,
-            cwd=str(td))
-        return set(
-            Package(name=name, version=version)
-            for line in stdout.splitlines()
-            for name, version in [line.split()])
-
-
-def get_packages_all(soe_version):
     acc = set()
+    for paragraph in status_path.read_text(encoding='utf-8').split('\n\n'):
+        fields = dict(re.findall(r'^([^\s:]+):[ \t]*(.*)$', paragraph, flags=re.MULTILINE))
+        if 'Package' not in fields or fields.get('Status', '').endswith(' not-installed'):
+            continue
+        m = re.fullmatch(r'(\S+)(?: \((\S+)\))?', fields.get('Source', fields['Package']))
+        acc.add(Package(name=m.group(1), version=m.group(2) or fields['Version']))
+    return acc
+
+
+# {'desktop-staff-amc-2022-01-01-1641000000': {Package(...), ...}, ...}
+def get_images(soe_version, templates):
+    acc = {}
     root = pathlib.Path('/srv/netboot/images/')
-    for template in args.templates:
+    for template in templates:
         glob = '{}-{}/dpkg.status'.format(template, soe_version)
         status_paths = sorted(root.glob(glob))
         logging.info('%s %s: %s', template, soe_version, status_paths)
         if not status_paths:
             raise FileNotFoundError(root / glob)
         for status_path in status_paths:
-            acc.update(get_packages_one(status_path))
+            acc[status_path.parent.name] = get_packages_one(status_path)
     return acc
 
 
+# Every real image (not the -latest/-previous symlinks) that has a dpkg.status.
+def get_images_fleet():
+    return {
+        status_path.parent.name: get_packages_one(status_path)
+        for status_path in sorted(pathlib.Path('/srv/netboot/images/').glob('*/dpkg.status'))
+        if not status_path.parent.is_symlink()}
+
+
+# The tracker data is about 32MB of JSON, and
+# this runs on the master server, next to production services.
+# So keep an index of just the bits we use (just for --suite) in sqlite, and
+# only re-download it when the tracker says it has changed.
+# When it has, parse it one source package at a time, as it arrives.
+# Ref. https://security-tracker.debian.org/tracker/data/json
 def get_security_data():
-    # This file is about 32MB.
-    resp = requests.get('https://security-tracker.debian.org/tracker/data/json')
-    resp.raise_for_status()
-    now, then = time.time(), int(subprocess.check_output(
-        ['date', '+%s', '-d', resp.headers['Last-Modified']]))
-    if now - then > 86400:
-        logging.warning('security data is over a day old! %s',
-                        resp.headers['Last-Modified'])
-    return resp.headers['Last-Modified'], resp.json()
-
-
-def debsecan(soe_version):
-    installed_packages = get_packages_all(soe_version)
+    args.cache_dir.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(args.cache_dir / 'security-tracker.sqlite3'))
+    db.executescript(
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);'
+        'CREATE TABLE IF NOT EXISTS vulns (package TEXT, cve TEXT, urgency TEXT,'
+        '                                  fixed_version TEXT, sid_fixed_version TEXT);'
+        'CREATE INDEX IF NOT EXISTS vulns_package ON vulns (package);')
+    meta = dict(db.execute('SELECT key, value FROM meta'))
+    resp = requests.get(
+        'https://security-tracker.debian.org/tracker/data/json',
+        stream=True,
+        headers={k: v for k, v in [('If-None-Match', meta.get('ETag')),
+                                   ('If-Modified-Since', meta.get('Last-Modified'))]
+                 if v and meta.get('suite') == args.suite})
+    try:
+        resp.raise_for_status()
+        if resp.status_code == 304:  # Not Modified
+            logging.info('Security data unchanged since %s', meta['Last-Modified'])
+        else:
+            with db:            # one transaction
+                db.execute('DELETE FROM vulns')
+                known_suites = set()
+                for package, cves in iter_json_object_items(resp.iter_content(2**20)):
+                    for cve, vuln in cves.items():
+                        known_suites.update(vuln['releases'])
+                        release = vuln['releases'].get(args.suite, {})
+                        db.execute('INSERT INTO vulns VALUES (?, ?, ?, ?, ?)', (
+                            package, cve,
+                            release.get('urgency'),  # NULL means "no data for this suite"
+                            release.get('fixed_version'),
+                            vuln['releases'].get('sid', {}).get('fixed_version')))
+                meta = {'suite': args.suite,
+                        'known_suites': json.dumps(sorted(known_suites)),
+                        **{k: resp.headers[k] for k in ('ETag', 'Last-Modified') if k in resp.headers}}
+                db.execute('DELETE FROM meta')
+                db.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+    finally:
+        resp.close()
+    then = email.utils.parsedate_to_datetime(meta['Last-Modified'])
+    if datetime.datetime.now(datetime.timezone.utc) - then > datetime.timedelta(days=1):
+        logging.warning('security data is over a day old! %s', meta['Last-Modified'])
+    return meta['Last-Modified'], json.loads(meta['known_suites']), db
+
+
+# Yield (key, value) for each member of a big JSON object, as its bytes arrive.
+# Only one value (e.g. one source package's CVEs) is ever decoded at a time.
+def iter_json_object_items(byte_chunks):
+    stream = JSONStream(byte_chunks)
+    if stream.read(stream.parse_punctuation) != '{':
+        raise ValueError('Expected a JSON object')
+    if stream.read(stream.parse_end_of_object) == '}':
+        return                  # {} has no first key to read
+    while True:
+        key = stream.read(stream.parse_value)
+        if stream.read(stream.parse_punctuation) != ':':
+            raise ValueError('Expected ":" after', key)
+        yield key, stream.read(stream.parse_value)
+        if stream.read(stream.parse_punctuation) == '}':
+            return
+
+
+class JSONStream:
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+    punctuation = re.compile(r'\s*([{}:,])')
+    end_of_object = re.compile(r'\s*(\}|(?=\S))')
+
+    def __init__(self, byte_chunks):
+        self.byte_chunks = iter(byte_chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf, self.pos = '', 0
+
+    # If there isn't enough in buf to parse the next thing, read some more and try again.
+    # Read at least as much again as is already waiting, so a huge value (e.g. "linux") is
+    # re-parsed a handful of times, not once per chunk.
+    def read(self, parse):
+        while True:
+            try:
+                value, self.pos = parse()
+                return value
+            except ValueError:  # includes json.JSONDecodeError
+                pending, more, more_length = self.buf[self.pos:], [], 0
+                while more_length <= len(pending):
+                    chunk = next(self.byte_chunks, None)
+                    if chunk is None:
+                        break
+                    more.append(self.utf8.decode(chunk))
+                    more_length += len(more[-1])
+                if not more:
+                    raise
+                self.buf, self.pos = pending + ''.join(more), 0
+
+    def parse_punctuation(self):
+        m = self.punctuation.match(self.buf, self.pos)
+        if not m:
+            raise ValueError('Expected punctuation', self.buf[self.pos:self.pos + 20])
+        return m.group(1), m.end()
+
+    # "}" if the object ends here, "" (consuming nothing but whitespace) if a key comes next.
+    def parse_end_of_object(self):
+        m = self.end_of_object.match(self.buf, self.pos)
+        if not m:
+            raise ValueError('Expected "}" or a key', self.buf[self.pos:self.pos + 20])
+        return m.group(1), m.end()
+
+    def parse_value(self):
+        return self.decoder.raw_decode(self.buf, self.whitespace.match(self.buf, self.pos).end())
+
+
+# {source package name: [Vuln, ...]} for every package in package_names, in one query.
+def get_vulnerabilities(package_names):
+    acc = collections.defaultdict(list)
+    with db:
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (package TEXT PRIMARY KEY)')
+        db.execute('DELETE FROM wanted')
+        db.executemany('INSERT INTO wanted VALUES (?)', ((name,) for name in set(package_names)))
+        for row in db.execute(
+                'SELECT cve, package, urgency, fixed_version, sid_fixed_version'
+                ' FROM vulns JOIN wanted USING (package)'):
+            vuln = Vuln(*row)
+            acc[vuln.package].append(vuln)
+    return acc
+
+
+# Which of these vulns affect this installed (source) package?
+def affecting(package, vulns):
     acc = set()                 # accumulator
-    apt_pkg.init()
-    for package in installed_packages:
-        if package.name not in vulnerabilities:
-            logging.info('No vulnerabilities for %s', package.name)
+    for vuln in vulns:
+        if vuln.cve in boring:
+            logging.debug('Ignoring boring CVE %s', vuln.cve)
+            continue
+        if vuln.urgency is None:
+            logging.warning('No suite data for %s %s %s?', package.name, vuln.cve, args.suite)
+            continue
+        fix_available = vuln.fixed_version is not None
+        if fix_available and apt_pkg.version_compare(
+                vuln.fixed_version, package.version) <= 0:
+            logging.debug('Our version is new enough to be unaffected (%s, %s)', vuln.cve, package)
             continue
-        for cve, vuln in vulnerabilities[package.name].items():
-            if cve in boring:
-                logging.debug('Ignoring boring CVE %s', cve)
-                continue
-            if args.suite not in vuln['releases']:
-                logging.warning('No suite data for %s %s %s?', package.name, cve, args.suite)
-                continue
-            vuln_release = vuln['releases'][args.suite]
-            fix_available = 'fixed_version' in vuln_release
-            if fix_available and apt_pkg.version_compare(
-                    vuln_release['fixed_version'], package.version) <= 0:
-                logging.debug('Our version is new enough to be unaffected (%s, %s)', cve, package)
-                continue
-            # "This problem does not affect the Debian binary package";
-            # "non-issues in practice"; or
-            # "not covered by security support".
-            # https://security-team.debian.org/security_tracker.html#severity-levels
-            if vuln_release['urgency'] == 'unimportant':
-                logging.debug('Skipping unimportant vuln: %s', cve)
-                continue
-            if args.only_fixed and not fix_available:
-                logging.info('Skipping vuln with no fix in %s: %s', args.suite, cve)
-                continue
-            # FUCK OFF, set()!
-            # I want to de-duplicate, and
-            # I want to diff vulns_fixed = vulns_old - vulns_new.
-            # If I use the vuln structure directly, I get this bullshit:
-            #   TypeError: unhashable type: 'dict'
-            # As a quick-and-dirty way to make the structure hashable,
-            # just convert it to a json string (and later, back).
-            acc.add((cve, package.name, json.dumps(vuln)))
+        # "This problem does not affect the Debian binary package";
+        # "non-issues in practice"; or
+        # "not covered by security support".
+        # https://security-team.debian.org/security_tracker.html#severity-levels
+        if vuln.urgency == 'unimportant':
+            logging.debug('Skipping unimportant vuln: %s', vuln.cve)
+            continue
+        if args.only_fixed and not fix_available:
+            logging.info('Skipping vuln with no fix in %s: %s', args.suite, vuln.cve)
+            continue
+        acc.add(vuln)
     return acc
 
 
+# {image: {Vuln, ...}} for every image at once.
+# Most images share most (source package, version) pairs, so
+# each distinct pair is only checked once, however many images it's in.
+def debsecan(images):
+    apt_pkg.init()
+    installed_packages = set().union(*images.values())
+    vulnerabilities = get_vulnerabilities(package.name for package in installed_packages)
+    affected = {
+        package: affecting(package, vulnerabilities.get(package.name, []))
+        for package in installed_packages}
+    return {
+        image: set().union(*(affected[package] for package in packages))
+        for image, packages in images.items()}
+
+
 # Entries in this list are ignored.
 boring = {
     # These vulns apply to Chromium 86-89 in Debian 10.
@@ -160,11 +295,6 @@ boring = {
 
 
 def sanity_check_suite():
-    known_suites = {
-        suite
-        for package in vulnerabilities.values()
-        for cve in package.values()
-        for suite in cve['releases'].keys()}
     if args.suite not in known_suites:
         logging.error('%s not supported by Debian Security Team %s', args.suite, sorted(known_suites))
         exit(3)  # https://www.monitoring-plugins.org/doc/guidelines.html#AEN78
@@ -175,35 +305,45 @@ def pretty_print(vulns):
     if not vulns:
         print('', 'Nothing, yay!', sep='\t')
         return
-    # Now that set() diffing is done, go back to dict()s.
-    vulns = [
-        {'cve': cve,
-         'url': 'https://security-tracker.debian.org/tracker/{}'.format(cve),
-         'package': package,
-         **json.loads(vuln_json_str)}
-        for cve, package, vuln_json_str in vulns]
-    # ORDER BY urgency DESC, cve DESC
-    vulns.sort(reverse=True, key=lambda v: (
-        urgency_sortkey(v['releases'][args.suite]['urgency']),
-        alnum_sortkey(v['cve'])))
+    vulns = sorted(vulns, reverse=True, key=vuln_sortkey)
 
 
     print('\t==========================================================\t===========\t===============\t==============')
     print('\t                                             VULNERABILITY\tURGENCY    \tFIX AVAILABLE? \tSOURCE PACKAGE')
     print('\t==========================================================\t===========\t===============\t==============')
     for vuln in vulns:
-        print('', vuln['url'],
-              '{} urgency'.format(vuln['releases'][args.suite]['urgency'].replace('not yet assigned', 'TBD')),
-              ('fix in {}'.format(args.suite)
-               if 'fixed_version' in vuln['releases'][args.suite] else
-               'fix in unstable'
-               if 'fixed_version' in vuln['releases'].get('sid', {}) else
-               'no fix yet'),
-              vuln['package'],
+        print('', 'https://security-tracker.debian.org/tracker/{}'.format(vuln.cve),
+              '{} urgency'.format(vuln.urgency.replace('not yet assigned', 'TBD')),
+              fix_status(vuln),
+              vuln.package,
               sep='\t')
     print('\t==========================================================\t===========\t===============\t==============')
 
 
+def fix_status(vuln):
+    return ('fix in {}'.format(args.suite)
+            if vuln.fixed_version is not None else
+            'fix in unstable'
+            if vuln.sid_fixed_version is not None else
+            'no fix yet')
+
+
+# One row per CVE, one column per image, "X" where that image has that vuln.
+# Tab-separated, so it can be pasted into a spreadsheet.
+def print_fleet_matrix(results):
+    images = sorted(results)
+    print('CVE', 'URGENCY', 'FIX AVAILABLE?', 'SOURCE PACKAGE', *images, sep='\t')
+    for vuln in sorted(set().union(*results.values()), reverse=True, key=vuln_sortkey):
+        print(vuln.cve, vuln.urgency, fix_status(vuln), vuln.package,
+              *('X' if vuln in results[image] else '' for image in images),
+              sep='\t')
+
+
+# ORDER BY urgency DESC, cve DESC
+def vuln_sortkey(vuln):
+    return urgency_sortkey(vuln.urgency), alnum_sortkey(vuln.cve), vuln.package
+
+
 # Sort 5-digit CVEs after 4-digit CVEs.
 def alnum_sortkey(s):
     return [int(i) if i.isdigit() else i
@@ -220,10 +360,17 @@ def urgency_sortkey(s):
             'not yet assigned': -1}[s]
 
 
-last_modified, vulnerabilities = get_security_data()
+last_modified, known_suites, db = get_security_data()
 sanity_check_suite()
-debsecan_old = debsecan(args.old_version)
-debsecan_new = debsecan(args.new_version)
+if args.fleet:
+    print('Vulnerabilities in every SOE image, using vulnerability database as at', last_modified)
+    print_fleet_matrix(debsecan(get_images_fleet()))
+    exit()
+images_old = get_images(args.old_version, args.templates)
+images_new = get_images(args.new_version, args.templates)
+results = debsecan({**images_old, **images_new})
+debsecan_old = set().union(*(results[image] for image in images_old))
+debsecan_new = set().union(*(results[image] for image in images_new))
 
 print('Vulnerability changes in SOE update', '({} → {})'.format(args.old_version, args.new_version))
 print('for SOEs', *sorted(args.templates))
@@ -2,11 +2,14 @@
 import csv
 import functools
 import gzip
+import hashlib
+import json
 import logging
 import math
 import pathlib
+import random
 import subprocess
-import tempfile
+import urllib.error
 import urllib.request
 
 doc = """ calculate the install footprint for each game & educational app
@@ -98,8 +101,10 @@ We can also skip metapackages like "games-mud", "games-java-dev", "education-dev
 #       This does not actually work later in mmdebstrap, so it's confusing and stupid.
 #       Adding prisonpc-bad-package-conflicts-inmates does not change the list of debs printed (because it is installed already).
 #       So the actual integer emitted should not change.
-@functools.cache
-def measure_cost(package_name):
+#
+# NOTE: this is now only used to spot-check measure_cost (below), because
+#       running a whole apt solver per app takes hours for debian-edu + debian-games + debian-science.
+def measure_cost_with_apt_get(package_name):
     try:
         apt_output = subprocess.check_output(
             ['apt-get', 'install', '--print-uris', '--quiet=2', package_name,
@@ -121,6 +126,140 @@ def measure_cost(package_name):
         return 'ERROR'
 
 
+# Same answer as measure_cost_with_apt_get, but worked out from the already-loaded apt.Cache().
+# For each Depends/Pre-Depends (and Recommends, if apt would install those),
+#   * if something installed already satisfies it, it's free;
+#   * otherwise take the first alternative (or provider) whose candidate version satisfies it,
+#     preferring one we're already going to install.
+# If a package we need can't be installed alongside prisonpc-bad-package-conflicts-inmates
+# (or an Essential package), apt-get would fail, so that's an ERROR too.
+#
+# This is the MARGINAL cost: what installing just this app would add to the current image.
+# Twenty KDE games each pay for the whole KDE stack, so see also measure_exclusive_costs & cheapest_bundle.
+def measure_cost(package_name):
+    bits = closure_bits(package_name)
+    if bits is None:
+        return 'ERROR'
+    return simplify_number(bits_to_mebibytes(bits))
+
+
+# Each not-yet-installed package gets a bit number, so a closure is just an int, and
+# unions/intersections/differences of thousands of closures are cheap.
+package_bits = {}               # package name -> bit number
+package_sizes = []              # bit number -> .deb size, like --print-uris
+
+
+@functools.cache
+def closure_bits(package_name):
+    closure = cached_closure(package_name)
+    if closure is None:
+        return None
+    bits = 0
+    for name, version, size in closure:
+        if name not in package_bits:
+            package_bits[name] = len(package_sizes)
+            package_sizes.append(size)
+        bits |= 1 << package_bits[name]
+    return bits
+
+
+# Closures from previous runs, as [(name, version, .deb size), ...] (or None for ERROR).
+# debian-11-main.py keeps this file in --cache-dir between builds.
+# A cached closure is still good if the installed packages are the same, and
+# the app and everything in its closure still have the same candidate version.
+# (Strictly, a brand new package could also change which alternative apt picks, but that's rare enough to ignore.)
+def cached_closure(package_name):
+    candidate = cache[package_name].candidate if package_name in cache else None
+    entry = footprint_cache['closures'].get(package_name)
+    if entry and all([
+            entry['image'] == image_fingerprint,
+            entry['version'] == (candidate.version if candidate else None),
+            all(name in cache and cache[name].candidate and cache[name].candidate.version == version
+                for name, version, size in entry['closure'] or [])]):
+        return entry['closure']
+    recomputed_names.add(package_name)
+    closure = resolve_closure(package_name)
+    footprint_cache['closures'][package_name] = {
+        'image': image_fingerprint,
+        'version': candidate.version if candidate else None,
+        'closure': None if closure is None else [(v.package.name, v.version, v.size) for v in closure]}
+    return footprint_cache['closures'][package_name]['closure']
+
+
+def bits_to_mebibytes(bits):
+    size_in_bytes = 0
+    while bits:
+        lowest_bit = bits & -bits
+        size_in_bytes += package_sizes[lowest_bit.bit_length() - 1]
+        bits ^= lowest_bit
+    return size_in_bytes / 1024 / 1024
+
+
+# The EXCLUSIVE cost: what's needed by this app and no other app in the list, i.e.
+# what dropping just this app from an "install all of them" image would save.
+def measure_exclusive_costs(package_names):
+    closures = {name: closure_bits(name) for name in set(package_names)}
+    closures = {name: bits for name, bits in closures.items() if bits is not None}
+    seen_once = seen_twice = 0
+    for bits in closures.values():
+        seen_twice |= seen_once & bits
+        seen_once |= bits
+    return {name: simplify_number(bits_to_mebibytes(bits & ~seen_twice))
+            for name, bits in closures.items()}
+
+
+# A cheap order to install a set of apps:
+# repeatedly pick the app that adds the least on top of the apps already picked, so
+# shared libraries are paid for once, by whichever app needs them first.
+# Yields (name, added MiB, running total MiB).
+def cheapest_bundle(package_names):
+    closures = {name: closure_bits(name) for name in set(package_names)}
+    closures = {name: bits for name, bits in closures.items() if bits is not None}
+    added = {name: bits_to_mebibytes(bits) for name, bits in closures.items()}
+    picked = 0
+    while added:
+        name = min(sorted(added), key=added.get)
+        newly_picked = closures[name] & ~picked
+        picked |= newly_picked
+        yield name, simplify_number(added.pop(name)), simplify_number(bits_to_mebibytes(picked))
+        # Only apps sharing something with the one just picked got any cheaper.
+        for other in added:
+            if closures[other] & newly_picked:
+                added[other] = bits_to_mebibytes(closures[other] & ~picked)
+
+
+def resolve_closure(package_name):
+    if package_name not in cache or not cache[package_name].candidate:
+        return None             # "E: Package 'vlc-plugin-bittorent' has no installation candidate"
+    todo, closure = [cache[package_name].candidate], {}
+    while todo:
+        version = todo.pop()
+        if version.is_installed or version.package.name in closure:
+            continue
+        if is_blocked(version):
+            return None
+        closure[version.package.name] = version
+        for dependency in version.get_dependencies(*dependency_types):
+            if dependency.installed_target_versions:
+                continue
+            candidates = [v for v in dependency.target_versions if v == v.package.candidate]
+            if not candidates:
+                if dependency.rawtype == 'Recommends':
+                    continue    # apt just skips a Recommends it can't satisfy
+                return None
+            todo.append(next((v for v in candidates if v.package.name in closure), candidates[0]))
+    return list(closure.values())
+
+
+def is_blocked(version):
+    return any([
+        (version.package.name, version.version) in protected_conflicts,
+        any(target.package.name in protected_package_names
+            for dependency in version.get_dependencies('Conflicts', 'Breaks')
+            for target in dependency.installed_target_versions
+            if target.package.name != version.package.name)])
+
+
 # Rather than reporting the exact size e.g. "1234.56 MiB",
 # round upwards to two significant figures e.g. "1300 MiB".
 # This is much easier for a human to process when quickly eyeballing a large list.
@@ -132,17 +271,27 @@ def simplify_number(n, significant_digits=2):
 
 # List the upsteam Debian popularity.
 # Just use rank for now (smaller is better).
+# popcon only changes daily, so ask "has it changed?" (and keep the last answer in footprint_cache).
+# If it has, decompress it as it downloads, instead of via a temporary file.
 def crunch_popcon():
-    with tempfile.TemporaryDirectory() as td:
-        td = pathlib.Path(td)
-        with urllib.request.urlopen('https://popcon.debian.org/by_vote.gz') as f:
-            (td / 'x.gz').write_bytes(f.read())
-        with gzip.open(td / 'x.gz', mode='rt') as f:
-            return {
+    popcon = footprint_cache['popcon']
+    request = urllib.request.Request(
+        'https://popcon.debian.org/by_vote.gz',
+        headers={k: v for k, v in {'If-None-Match': popcon.get('ETag'),
+                                   'If-Modified-Since': popcon.get('Last-Modified')}.items()
+                 if v and 'ranks' in popcon})
+    try:
+        with urllib.request.urlopen(request) as resp, gzip.open(resp, mode='rt') as f:
+            popcon['ranks'] = {
                 name: int(rank)
                 for line in f
                 if line[0].isdigit()  # not a comment line
                 for rank, name, _ in [line.split(maxsplit=2)]}
+            popcon.update({k: resp.headers[k] for k in ('ETag', 'Last-Modified') if k in resp.headers})
+    except urllib.error.HTTPError as e:
+        if e.code != 304:       # Not Modified
+            raise
+    return popcon['ranks']
 
 
 # Argh, prisonpc-bad-package-conflicts-everyone blocks python3-apt!
@@ -150,8 +299,36 @@ def crunch_popcon():
 subprocess.check_call(['apt', 'download', 'python3-apt'])
 subprocess.check_call(['dpkg', '-x', *list(pathlib.Path.cwd().glob('python3-apt_*_*.deb')), '/'])
 import apt                      # noqa: E402
+import apt_pkg                  # noqa: E402
 cache = apt.Cache()
 
+dependency_types = ['PreDepends', 'Depends']
+if apt_pkg.config.find_b('APT::Install-Recommends', True):
+    dependency_types.append('Recommends')
+# Installed packages apt-get would refuse to remove to make room for an app.
+protected_package_names = {
+    package.name
+    for package in cache
+    if package.is_installed
+    if package.essential or package.name == 'prisonpc-bad-package-conflicts-inmates'}
+protected_conflicts = {
+    (target.package.name, target.version)
+    for name in protected_package_names
+    for dependency in cache[name].installed.get_dependencies('Conflicts', 'Breaks')
+    for target in dependency.target_versions
+    if target.package.name != name}
+measured_names = []             # every app in the CSV
+recomputed_names = set()        # every app NOT answered from footprint_cache, for the spot-check at the end
+
+footprint_cache_path = pathlib.Path('/tmp/install-footprint-cache.json')
+footprint_cache = {'closures': {}, 'popcon': {}}
+if footprint_cache_path.exists():
+    footprint_cache.update(json.loads(footprint_cache_path.read_text()))
+image_fingerprint = hashlib.sha256(json.dumps([
+    dependency_types,
+    sorted(f'{package.name}={package.installed.version}' for package in cache if package.is_installed),
+]).encode()).hexdigest()
+
 popcon_ranks = crunch_popcon()
 
 package_shitlist = {
@@ -421,7 +598,7 @@ with open('/tmp/app-reviews.csv') as f:
         if row['Package']}
 with open('/var/log/install-footprint.csv', 'w') as f:
     g = csv.writer(f)
-    g.writerow(['Section', 'Subsection', 'Name', 'Verdict', 'Score', 'Cost (MiB)', 'Rank', 'Description'])
+    rows = []                   # written at the end, once every app's closure is known
     for metapackage in metapackages:
         if metapackage.package.name == 'kdeedu':
             section, subsection = 'education', 'KDE'
@@ -445,12 +622,13 @@ with open('/var/log/install-footprint.csv', 'w') as f:
                     logging.debug('GNU R (statistics) needs zip (banned crypto) due to r-base-core. Therefore skipping.')
                     continue
             except KeyError:  # "The cache has no package named 'cups-pdf'"
-                g.writerow([section, subsection, name, verdict, 'N/A', 'N/A', 'N/A', 'N/A'])
+                rows.append([section, subsection, name, verdict, 'N/A', 'N/A', 'N/A', 'N/A'])
             else:
                 cost = measure_cost(name)
+                measured_names.append(name)
                 rank = popcon_ranks.get(name)
                 score = cost * rank if isinstance(cost, int) and isinstance(rank, int) else None
-                g.writerow([section, subsection, name, verdict, score, cost, rank, description])
+                rows.append([section, subsection, name, verdict, score, cost, rank, description])
 
     all_games = {
         line.split('/')[0]
@@ -478,9 +656,35 @@ with open('/var/log/install-footprint.csv', 'w') as f:
         try:
             description = cache[name].versions[0].raw_description.splitlines()[0]
         except KeyError:  # "The cache has no package named 'cups-pdf'"
-            g.writerow([section, subsection, name, verdict, 'N/A', 'N/A', 'N/A', 'N/A'])
+            rows.append([section, subsection, name, verdict, 'N/A', 'N/A', 'N/A', 'N/A'])
         else:
             cost = measure_cost(name)
+            measured_names.append(name)
             rank = popcon_ranks.get(name)
             score = cost * rank if isinstance(cost, int) and isinstance(rank, int) else None
-            g.writerow([section, subsection, name, verdict, score, cost, rank, description])
+            rows.append([section, subsection, name, verdict, score, cost, rank, description])
+
+    exclusive_costs = measure_exclusive_costs(measured_names)
+    g.writerow(['Section', 'Subsection', 'Name', 'Verdict', 'Score', 'Cost (MiB)', 'Exclusive Cost (MiB)', 'Rank', 'Description'])
+    for row in rows:
+        section, subsection, name, verdict, score, cost, rank, description = row
+        g.writerow([section, subsection, name, verdict, score, cost, exclusive_costs.get(name, 'N/A'), rank, description])
+
+# What would it cost to install every approved app at once?
+with open('/var/log/install-footprint-bundle.csv', 'w') as f:
+    g = csv.writer(f)
+    g.writerow(['Name', 'Added Cost (MiB)', 'Total Cost (MiB)'])
+    for name, added_cost, total_cost in cheapest_bundle(
+            name for name, verdict in verdicts.items() if verdict == 'PASS'):
+        g.writerow([name, added_cost, total_cost])
+
+footprint_cache_path.write_text(json.dumps(footprint_cache))
+logging.info('Recomputed %d of %d closures', len(recomputed_names), len(footprint_cache['closures']))
+
+# Spot-check the in-process answers against apt-get itself.
+# Only a sample, because apt-get is the slow part.
+# Only recomputed ones, because the others were spot-checked last time (or not at all, but still).
+for name in random.sample(sorted(recomputed_names), min(20, len(recomputed_names))):
+    if measure_cost(name) != measure_cost_with_apt_get(name):
+        logging.warning('measure_cost disagrees with apt-get for %s: %s != %s',
+                        name, measure_cost(name), measure_cost_with_apt_get(name))
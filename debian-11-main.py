@@ -1,19 +1,33 @@
 #!/usr/bin/python3
 import argparse
+import collections
+import concurrent.futures
 import configparser
+import contextlib
 import datetime
+import fcntl
+import functools
+import hashlib
+import http.server
 import io
 import json
 import logging
+import math
 import os
 import pathlib
 import pprint
 import re
+import shlex
 import shutil
+import statistics
 import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
+import time
 import types
+import typing
 
 import hyperlink                # URL validation
 import requests                 # FIXME: h2 support!
@@ -37,6 +51,369 @@ def validate_unescaped_path_is_safe(path: pathlib.Path) -> None:
             raise NotImplementedError('Path component should not need shell quoting', part, path)
 
 
+# Hash the names, executable bits and contents of every file under paths.
+# This is what create_tarball() & git actually care about (not mtime, not owner).
+def hash_tree(paths: typing.Iterable[pathlib.Path]) -> str:
+    acc = hashlib.sha256()
+    for root in paths:
+        for path in sorted([root, *root.glob('**/*')] if root.is_dir() else [root]):
+            if path.is_file():
+                acc.update(f'{path}\0{path.stat().st_mode & 0o111:o}\0'.encode())
+                acc.update(hashlib.sha256(path.read_bytes()).digest())
+    return acc.hexdigest()
+
+
+# Mark a cache file as used (for remove_unused()), if it's there.
+# NOTE: not .touch(), which would create an empty one.
+def mark_used(path: pathlib.Path) -> bool:
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+# Remove cache files that no build has used (i.e. touched) for max_idle_days.
+# Returns what it removed, for logging.
+def remove_unused(paths: typing.Iterable[pathlib.Path], max_idle_days: float) -> list:
+    removed = []
+    for path in paths:
+        try:
+            if time.time() - path.stat().st_mtime > max_idle_days * 86400:
+                path.unlink()
+                removed.append(path)
+        except FileNotFoundError:
+            pass                # a concurrent build removed it first
+    return removed
+
+
+# Hash the InRelease of every suite in a deb822 .sources file,
+# i.e. "what is in the archive right now".
+# NOTE: cached, because several caches ask, and the archive won't change under us mid-build (much).
+@functools.lru_cache
+def get_apt_release_digest(sources_path: pathlib.Path, apt_proxy: str) -> str:
+    acc = hashlib.sha256()
+    for paragraph in sources_path.read_text().split('\n\n'):
+        fields, key = {}, None
+        for line in paragraph.splitlines():
+            if line.startswith('#'):
+                continue
+            elif line.startswith((' ', '\t')):
+                fields[key] += ' ' + line.strip()
+            elif ':' in line:
+                key, _, value = line.partition(':')
+                fields[key] = value.strip()
+        for uri in fields.get('URIs', '').split():
+            for suite in fields.get('Suites', '').split():
+                resp = requests.get(f'{uri}/dists/{suite}/InRelease', proxies={'http': apt_proxy})
+                resp.raise_for_status()
+                acc.update(resp.content)
+    return acc.hexdigest()
+
+
+# Every phase of the build, in the order it finished, as {"phase": ..., "seconds": ...}.
+# This ends up in destdir/timings.json (and --cache-dir/timings/), so
+# comments like "save 12s" below can be checked, instead of measured by hand.
+timings = []
+
+
+@contextlib.contextmanager
+def timed(phase: str) -> typing.Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings.append({'phase': phase, 'seconds': round(time.monotonic() - start, 3)})
+
+
+# Every second, note how big a build's own temporary directory is, and how much RAM & I/O a process (and its children) use.
+# Used with check_call_mmdebstrap_timed(), so the timing report also says e.g.
+# "this hook is where /tmp peaks", not just "this hook is slow".
+# NOTE: only count tmp_dir (not "used" on the whole filesystem), because other builds share the filesystem.
+#       Some of the chroot (e.g. /root) is unreadable to us, so this slightly underestimates.
+# NOTE: /proc/PID/io is only readable for our own processes, not those mmdebstrap runs as (unshared) root.
+#       The kernel adds a child's I/O to its parent when the child exits, so
+#       mmdebstrap's own /proc/PID/io still ends up counting (nearly) everything.
+class ResourceSampler:
+    Sample = collections.namedtuple('Sample', 'time tmp_bytes rss_bytes read_bytes write_bytes')
+
+    def __init__(self, pid: int, tmp_dir: pathlib.Path, interval: float = 1):
+        self.pid, self.tmp_dir, self.interval = pid, tmp_dir, interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.samples.append(self.sample())
+
+    def descendants(self) -> list:
+        children = collections.defaultdict(list)
+        for stat_path in pathlib.Path('/proc').glob('[0-9]*/stat'):
+            try:
+                # comm can contain spaces and parens, so split after the LAST ")".
+                ppid = int(stat_path.read_text().rpartition(')')[-1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue        # exited while we were looking
+            children[ppid].append(int(stat_path.parent.name))
+        acc, todo = [], [self.pid]
+        while todo:
+            acc.append(todo.pop())
+            todo.extend(children[acc[-1]])
+        return acc
+
+    # Like "du -s", i.e. blocks actually allocated (sparse files and tmpfs count what they really use).
+    def tmp_bytes(self) -> int:
+        acc, todo = 0, [self.tmp_dir]
+        while todo:
+            try:
+                with os.scandir(todo.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            todo.append(entry.path)
+                        acc += entry.stat(follow_symlinks=False).st_blocks * 512
+            except OSError:
+                continue        # unreadable, or deleted while we were looking
+        return acc
+
+    def sample(self) -> Sample:
+        rss_bytes = read_bytes = write_bytes = 0
+        for pid in self.descendants():
+            try:
+                rss_bytes += int(pathlib.Path(f'/proc/{pid}/statm').read_text().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+                io = dict(line.split(': ') for line in pathlib.Path(f'/proc/{pid}/io').read_text().splitlines())
+                read_bytes += int(io['read_bytes'])
+                write_bytes += int(io['write_bytes'])
+            except (OSError, ValueError, KeyError):
+                continue        # exited, or not ours
+        return self.Sample(time.time(), self.tmp_bytes(), rss_bytes, read_bytes, write_bytes)
+
+    # Peaks & totals between two times (same clock as "date +%s").
+    def summarise(self, start: float, end: float) -> dict:
+        before = [sample for sample in self.samples if sample.time < start]
+        during = [sample for sample in self.samples if start <= sample.time <= end]
+        if not during:
+            return {}           # phase was shorter than self.interval
+        return {
+            'peak_tmp_bytes': max(sample.tmp_bytes for sample in during),
+            'peak_rss_bytes': max(sample.rss_bytes for sample in during),
+            'read_bytes': during[-1].read_bytes - (before[-1].read_bytes if before else 0),
+            'write_bytes': during[-1].write_bytes - (before[-1].write_bytes if before else 0)}
+
+
+# mmdebstrap does not say how long each hook took.
+# So after every hook, add another hook that appends "<time> <index>" to a log inside the chroot.
+# The time between two markers is how long the hook (or mmdebstrap phase) between them took.
+# Each kind of hook also gets a marker BEFORE its first hook, which
+# measures what mmdebstrap itself did since the previous kind of hook.
+# Ref. https://manpages.debian.org/bookworm/mmdebstrap/mmdebstrap.1.en.html#HOOKS
+def check_call_mmdebstrap_timed(
+        command: list,
+        options: list,
+        positional: list,
+        log_path: pathlib.Path,
+        last_phase: str,
+        pipe_to: list = None,
+        tmp_dir: pathlib.Path = None) -> None:
+    labels = []
+
+    def marker(kind: str, label: str) -> str:
+        # Labels must be the same from one build to the next, so compare_timings() can match them up.
+        # NOTE: log_path is in td, which is different every run.
+        labels.append(re.sub(r'[0-9a-f]{64}', 'SHA256', label.replace(str(log_path.parent), 'TD')))
+        return f'--{kind}-hook=echo $(date +%s.%N) {len(labels) - 1} >>$1/bootstrap2020-timings.log'
+
+    acc = [marker('setup', 'mmdebstrap: setup'),
+           marker('extract', 'mmdebstrap: update, download & extract essential packages'),
+           marker('essential', 'mmdebstrap: install essential packages'),
+           marker('customize', 'mmdebstrap: download, unpack & configure --include packages')]
+    for option in options:
+        if str(option).startswith('--hook-dir='):
+            # Do what mmdebstrap would do with --hook-dir ourselves, so each script gets its own marker:
+            # one --X-hook= per executable file named X*, in name order, where the --hook-dir= was.
+            hook_dir = pathlib.Path(str(option).removeprefix('--hook-dir='))
+            expanded = [f'--{kind}-hook={path}'
+                        for kind in ('setup', 'extract', 'essential', 'customize')
+                        for path in sorted(hook_dir.glob(f'{kind}*'))
+                        if path.is_file() and os.access(path, os.X_OK)]
+        else:
+            expanded = [option]
+        for option in expanded:
+            acc.append(option)
+            if m := re.fullmatch(r'--(setup|extract|essential|customize)-hook=(.*)', str(option), flags=re.DOTALL):
+                acc.append(marker(m[1], f'{m[1]}-hook: {m[2]}'))
+    acc += [f'--customize-hook=download /bootstrap2020-timings.log {log_path}',
+            '--customize-hook=rm $1/bootstrap2020-timings.log']
+    previous = time.time()      # same clock as "date +%s"
+    with (subprocess.Popen([*command, *acc, *positional],
+                           # e.g. "mmdebstrap ... - | sqfstar ..."
+                           stdout=subprocess.PIPE if pipe_to else None) as proc,
+          ResourceSampler(proc.pid, tmp_dir or pathlib.Path(tempfile.gettempdir())) as sampler):
+        if pipe_to:
+            subprocess.check_call(pipe_to, stdin=proc.stdout)
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    end = time.time()
+    for line in [*log_path.read_text().splitlines(), f'{end} {len(labels)}']:
+        when, index = line.split()
+        timings.append({'phase': [*labels, last_phase][int(index)],
+                        'seconds': round(float(when) - previous, 3),
+                        **sampler.summarise(previous, float(when))})
+        previous = float(when)
+
+
+# Ask rsync how much of new_path it would send, if old_path was already on the other end.
+# --only-write-batch does the whole delta algorithm, but doesn't touch old_path.
+# NOTE: --no-whole-file because rsync defaults to --whole-file for local copies.
+def measure_rsync_delta(old_path: pathlib.Path, new_path: pathlib.Path) -> dict:
+    with tempfile.TemporaryDirectory() as td:
+        stdout = subprocess.check_output(
+            ['rsync', '--no-whole-file', '--stats', '--no-human-readable',
+             f'--only-write-batch={td}/batch',
+             new_path, old_path],
+            text=True)
+    matched, = re.findall(r'^Matched data: ([0-9,]+) bytes', stdout, flags=re.MULTILINE)
+    literal, = re.findall(r'^Literal data: ([0-9,]+) bytes', stdout, flags=re.MULTILINE)
+    return {'previous': str(old_path),
+            'matched_bytes': int(matched.replace(',', '')),
+            'literal_bytes': int(literal.replace(',', '')),
+            'total_bytes': new_path.stat().st_size}
+
+
+# Warn about phases that got noticeably slower since the previous build.
+# Small absolute differences are just noise (e.g. a busy apt proxy), so ignore those.
+def compare_timings(old_timings: list, new_timings: list, ratio: float = 1.2, noise_seconds: float = 5) -> None:
+    old, new = collections.Counter(), collections.Counter()
+    for acc, phases in ((old, old_timings), (new, new_timings)):
+        for phase in phases:
+            acc[phase['phase']] += phase['seconds']
+    for phase, seconds in new.items():
+        if phase not in old:
+            logging.info('New phase (nothing to compare): %s (%.1fs)', phase, seconds)
+        elif seconds > old[phase] * ratio and seconds - old[phase] > noise_seconds:
+            logging.warning('Phase got slower: %s (%.1fs -> %.1fs)', phase, old[phase], seconds)
+
+
+# Parse a dpkg status file (deb822) into {package: {field: value}}, keeping only installed packages.
+# Ref. https://manpages.debian.org/deb-control
+def parse_dpkg_status(status_path: pathlib.Path) -> dict:
+    packages = {}
+    for paragraph in re.split(r'\n\n+', status_path.read_text()):
+        fields = dict(re.findall(r'^(\S+): ?(.*(?:\n[ \t].*)*)', paragraph, flags=re.MULTILINE))
+        if fields.get('Status', '').endswith(' installed'):
+            # Multi-Arch: same (e.g. libc6 and libc6:i386) would otherwise collide.
+            name = fields['Package'] if fields['Package'] not in packages else f'{fields["Package"]}:{fields["Architecture"]}'
+            packages[name] = fields
+    return packages
+
+
+# "libc6 (>= 2.34), foo | bar:any" to [['libc6'], ['foo', 'bar']].
+def parse_relations(value: str) -> list:
+    return [[re.match(r'[^\s:(\[]+', alternative.strip())[0] for alternative in relation.split('|')]
+            for relation in value.split(',') if relation.strip()]
+
+
+# What does each package cost (Installed-Size), and which --include pulled it in?
+# Follow Depends/Pre-Depends only, because mmdebstrap doesn't install Recommends.
+# A package pulled in by NO --include is part of the essential/required set mmdebstrap always installs.
+# "exclusive" is what dropping just that one --include would save.
+def size_report(status_path: pathlib.Path, include_names: typing.Iterable[str]) -> dict:
+    packages = parse_dpkg_status(status_path)
+    providers = collections.defaultdict(set)
+    for name, fields in packages.items():
+        providers[fields['Package']].add(name)
+        for provided, *_ in parse_relations(fields.get('Provides', '')):
+            providers[provided].add(name)
+    pulled_in_by = collections.defaultdict(set)
+    for include in set(include_names):
+        todo = list(providers.get(include, ()))
+        while todo:
+            name = todo.pop()
+            if include in pulled_in_by[name]:
+                continue
+            pulled_in_by[name].add(include)
+            for alternatives in parse_relations(', '.join(
+                    packages[name].get(field, '') for field in ('Pre-Depends', 'Depends'))):
+                # apt picks the first alternative it can; assume it's the first one that IS installed.
+                todo.extend(next((providers[a] for a in alternatives if a in providers), ()))
+    report = {
+        'packages': {
+            name: {'version': fields['Version'],
+                   'installed_KiB': int(fields.get('Installed-Size', 0)),
+                   'priority': fields.get('Priority', 'unknown'),
+                   'pulled_in_by': sorted(pulled_in_by[name])}
+            for name, fields in sorted(packages.items())},
+        'includes': {}}
+    for include in sorted(set(include_names)):
+        closure = [p for p in report['packages'].values() if include in p['pulled_in_by']]
+        report['includes'][include] = {
+            'installed_KiB': sum(p['installed_KiB'] for p in closure),
+            'exclusive_KiB': sum(p['installed_KiB'] for p in closure if p['pulled_in_by'] == [include])}
+    report['installed_KiB'] = sum(p['installed_KiB'] for p in report['packages'].values())
+    return report
+
+
+# Log what got bigger (or smaller) since the previous build, biggest first.
+def compare_size_reports(old: dict, new: dict, top: int = 20) -> None:
+    def installed_KiB(report: dict, name: str) -> int:
+        return report['packages'].get(name, {}).get('installed_KiB', 0)
+    deltas = {name: installed_KiB(new, name) - installed_KiB(old, name)
+              for name in {*old['packages'], *new['packages']}}
+    for name, delta in sorted(deltas.items(), key=lambda kv: abs(kv[1]), reverse=True)[:top]:
+        if delta:
+            logging.info('%+8d KiB  %s (%s)', delta, name,
+                         'new' if name not in old['packages'] else
+                         'gone' if name not in new['packages'] else
+                         f'{old["packages"][name]["version"]} -> {new["packages"][name]["version"]}')
+    logging.info('Installed-Size %+d MiB, filesystem.squashfs %+d MiB since the previous build',
+                 (new['installed_KiB'] - old['installed_KiB']) // 2**10,
+                 (new['squashfs_bytes'] - old['squashfs_bytes']) // 2**20)
+
+
+# Fetch one --authorized-keys-urls entry, via a cache in cache_dir.
+# If nothing changed since last time, the server just says "304 Not Modified".
+# If the server is down (e.g. Github is having a bad day), use the last good copy instead of failing the build.
+def fetch_authorized_keys(session: requests.Session, url: hyperlink.URL, cache_dir: pathlib.Path) -> bytes:
+    cache_path = cache_dir / hashlib.sha256(url.to_text().encode()).hexdigest()
+    headers_path = cache_path.with_suffix('.json')
+    cached_headers = (
+        json.loads(headers_path.read_text())
+        if cache_path.exists() and headers_path.exists() else {})
+    try:
+        resp = session.get(
+            url.to_text(),
+            timeout=30,
+            headers={k: v for k, v in {'If-None-Match': cached_headers.get('ETag'),
+                                       'If-Modified-Since': cached_headers.get('Last-Modified')}.items()
+                     if v})
+        resp.raise_for_status()
+    except requests.exceptions.RequestException:
+        if not cache_path.exists():
+            raise
+        logging.warning('Cannot fetch %s; using the copy from %s', url.to_text(),
+                        datetime.datetime.fromtimestamp(cache_path.stat().st_mtime))
+        return cache_path.read_bytes()
+    if resp.status_code == 304:  # Not Modified
+        return cache_path.read_bytes()
+    # can't use resp.content, because website might be using BIG5 or something.
+    content = b'#' + url.to_text().encode() + b'\n' + resp.text.encode() + b'\n'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    tmp_path.write_bytes(content)
+    tmp_path.rename(cache_path)
+    headers_path.write_text(json.dumps({k: resp.headers[k] for k in ('ETag', 'Last-Modified') if k in resp.headers}))
+    return content
+
+
 def hostname_or_fqdn_with_optional_user_at(s: str) -> str:
     if re.fullmatch(r'([a-z]+@)?[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?(\.[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?)*', s):
         return s
@@ -58,6 +435,9 @@ group.add_argument('--break', default='',
                    help='pause boot test during initrd')
 group.add_argument('--backdoor-enable', action='store_true',
                    help='login as root with no password')
+group.add_argument('--boot-test-benchmark', type=int, metavar='N',
+                   help='instead of an interactive --boot-test, boot N times headless and'
+                   ' write boot-benchmark.json (median/p95 boot time, slowest units)')
 group.add_argument('--host-port-for-boot-test-ssh', type=int, default=2022, metavar='N',
                    help='so you can run two of these at once')
 group.add_argument('--host-port-for-boot-test-vnc', type=int, default=5900, metavar='N',
@@ -65,8 +445,23 @@ group.add_argument('--host-port-for-boot-test-vnc', type=int, default=5900, meta
 group.add_argument('--opengl-for-boot-test-ssh', action='store_true',
                    help='Enable OpenGL in --boot-test (requires qemu 7.1)')
 group.add_argument('--measure-install-footprints', action='store_true')
+group.add_argument('--netboot-transport', choices=('auto', 'smb', 'tftp', 'http'), default='auto',
+                   help='how --boot-test --netboot-only gets filesystem.squashfs'
+                   ' (auto: smb if smbd is installed, else http)')
+group.add_argument('--record-boot-trace', action='store_true',
+                   help='during --boot-test, record which files are read during boot, so'
+                   ' the next build of this template puts them first in filesystem.squashfs')
+group.add_argument('--compare-timings', action='store_true',
+                   help='warn about phases that got slower since the previous build of this template')
 parser.add_argument('--destdir', type=lambda s: pathlib.Path(s).resolve(),
                     default='/tmp/bootstrap2020/')
+parser.add_argument('--cache-dir', type=lambda s: pathlib.Path(s).resolve(),
+                    default='/var/tmp/bootstrap2020/',
+                    help='keep things that can be reused between builds here (e.g. --deb-pool)')
+parser.add_argument('--offline', action='store_true',
+                    help='build using only the .debs earlier --deb-pool builds kept (no mirror or proxy needed)')
+parser.add_argument('--prefetch-debs', action='store_true',
+                    help='build nothing; just download the .debs this template needs into --deb-pool')
 parser.add_argument('--template', default='main',
                     choices=('main',
                              'dban',
@@ -93,6 +488,19 @@ parser.add_argument('--rpi', default=None, choices=['armel'],
 group = parser.add_argument_group('optimization')
 group.add_argument('--optimize', choices=('size', 'speed', 'simplicity'), default='size',
                    help='build slower to get a smaller image? (default=size)')
+group.add_argument('--squashfs-layout', choices=('default', 'delta'), default='default',
+                   help='delta: slightly bigger filesystem.squashfs, but'
+                   ' --upload-to only sends what changed since the previous build')
+group.add_argument('--stage-on-tmpfs', choices=('never', 'auto', 'always'), default='never',
+                   help='build the chroot in /dev/shm, not $TMPDIR?'
+                   ' (auto: if the previous build\'s peak fits in available RAM)')
+group.add_argument('--deb-pool', action='store_true',
+                   help='keep every .deb downloaded in --cache-dir, and install from there next time (any template)')
+group.add_argument('--skip-if-unchanged', action='store_true',
+                   help='if an image was already built from exactly these inputs, reuse it instead of building')
+group.add_argument('--max-image-growth', type=int, metavar='MiB',
+                   help='fail if filesystem.squashfs grew by more than this since the previous build of this template'
+                   ' (see size-report.json for which packages grew)')
 mutex = group.add_mutually_exclusive_group()
 mutex.add_argument('--netboot-only', '--no-local-boot', action='store_true',
                    help='save space/time by omitting USB/SSD stuff')
@@ -160,18 +568,101 @@ git_proc = subprocess.run(
 git_description = git_proc.stdout.strip() if git_proc.returncode == 0 else 'UNKNOWN'
 
 have_smbd = pathlib.Path('/usr/sbin/smbd').exists()
-if args.boot_test and args.netboot_only and not have_smbd:
-    logging.warning('No /usr/sbin/smbd; will test with TFTP (fetch=).'
+netboot_transport = (
+    args.netboot_transport if args.netboot_transport != 'auto' else
+    'smb' if have_smbd else
+    'http')
+if args.netboot_transport != 'auto' and not args.netboot_only:
+    raise NotImplementedError('--netboot-transport only applies to --netboot-only')
+if netboot_transport == 'smb' and not have_smbd:
+    raise NotImplementedError('--netboot-transport=smb needs /usr/sbin/smbd')
+if args.boot_test and args.netboot_only and netboot_transport == 'tftp':
+    logging.warning('Testing with TFTP (fetch=).'
                     '  This is OK for small images; bad for big ones!')
 
+# Files written into destdir AFTER mmdebstrap, i.e. not part of "the image" for --skip-if-unchanged.
+post_build_file_names = {
+    'fingerprint.txt',
+    'timings.json',
+    'args.txt',
+    'git-description.txt',
+    'B2SUMS',
+    'SHA3SUMS',
+    'squashfs-delta.json',
+    'boot-benchmark.json',
+    'boot-benchmark-serial.log',
+    'netboot-transport.json',
+    'size-report.json',
+}
+
 if args.boot_test and args.physical_only:
     raise NotImplementedError("You can't --boot-test a --physical-only (--no-virtual) build!")
 
+if args.boot_test_benchmark and not args.boot_test:
+    raise NotImplementedError("--boot-test-benchmark is a kind of --boot-test")
+
+if args.record_boot_trace and not args.boot_test:
+    raise NotImplementedError("--record-boot-trace only records during --boot-test")
+
+# The trace only stops (and leaves /run) when --boot-test's boottrace disk is there.
+# On real hardware, fatrace would log every file access to RAM until it ran out.
+if args.record_boot_trace and (args.upload_to or args.github_release):
+    raise NotImplementedError("Don't publish a --record-boot-trace image (it runs fatrace on every boot)")
+
+# Only sqfstar can apply the trace (see -sort below), so without it the trace would never be used.
+if args.record_boot_trace and not shutil.which('sqfstar'):
+    raise NotImplementedError('--record-boot-trace needs sqfstar (squashfs-tools 4.6) to use the trace')
+
 template_wants_WiFi = args.template in {'jellyfin-media-player', 'cec-androidtv-fixes'}
 template_wants_GUI = args.template.startswith('desktop')
 template_wants_DVD = args.template.startswith('desktop')
 template_wants_disks = args.template in {'dban', 'zfs'}
 
+if args.offline or args.prefetch_debs:
+    args.deb_pool = True        # --offline & --prefetch-debs need the pool
+
+if args.prefetch_debs and any([args.boot_test, args.upload_to, args.github_release, args.skip_if_unchanged]):
+    raise NotImplementedError('--prefetch-debs builds no image to test, upload or reuse')
+
+validate_unescaped_path_is_safe(args.cache_dir)
+
+
+# The timings.json of the newest earlier build of this template (if any).
+def get_previous_timings_path() -> typing.Optional[pathlib.Path]:
+    paths = sorted(
+        path for path in (args.cache_dir / 'timings').glob(f'{args.template}-*.json')
+        if re.fullmatch(fr'{re.escape(args.template)}-\d{{4}}-\d{{2}}-\d{{2}}\.json', path.name))
+    return paths[-1] if paths else None
+
+
+# mmdebstrap stages the whole chroot in $TMPDIR, which
+# on the shared build host is an SSD that several builds are hammering at once.
+# Would the chroot fit in RAM instead?  Guess from the previous build's peaks (plus 25% slack).
+def tmpfs_fits_previous_peak() -> bool:
+    previous_timings_path = get_previous_timings_path()
+    if not previous_timings_path:
+        logging.info('No previous %s build, so no idea how big the chroot gets; not staging on tmpfs', args.template)
+        return False
+    phases = json.loads(previous_timings_path.read_text())['phases']
+    peak_tmp_bytes = max((phase.get('peak_tmp_bytes', 0) for phase in phases), default=0)
+    peak_rss_bytes = max((phase.get('peak_rss_bytes', 0) for phase in phases), default=0)
+    mem_available_bytes = 1024 * int(re.search(
+        r'^MemAvailable:\s+(\d+) kB', pathlib.Path('/proc/meminfo').read_text(), flags=re.MULTILINE)[1])
+    fits = all([
+        peak_tmp_bytes > 0,     # i.e. the previous build was measured
+        peak_tmp_bytes * 1.25 + peak_rss_bytes < mem_available_bytes,
+        peak_tmp_bytes * 1.25 < shutil.disk_usage('/dev/shm').free])
+    logging.info('Previous %s build peaked at %d MiB $TMPDIR + %d MiB RSS; %d MiB RAM available; %s',
+                 args.template, peak_tmp_bytes // 2**20, peak_rss_bytes // 2**20, mem_available_bytes // 2**20,
+                 'staging on tmpfs' if fits else 'NOT staging on tmpfs')
+    return fits
+
+
+mmdebstrap_staging_dir = (
+    pathlib.Path('/dev/shm')
+    if args.stage_on_tmpfs == 'always' or (args.stage_on_tmpfs == 'auto' and tmpfs_fits_previous_peak()) else
+    pathlib.Path(tempfile.gettempdir()))
+
 if template_wants_GUI and args.virtual_only:
     logging.warning('GUI on cloud kernel is a bit hinkey')
 
@@ -196,416 +687,800 @@ if subprocess.check_output(
         ' make the /lib/systemd/resolv.conf line run much later.')
 
 # Use a separate declarative file for these long, boring lists.
-with tempfile.TemporaryDirectory() as td:
-    td = pathlib.Path(td)
+# mmdebstrap gets its own $TMPDIR, so ResourceSampler can measure just this build's chroot.
+# NOTE: ignore_cleanup_errors, because a failed mmdebstrap can leave files owned by its (unshared) root.
+with tempfile.TemporaryDirectory() as td, \
+     tempfile.TemporaryDirectory(dir=mmdebstrap_staging_dir, ignore_cleanup_errors=True) as mmdebstrap_tmpdir:
+    td, mmdebstrap_tmpdir = pathlib.Path(td), pathlib.Path(mmdebstrap_tmpdir)
     validate_unescaped_path_is_safe(td)
+    validate_unescaped_path_is_safe(mmdebstrap_tmpdir)
     # FIXME: use SSH certificates instead, and just trust a static CA!
-    authorized_keys_tar_path = td / 'ssh.tar'
-    with tarfile.open(authorized_keys_tar_path, 'w') as t:
-        with io.BytesIO() as f:  # addfile() can't autoconvert StringIO.
-            for url in args.authorized_keys_urls:
-                resp = requests.get(url)
-                resp.raise_for_status()
-                f.write(b'#')
-                f.write(url.to_text().encode())
-                f.write(b'\n')
-                # can't use resp.content, because website might be using BIG5 or something.
-                f.write(resp.text.encode())
-                f.write(b'\n')
-                f.flush()
-            member = tarfile.TarInfo('root/.ssh/authorized_keys')
-            member.mode = 0o0400
-            member.size = f.tell()
-            f.seek(0)
-            t.addfile(member, f)
+    # NOTE: the tarball is content-addressed (and has a fixed mtime), so
+    #       it only changes when the keys change, and doesn't invalidate caches keyed on it.
+    with timed('authorized_keys'):
+        with requests.Session() as session, concurrent.futures.ThreadPoolExecutor() as pool:
+            authorized_keys = b''.join(pool.map(
+                lambda url: fetch_authorized_keys(session, url, args.cache_dir / 'authorized-keys'),
+                args.authorized_keys_urls))
+        authorized_keys_tar_path = (
+            args.cache_dir / 'authorized-keys' / f'{hashlib.sha256(authorized_keys).hexdigest()}.tar')
+        authorized_keys_tar_path.parent.mkdir(parents=True, exist_ok=True)
+        if not mark_used(authorized_keys_tar_path):
+            tmp_path = authorized_keys_tar_path.with_suffix(f'.{os.getpid()}.tmp')
+            with tarfile.open(tmp_path, 'w') as t:
+                member = tarfile.TarInfo('root/.ssh/authorized_keys')
+                member.mode = 0o0400
+                member.size = len(authorized_keys)
+                t.addfile(member, io.BytesIO(authorized_keys))
+            tmp_path.rename(authorized_keys_tar_path)
+
+    # Overlay tarballs are content-addressed, so
+    # they are reused between builds (and templates) until a .tarinfo or its content changes.
+    # Writing them is done in the background; wait_for_tarballs() before running mmdebstrap.
+    # Each build marks the ones it uses (mtime); any no build has used for tarball_max_idle_days are removed.
+    tarball_max_idle_days = 30
+    overlays_dir = args.cache_dir / 'overlays'
+    overlays_dir.mkdir(parents=True, exist_ok=True)
+    overlay_pool = concurrent.futures.ThreadPoolExecutor()
+    overlay_futures = {}
 
     def create_tarball(src_path: pathlib.Path) -> pathlib.Path:
         src_path = pathlib.Path(src_path)
         assert src_path.exists(), 'The .glob() does not catch this!'
-        # FIXME: this can still collide
-        # FIXME: can't do symlinks, directories, &c.
-        dst_path = td / f'{src_path.name}.tar'
-        with tarfile.open(dst_path, 'w') as t:
-            for tarinfo_path in src_path.glob('**/*.tarinfo'):
-                content_path = tarinfo_path.with_suffix('')
-                tarinfo_object = tarfile.TarInfo()
-                # git can store *ONE* executable bit.
-                # Default to "r--------" or "r-x------", not "---------".
-                tarinfo_object.mode = (
-                    0 if not content_path.exists() else
-                    0o500 if content_path.stat().st_mode & 0o111 else 0o400)
-                for k, v in json.loads(tarinfo_path.read_text()).items():
-                    setattr(tarinfo_object, k, v)
-                if tarinfo_object.linkpath:
-                    tarinfo_object.type = tarfile.SYMTYPE
+        tarinfo_objects = []
+        digest = hashlib.sha256()
+        for tarinfo_path in src_path.glob('**/*.tarinfo'):
+            content_path = tarinfo_path.with_suffix('')
+            tarinfo_object = tarfile.TarInfo()
+            # git can store *ONE* executable bit.
+            # Default to "r--------" or "r-x------", not "---------".
+            tarinfo_object.mode = (
+                0 if not content_path.exists() else
+                0o500 if content_path.stat().st_mode & 0o111 else 0o400)
+            for k, v in json.loads(tarinfo_path.read_text()).items():
+                setattr(tarinfo_object, k, v)
+            if tarinfo_object.linkpath:
+                tarinfo_object.type = tarfile.SYMTYPE
+            elif content_path.is_dir():
+                tarinfo_object.type = tarfile.DIRTYPE
+            if tarinfo_object.isreg():
+                tarinfo_object.size = content_path.stat().st_size
+            tarinfo_objects.append((tarinfo_object, content_path))
+        # Parent directories must come before their contents.
+        tarinfo_objects.sort(key=lambda pair: pair[0].name)
+        for tarinfo_object, content_path in tarinfo_objects:
+            digest.update(repr(tarinfo_object.get_info()).encode())
+            if tarinfo_object.isreg():
+                digest.update(hashlib.sha256(content_path.read_bytes()).digest())
+        # NOTE: name is content hash, so different overlays can no longer collide.
+        dst_path = overlays_dir / f'{digest.hexdigest()}.tar'
+        if not mark_used(dst_path) and dst_path not in overlay_futures:
+            overlay_futures[dst_path] = overlay_pool.submit(
+                timed(f'overlay tarball: {src_path}')(write_tarball), tarinfo_objects, dst_path)
+        return dst_path
+
+    def write_tarball(tarinfo_objects: list, dst_path: pathlib.Path) -> None:
+        # Write under a temporary name, then rename, so
+        # a concurrent or interrupted build never sees half a tarball.
+        tmp_path = dst_path.with_name(f'{dst_path.stem}-{os.getpid()}.tmp')
+        with tarfile.open(tmp_path, 'w') as t:
+            for tarinfo_object, content_path in tarinfo_objects:
                 if tarinfo_object.isreg():
-                    tarinfo_object.size = content_path.stat().st_size
                     with content_path.open('rb') as content_handle:
                         t.addfile(tarinfo_object, content_handle)
                 else:
                     t.addfile(tarinfo_object)
+        tmp_path.rename(dst_path)
         # subprocess.check_call(['tar', 'vvvtf', dst_path])  # DEBUGGING
-        return dst_path
 
-    subprocess.check_call(
-        ['nice', 'ionice', '-c3', 'chrt', '--idle', '0',
-         'mmdebstrap',
-         '--dpkgopt=force-confold',  # https://bugs.debian.org/981004
-         '--aptopt=APT::AutoRemove::SuggestsImportant "false"',  # fix autoremove
-         '--include=linux-image-rpi' if args.rpi == 'armel' else
-         '--include=linux-image-rt-armmp' if args.rpi == 'armhf' else
-         '--include=linux-image-rt-arm64' if args.rpi == 'arm64' else
-         '--include=linux-image-cloud-amd64'
-         if args.virtual_only else
-         # NOTE: can't --include= this because there are too many dpkg trigger problems.
-         '--include=linux-image-amd64',
-         '--include=live-boot',
-         *([f'--aptopt=Acquire::http::Proxy "{apt_proxy}"',  # save 12s
-            '--aptopt=Acquire::https::Proxy "DIRECT"']
-           if args.optimize != 'simplicity' else []),
-         *(['--variant=apt',           # save 12s 30MB
-            '--include=netbase',       # https://bugs.debian.org/995343 et al
-            '--include=init']          # https://bugs.debian.org/993289
-           if args.optimize != 'simplicity' else []),
-         '--include=systemd-timesyncd',  # https://bugs.debian.org/986651
-         *(['--dpkgopt=force-unsafe-io']  # save 20s (even on tmpfs!)
-           if args.optimize != 'simplicity' else []),
-         # Reduce peak /tmp usage by about 500MB
-         *(['--essential-hook=chroot $1 apt clean',
-            '--customize-hook=chroot $1 apt clean']
-           if args.optimize != 'simplicity' else []),
-         *(['--dpkgopt=path-exclude=/usr/share/doc/*']  # 9% to 12% smaller and
-           if args.optimize == 'size' else []),
-         *(['--dpkgopt=path-exclude=/usr/share/man/*']  # 8% faster to 7% SLOWER. Breaks JRE install
-           if args.optimize == 'size' and args.template != 'minecraft-server' else []),
-         *([]
-           if args.optimize == 'simplicity' else
-           ['--include=pigz']       # save 8s
-           if args.optimize == 'speed' else
-           ['--include=xz-utils',   # save 10MB lose 28s
-            '--essential-hook=mkdir -p $1/etc/initramfs-tools/conf.d',
-            '--essential-hook=>$1/etc/initramfs-tools/conf.d/xz echo COMPRESS=xz']),
-         *(['--include=dbus',       # https://bugs.debian.org/814758
-            '--customize-hook=ln -nsf /etc/machine-id $1/var/lib/dbus/machine-id']  # https://bugs.debian.org/994096
-           if args.optimize != 'simplicity' else []),
-         *(['--include=libnss-myhostname libnss-resolve',
-            '--include=policykit-1',  # https://github.com/openbmc/openbmc/issues/3543
-            '--customize-hook=rm $1/etc/hostname',
-            '--customize-hook=ln -nsf /lib/systemd/resolv.conf $1/etc/resolv.conf',
-            '--include=rsyslog-relp msmtp-mta',
-            '--include=python3-dbus',  # for get-config-from-dnssd
-            '--include=debian-security-support',  # for customize90-check-support-status.py
-            f'--essential-hook=tar-in {create_tarball("debian-11-main")} /',
-            '--hook-dir=debian-11-main.hooks',
-            ]
-           if args.optimize != 'simplicity' else []),
-         *(['--include=tzdata',
-            '--essential-hook={'
-            f'    echo tzdata tzdata/Areas                select {args.TZ.area};'
-            f'    echo tzdata tzdata/Zones/{args.TZ.area} select {args.TZ.zone};'
-            '     } | chroot $1 debconf-set-selections']
-           if args.optimize != 'simplicity' else []),
-         *(['--include=locales',
-            '--essential-hook={'
-            f'    echo locales locales/default_environment_locale select {args.LANG.full};'
-            f'    echo locales locales/locales_to_be_generated multiselect {args.LANG.full} {args.LANG.encoding};'
-            '     } | chroot $1 debconf-set-selections']
-           if args.optimize != 'simplicity' else []),
-         # x86_64 CPUs are undocumented proprietary RISC chips that EMULATE a documented x86_64 CISC ISA.
-         # The emulator is called "microcode", and is full of security vulnerabilities.
-         # Make sure security patches for microcode for *ALL* CPUs are included.
-         # By default, it tries to auto-detect the running CPU, so only patches the CPU of the build server.
-         *([*(['--include=intel-microcode amd64-microcode'] if not args.rpi else []),
-            '--essential-hook=>$1/etc/default/intel-microcode echo IUCODE_TOOL_INITRAMFS=yes IUCODE_TOOL_SCANCPUS=no',
-            '--essential-hook=>$1/etc/default/amd64-microcode echo AMD64UCODE_INITRAMFS=yes',
-            '--components=main contrib non-free']
-           if args.optimize != 'simplicity' and not args.virtual_only else []),
-         *(['--include=ca-certificates publicsuffix']
-           if args.optimize != 'simplicity' else []),
-         *(['--include=nfs-client',  # support NFSv4 (not just NFSv3)
-            '--include=cifs-utils',  # support SMB3
-            f'--essential-hook=tar-in {create_tarball("debian-11-main.netboot")} /']
-           if not args.local_boot_only else []),
-         *([f'--essential-hook=tar-in {create_tarball("debian-11-main.netboot-only")} /']  # 9% faster 19% smaller
-           if args.netboot_only else []),
-         *(['--include=nwipe']
-           if args.template == 'dban' else []),
-         *(['--include=zfs-dkms zfsutils-linux zfs-zed',
-            '--include=mmdebstrap auto-apt-proxy',  # for installing
-            '--include=linux-headers-cloud-amd64'
-            if args.virtual_only else
-            '--include=linux-headers-amd64']
-           if args.template == 'zfs' else []),
-         *(['--include=smartmontools'
-            '    bsd-mailx'    # smartd calls mail(1), not sendmail(8)
-            '    curl ca-certificates gnupg',  # update-smart-drivedb
-            f'--essential-hook=tar-in {create_tarball("debian-11-main.disks")} /',
-            '--customize-hook=chroot $1 update-smart-drivedb'
-            ]
-           if template_wants_disks and not args.virtual_only else []),
-         *(['--include='
-            '    xserver-xorg-core xserver-xorg-input-libinput'
-            '    xfce4-session xfwm4 xfdesktop4 xfce4-panel thunar galculator'
-            '    xdm'
-            '    pulseaudio xfce4-pulseaudio-plugin pavucontrol'
-            # Without "alsactl init" & /usr/share/alsa/init/default,
-            # pipewire/pulseaudio use the kernel default (muted & 0%)!
-            '    alsa-utils'
-            '    ir-keytable'   # infrared TV remote control
-            '    xfce4-xkb-plugin '  # basic foreign language input (e.g. Russian, but not Japanese)
-            '    xdg-user-dirs-gtk'  # Thunar sidebar gets Documents, Music &c
-            '    gvfs thunar-volman eject'  # Thunar trash://, DVD autoplay, DVD eject
-            '    xfce4-notifyd '     # xfce4-panel notification popups
-            # FIXME: use plocate (not mlocate) once PrisonPC master server upgrades!
-            '    catfish mlocate xfce4-places-plugin'  # "Find Files" tool
-            '    eog '  # chromium can't flip between 1000 photos quickly
-            '    usermode'                             # password reset tool
-            '    librsvg2-common'    # SVG icons in GTK3 apps
-            '    gnome-themes-extra adwaita-qt'  # theming
-            '    at-spi2-core gnome-accessibility-themes'
-            '    plymouth-themes',
-            # Workaround https://bugs.debian.org/1004001 (FIXME: fix upstream)
-            '--essential-hook=chronic chroot $1 apt install -y fontconfig-config',
-            # FIXME: in Debian 12, change --include=pulseaudio to --include=pipewire,pipewire-pulse
-            # https://wiki.debian.org/PipeWire#Using_as_a_substitute_for_PulseAudio.2FJACK.2FALSA
-            # linux-image-cloud-amd64 is CONFIG_DRM=n so Xorg sees no /dev/dri/card0.
-            # It seems there is a fallback for -vga qxl, but not -vga virtio.
-            '--include=xserver-xorg-video-qxl'
-            if args.virtual_only else
-            # Accelerated graphics drivers for several libraries & GPU families
-            '--include=vdpau-driver-all'  # VA/AMD, free
-            '    mesa-vulkan-drivers'     # Intel/AMD/Nvidia, free
-            '    va-driver-all'           # Intel/AMD/Nvidia, free
-            '    i965-va-driver-shaders'  # Intel, non-free, 2013-2017
-            '    intel-media-va-driver-non-free',  # Intel, non-free, 2017+
-            # For https://github.com/cyberitsolutions/bootstrap2020/blob/main/debian-11-desktop/xfce-spice-output-resizer.py
-            *(['--include=python3-xlib python3-dbus spice-vdagent']
-              if not args.physical_only else []),
-            # Seen on H81 and H110 Pioneer AIOs.
-            # Not NEEDED, just makes journalctl -p4' quieter.
-            f'--essential-hook=tar-in {create_tarball("debian-11-desktop")} /'
-            ]
-           if template_wants_GUI else []),
-         # Mike wants this for prisonpc-desktop-staff-amc in spice-html5.
-         # FIXME: WHY?  Nothing in the package description sounds useful.
-         # FIXME: --boot-test's kvm doesn't know to create the device!!!
-         *(['--include=qemu-guest-agent']
-           if not args.physical_only else []),
-         *([f'--include={args.ssh_server}',
-            f'--essential-hook=tar-in {authorized_keys_tar_path} /',
-            # Work around https://bugs.debian.org/594175 (dropbear & openssh-server)
-            '--customize-hook=rm -f $1/etc/dropbear/dropbear_*_host_key',
-            '--customize-hook=rm -f $1/etc/ssh/ssh_host_*_key*',
-            ]
-           if args.optimize != 'simplicity' else []),
-         '--customize-hook=chronic chroot $1 systemctl preset-all',  # enable ALL units!
-         '--customize-hook=chronic chroot $1 systemctl preset-all --user --global',
-         *(['--customize-hook=chroot $1 adduser x --gecos x --disabled-password --quiet',
-            '--customize-hook=echo x:x | chroot $1 chpasswd',
-            '--customize-hook=echo root: | chroot $1 chpasswd --crypt-method=NONE',
-            '--include=strace',
-            '--customize-hook=rm -f $1/etc/sysctl.d/bootstrap2020-hardening.conf',
-            *(['--include=xfce4-terminal']
-              if template_wants_GUI else [])]
-           if args.backdoor_enable else []),
-         *([f'--customize-hook=echo bootstrap:{git_description} >$1/etc/debian_chroot',
-            '--customize-hook=chroot $1 bash -i; false',
-            '--customize-hook=rm -f $1/etc/debian_chroot']
-           if args.debug_shell else []),
-         *(['--customize-hook=upload doc/debian-11-app-reviews.csv /tmp/app-reviews.csv',
-            '--customize-hook=chroot $1 python3 < debian-11-install-footprint.py',
-            '--customize-hook=download /var/log/install-footprint.csv'
-            f'    doc/debian-11-install-footprint.{args.template}.csv']
-           if args.measure_install_footprints else []),
-         # Make a simple copy for https://kb.cyber.com.au/32894-debsecan-SOEs.sh
-         # FIXME: remove once that can/does use rdsquashfs --cat (master server is Debian 11)
-         *([f'--customize-hook=download /var/lib/dpkg/status {destdir}/dpkg.status']
-           if args.optimize != 'simplicity' else []),
-         *([f'--customize-hook=download vmlinuz {destdir}/vmlinuz',
-            f'--customize-hook=download initrd.img {destdir}/initrd.img']
-           if not args.rpi else [f'--customize-hook=sync-out /boot/firmware/ {destdir}/']),
-         *(['--customize-hook=rm $1/boot/vmlinuz* $1/boot/initrd.img*']  # save 27s 27MB
-           if args.optimize != 'simplicity' else []),
-         *(['--verbose', '--logfile', destdir / 'mmdebstrap.log']
-           if args.reproducible else []),
-         *(['--include=wpasupplicant firmware-realtek firmware-iwlwifi']
-           if template_wants_WiFi else []),
-         *(['--include=python3-cec',  # Needed to control the HDMI devices
-            '--include=python3-pip',  # Needed because python3-androidtvremote2 & python3-snapcast are not packaged for Debian
-            '--include=python3-aiofiles python3-cryptography python3-protobuf',  # Dependencies of python3-androidtvremote2
-            # NOTE: We could use pip from the host system with `--root=$1` but that adds more dependencies in the host,
-            #       and likely to cause version mismatch between the OS and the Python library
-            '--customize-hook=chroot $1 python3 -m pip install --break-system-packages --no-deps androidtvremote2',  # FIXME: Use a venv?
-            '--include=python3-construct python3-packaging',  # Dependencies of python3-snapcast
-            '--customize-hook=chroot $1 python3 -m pip install --break-system-packages --no-deps snapcast',  # FIXME: Use a venv?
-
-            '--include=ir-keytable',  # infrared remote control
-            '--include=cec-utils',  # Useful for investigating the CEC protocol, not actually sued
-            '--include=v4l-utils',  # Needed for the ir-keytable RC passthrough
-
-            '--include=python3-evdev python3-pyudev',  # needed for the Python global keybindings handler
-            '--include=python3-systemd',  # Let logging.py use the Journal
-
-            '--include=snapclient',
-
-            '--include=rsync',  # Great for dev & updates
-
-            # Append to the default /etc/rc_maps.cfg
-            # FIXME: Use pathlib or os.path.join.
-            f'--customize-hook=cat "{args.template}/infrared-tv-remote-control/rc_maps.cfg" >>"$1/etc/rc_maps.cfg"',
-            f'--essential-hook=tar-in {create_tarball(args.template)} /',
-            ]
-           if args.template == 'cec-androidtv-fixes' else []),
-         *(['--include=phoc xwayland',  # Let's try Wayland instead of X11  NOTE: jellyfin-media-player has issues with sway, mako-notifier can't work with weston
-
-            # copied from wants_GUI section above because while this does want a GUI, it's not an X11 GUI so we can't use that entire section
-            '--include=vdpau-driver-all'  # VA/AMD, free
-            '    mesa-vulkan-drivers'     # Intel/AMD/Nvidia, free
-            '    va-driver-all'           # Intel/AMD/Nvidia, free
-            '    i965-va-driver-shaders'  # Intel, non-free, 2013-2017
-            '    intel-media-va-driver-non-free',  # Intel, non-free, 2017+
-            '--include=ir-keytable',   # infrared TV remote control
-            '--include=v4l-utils',   # ir-ctl for *sending* IR signals
-            '--include=plymouth-themes',  # For custom bootup logo
-            # Workaround https://bugs.debian.org/1004001 (FIXME: fix upstream)
-            '--essential-hook=chroot $1 apt install -y fontconfig-config',
-
-            # Having hardware support issues, let's just throw some firmware in and see if it helps
-            '--include=firmware-linux-free firmware-linux firmware-linux-nonfree',  # Lots of generic firmware stuff, normally helps
-            '--include=firmware-amd-graphics firmware-intel-sound',  # I don't think I'm using any of this hardware, but shouldn't hurt
-            # NOTE: firmware-ivtv has an EULA that needs to be agreed to, rather than fixing that I'm just leaving it out
-            '--include=firmware-samsung',  # I don't understand how codec firmwares work, but given this is a media machine I might as well include them
-            # I continued getting errors about failing to load iwlwifi firmware, but it worked.
-            # it did *not* work without the firmware-iwlwifi package though,
-            # so I suspect it fellback on a firmware for an older chipset from the same package
-            # '--include= atmel-firmware firmware-atheros firmware-libertas firmware-ti-connectivity',  # FIXME: Worth including these as well?
-            '--include=firmware-sof-signed',  # Needed this for audio on my Lenovo ThinkPad Yoga when testing for WiFi dev
-
-            '--include=jellyfin-media-player',  # The whole point of this thing
-            '--include=python3-plyvel python3-dnspython',  # Needed for set-jellyfin-server.py
-            '--include=qtwayland5',  # Wayland support for jellyfin-media-player
-
-            '--include=pulseaudio',  # Pulseaudio's role-corking makes pausing the music when movie starts a lot easier, pipewire does not seem to have this feature
-            # FIXME: Just change the PA config to what I actually want rather than using pacmd in override.conf
-            '--customize-hook=sed -i "/module-role-cork/ s/^load/#load/" $1/etc/pulse/default.pa',  # Disable role corking because the default config sucks, we enable it later in a systemd override.conf
-
-            '--include=snapclient',  # Using this as the whole house audio solution
-            '--include=avahi-daemon',  # Dependency of snapclient missing in control file
-
-            '--include=python3-systemd',  # Used in some of my .py systemd units
-
-            '--include=ydotool',  # Wayland xdotool, needed only to hide the mouse in the bottom-right  FIXME: jellyfin-media-player or phoc should handle this
-
-            '--include=swaybg',  # For setting Phoc's background image.   NOTE Has nothing to do with sway
-
-            # keybinds.py
-            # A daemon that handles system keybindings such as volume +/-
-            '--include=python3-evdev',  # The library I use to get the keypresses
-            '--include=python3-pyudev',  # Used to identify new devices when they come in
-
-            '--include=python3-paho-mqtt',  # Used by tasmota_controller.py
-
-            '--include=python3-psutil',  # Used by snapcontroller.py to get the local mac address
-            '--include=python3-gi gir1.2-notify-0.7 gir1.2-gtk-3.0',  # Libraries for notifyd & gtk icons
-            '--include=mako-notifier',  # Notification daemon that supports Wayland
-
-            '--include=sound-theme-freedesktop',  # Generic sound effects, used to notify when turning speakers/TV on/off
-
-            '--include=grim',  # Wayland screenshot utility, not really using it yet but would like to
-
-            '--include=python3-github',  # Github API library for the auto updater script
-
-            '--include=lvm2',  # So that Ron can recover some data from repuprosed system if necessary
-
-            # Steam Link
-            # Don't actually install the Steam Link app here as it doubles the size of the SOE,
-            # just install the necessary packages for the flatpaks to be installed on the boot media.
-            '--include=flatpak',  # The offical Steam Link app is a flatpak, so just use that because CBFed doing it myself
-            '--include=steam-devices',  # Some udev rules to theoretically help with Steam Controller support
-
-            '--include=rsync',  # I like to manually update the SOE directly sometimes
-
-            # Create the actual user that the GUI runs as
-            '--customize-hook=chroot $1 adduser jellyfinuser --gecos "Jellyfin Client User" --disabled-password --quiet',
-            '--customize-hook=chroot $1 adduser jellyfinuser input --quiet',  # For access to evdev devices for keybinds.py
-            '--customize-hook=chroot $1 adduser jellyfinuser video --quiet',  # For access to /dev/lirc0 device to send IR signals
-
-            '--customize-hook=systemctl disable --quiet --system --root $1 snapclient.service',  # We run snapclient as a user unit, not a system unit
-
-            # Ugly hacks to try and make Plymouth more seamless
-            '--customize-hook=rm $1/lib/systemd/system/multi-user.target.wants/plymouth-quit.service',  # disable doesn't actually work because Debian created the symlink explicitly without putting "WantedBy" in the .service file
-            '--customize-hook=systemctl mask --quiet --system --root $1 plymouth-quit-wait.service',  # This is a service that waits for plymouth to stop before allowing graphical.target to start, that gets stupidly in the way for us.
-            '--customize-hook=systemctl enable --quiet --system --root $1 plymouth-quit.service',  # Instead of disabling plymouth, just have the stop unit start *after* phoc
-
-            f'--customize-hook=sed -i "s|{pathlib.Path.cwd()}/jellyfin-media-player|/etc/apt/trusted.gpg.d|" "$1/etc/apt/sources.list.d/0001main.list"',  # Fix apt sources.list for the correct public key location
-
-            f'--essential-hook=tar-in {create_tarball(args.template)} /']
-           if args.template == 'jellyfin-media-player' else []),
-         *(['--include=openjdk-17-jre-headless rsync',
-
-            '--include=zfs-dkms zfsutils-linux zfs-zed',  # ZFS support
-            '--include=linux-headers-cloud-amd64'
-            if args.virtual_only else
-            '--include=linux-headers-amd64',
-            '--customize-hook=systemctl --root $1 add-wants zfs-import.target zfs-import-scan.service',  # scan & import zfs pools on boot
-
-            # FIXME: Use a systemd ephemeral user thing
-            # NOTE: I've set the user ID because I need it to match the ownership/permissions of the data partition
-            '--customize-hook=chroot $1 adduser minecraft --home /srv/mcdata --no-create-home --system --group --uid 420',
-            '--hook-dir=minecraft-server.hooks',
-            f'--essential-hook=tar-in {create_tarball(args.template)} /']
-           if args.template == 'minecraft-server' else []),
-         f'--customize-hook=echo "BOOTSTRAP2020_TEMPLATE={args.template}" >>$1/etc/os-release',
-         *([f'--architecture={args.rpi}',
-            '--include=raspi-firmware',
-            *(['--include=firmware-atheros firmware-brcm80211 firmware-libertas firmware-misc-nonfree firmware-realtek',
-               '--include=wireless-regdb',  # No idea why this one is necessary, but I had a bunch of erros in the log without it
-               ] if template_wants_WiFi else []),
-            # '--include=python3-rpi.gpio',
-            # I want this to run **before** installing raspi-firmware, or at least before a final `update-initramfs`
-            # is customize-hook good enough anyway?
-            ('--essential-hook=printf >$1/etc/default/raspi-firmware-custom "%s\n"'  # This eventually makes it to /boot/firmware/config.txt
-             # # https://www.raspberrypi.com/documentation/computers/config_txt.html#hdmi_enable_4kp60-raspberry-pi-4-only
-             # # UNTESTED, seems like a good idea if used for media playback purposes, but I don't have an rPi4
-             # ' "hdmi_enable_4kp60=1"'
-             # # https://www.raspberrypi.com/documentation/computers/config_txt.html#disable_fw_kms_setup
-             # # FIXME: Why is "let the kernel handle it" not the default? O.o
-             # ' "disable_fw_kms_setup=1"'
-             # https://www.raspberrypi.com/documentation/computers/config_txt.html#disable_overscan
-             # Overscan is just annoying, ideally disable it everywhere, but some specific TVs will require it
-             ' "disable_overscan=1"'
-            ),
-            # We're using live-boot directly from the fat32 boot/firmware filesystem,
-            # stop using partition 2 as "root".
-            '--essential-hook=echo >>$1/etc/default/raspi-firmware "ROOTPART=/dev/mmcblk0p1"',
-            # https://wiki.debian.org/RaspberryPi4#Root_file_system_on_a_USB_disk
-            # Probably not useful to me, but shouldn't hurt, and might avoid some confusion later down the track
-            # FIXME: Include `raspberrypi_cpufreq` & `raspberrypi_hwmon`?
-            '--essential-hook=printf >$1/etc/initramfs-tools/modules "%s\n" "reset_raspberrypi"',
-            # FIXME: net.ifnames=0 is currently needed for WiFi persistent config... do better.
-            '--essential-hook=echo >$1/etc/default/raspi-extra-cmdline "net.ifnames=0 boot=live live-media-path="',
-            # FIXME: Somehow implement a/b partitions for some form of auto-updates later?
-            #        https://www.raspberrypi.com/documentation/computers/config_txt.html#autoboot-txt
-            #        Likely requires using u-boot or similar.
-           ] if args.rpi else []),
-         'bookworm',
-         destdir / 'filesystem.squashfs',
-         'debian-12.sources',
-         # https://github.com/rsnapshot/rsnapshot/issues/279
-         # https://tracker.debian.org/news/1238555/rsnapshot-removed-from-testing/
-         *([f'deb [signed-by={pathlib.Path.cwd()}/jellyfin-media-player/mijofa-archive-pubkey.asc] https://github.com/mijofa/mijofa.github.io/releases/download/apt-bookworm-amd64 ./']
-           if args.template == 'jellyfin-media-player' else []),
-         ])
+    def wait_for_tarballs() -> None:
+        for future in overlay_futures.values():
+            future.result()     # re-raise any exception
+        overlay_pool.shutdown()
+
+    mmdebstrap = ['env', f'TMPDIR={mmdebstrap_tmpdir}',
+                  'nice', 'ionice', '-c3', 'chrt', '--idle', '0', 'mmdebstrap']
+
+    # Everything every template needs.
+    base_mmdebstrap_args = [
+        '--dpkgopt=force-confold',  # https://bugs.debian.org/981004
+        '--aptopt=APT::AutoRemove::SuggestsImportant "false"',  # fix autoremove
+        '--include=linux-image-rpi' if args.rpi == 'armel' else
+        '--include=linux-image-rt-armmp' if args.rpi == 'armhf' else
+        '--include=linux-image-rt-arm64' if args.rpi == 'arm64' else
+        '--include=linux-image-cloud-amd64'
+        if args.virtual_only else
+        # NOTE: can't --include= this because there are too many dpkg trigger problems.
+        '--include=linux-image-amd64',
+        '--include=live-boot',
+        *([f'--aptopt=Acquire::http::Proxy "{apt_proxy}"',  # save 12s
+           '--aptopt=Acquire::https::Proxy "DIRECT"']
+          if args.optimize != 'simplicity' else []),
+        *(['--variant=apt',           # save 12s 30MB
+           '--include=netbase',       # https://bugs.debian.org/995343 et al
+           '--include=init']          # https://bugs.debian.org/993289
+          if args.optimize != 'simplicity' else []),
+        '--include=systemd-timesyncd',  # https://bugs.debian.org/986651
+        *(['--dpkgopt=force-unsafe-io']  # save 20s (even on tmpfs!)
+          if args.optimize != 'simplicity' else []),
+        # Reduce peak /tmp usage by about 500MB
+        *(['--essential-hook=chroot $1 apt clean',
+           '--customize-hook=chroot $1 apt clean']
+          if args.optimize != 'simplicity' else []),
+        *(['--dpkgopt=path-exclude=/usr/share/doc/*']  # 9% to 12% smaller and
+          if args.optimize == 'size' else []),
+        *(['--dpkgopt=path-exclude=/usr/share/man/*']  # 8% faster to 7% SLOWER. Breaks JRE install
+          if args.optimize == 'size' and args.template != 'minecraft-server' else []),
+        *([]
+          if args.optimize == 'simplicity' else
+          ['--include=pigz']       # save 8s
+          if args.optimize == 'speed' else
+          ['--include=xz-utils',   # save 10MB lose 28s
+           '--essential-hook=mkdir -p $1/etc/initramfs-tools/conf.d',
+           '--essential-hook=>$1/etc/initramfs-tools/conf.d/xz echo COMPRESS=xz']),
+        *(['--include=dbus',       # https://bugs.debian.org/814758
+           '--customize-hook=ln -nsf /etc/machine-id $1/var/lib/dbus/machine-id']  # https://bugs.debian.org/994096
+          if args.optimize != 'simplicity' else []),
+        *(['--include=libnss-myhostname libnss-resolve',
+           '--include=policykit-1',  # https://github.com/openbmc/openbmc/issues/3543
+           '--customize-hook=rm $1/etc/hostname',
+           '--customize-hook=ln -nsf /lib/systemd/resolv.conf $1/etc/resolv.conf',
+           '--include=rsyslog-relp msmtp-mta',
+           '--include=python3-dbus',  # for get-config-from-dnssd
+           '--include=debian-security-support',  # for customize90-check-support-status.py
+           f'--essential-hook=tar-in {create_tarball("debian-11-main")} /',
+           '--hook-dir=debian-11-main.hooks',
+           ]
+          if args.optimize != 'simplicity' else []),
+        *(['--include=tzdata',
+           '--essential-hook={'
+           f'    echo tzdata tzdata/Areas                select {args.TZ.area};'
+           f'    echo tzdata tzdata/Zones/{args.TZ.area} select {args.TZ.zone};'
+           '     } | chroot $1 debconf-set-selections']
+          if args.optimize != 'simplicity' else []),
+        *(['--include=locales',
+           '--essential-hook={'
+           f'    echo locales locales/default_environment_locale select {args.LANG.full};'
+           f'    echo locales locales/locales_to_be_generated multiselect {args.LANG.full} {args.LANG.encoding};'
+           '     } | chroot $1 debconf-set-selections']
+          if args.optimize != 'simplicity' else []),
+        # x86_64 CPUs are undocumented proprietary RISC chips that EMULATE a documented x86_64 CISC ISA.
+        # The emulator is called "microcode", and is full of security vulnerabilities.
+        # Make sure security patches for microcode for *ALL* CPUs are included.
+        # By default, it tries to auto-detect the running CPU, so only patches the CPU of the build server.
+        *([*(['--include=intel-microcode amd64-microcode'] if not args.rpi else []),
+           '--essential-hook=>$1/etc/default/intel-microcode echo IUCODE_TOOL_INITRAMFS=yes IUCODE_TOOL_SCANCPUS=no',
+           '--essential-hook=>$1/etc/default/amd64-microcode echo AMD64UCODE_INITRAMFS=yes',
+           '--components=main contrib non-free']
+          if args.optimize != 'simplicity' and not args.virtual_only else []),
+        *(['--include=ca-certificates publicsuffix']
+          if args.optimize != 'simplicity' else []),
+        *(['--include=nfs-client',  # support NFSv4 (not just NFSv3)
+           '--include=cifs-utils',  # support SMB3
+           f'--essential-hook=tar-in {create_tarball("debian-11-main.netboot")} /']
+          if not args.local_boot_only else []),
+        *([f'--essential-hook=tar-in {create_tarball("debian-11-main.netboot-only")} /']  # 9% faster 19% smaller
+          if args.netboot_only else []),
+    ]
+
+    # Keep the install footprints in --cache-dir, so the next --measure-install-footprints only recomputes what changed.
+    footprint_cache_path = args.cache_dir / 'install-footprint' / f'{args.template}.json'
+    if args.measure_install_footprints and not footprint_cache_path.exists():
+        footprint_cache_path.parent.mkdir(parents=True, exist_ok=True)
+        footprint_cache_path.write_text('{}')  # "upload" needs SOMETHING to upload
+
+    # Everything specific to this template (or this run).
+    template_mmdebstrap_args = [
+        *(['--include=nwipe']
+          if args.template == 'dban' else []),
+        *(['--include=zfs-dkms zfsutils-linux zfs-zed',
+           '--include=mmdebstrap auto-apt-proxy',  # for installing
+           '--include=linux-headers-cloud-amd64'
+           if args.virtual_only else
+           '--include=linux-headers-amd64']
+          if args.template == 'zfs' else []),
+        *(['--include=smartmontools'
+           '    bsd-mailx'    # smartd calls mail(1), not sendmail(8)
+           '    curl ca-certificates gnupg',  # update-smart-drivedb
+           f'--essential-hook=tar-in {create_tarball("debian-11-main.disks")} /',
+           '--customize-hook=chroot $1 update-smart-drivedb'
+           ]
+          if template_wants_disks and not args.virtual_only else []),
+        *(['--include='
+           '    xserver-xorg-core xserver-xorg-input-libinput'
+           '    xfce4-session xfwm4 xfdesktop4 xfce4-panel thunar galculator'
+           '    xdm'
+           '    pulseaudio xfce4-pulseaudio-plugin pavucontrol'
+           # Without "alsactl init" & /usr/share/alsa/init/default,
+           # pipewire/pulseaudio use the kernel default (muted & 0%)!
+           '    alsa-utils'
+           '    ir-keytable'   # infrared TV remote control
+           '    xfce4-xkb-plugin '  # basic foreign language input (e.g. Russian, but not Japanese)
+           '    xdg-user-dirs-gtk'  # Thunar sidebar gets Documents, Music &c
+           '    gvfs thunar-volman eject'  # Thunar trash://, DVD autoplay, DVD eject
+           '    xfce4-notifyd '     # xfce4-panel notification popups
+           # FIXME: use plocate (not mlocate) once PrisonPC master server upgrades!
+           '    catfish mlocate xfce4-places-plugin'  # "Find Files" tool
+           '    eog '  # chromium can't flip between 1000 photos quickly
+           '    usermode'                             # password reset tool
+           '    librsvg2-common'    # SVG icons in GTK3 apps
+           '    gnome-themes-extra adwaita-qt'  # theming
+           '    at-spi2-core gnome-accessibility-themes'
+           '    plymouth-themes',
+           # Workaround https://bugs.debian.org/1004001 (FIXME: fix upstream)
+           '--essential-hook=chronic chroot $1 apt install -y fontconfig-config',
+           # FIXME: in Debian 12, change --include=pulseaudio to --include=pipewire,pipewire-pulse
+           # https://wiki.debian.org/PipeWire#Using_as_a_substitute_for_PulseAudio.2FJACK.2FALSA
+           # linux-image-cloud-amd64 is CONFIG_DRM=n so Xorg sees no /dev/dri/card0.
+           # It seems there is a fallback for -vga qxl, but not -vga virtio.
+           '--include=xserver-xorg-video-qxl'
+           if args.virtual_only else
+           # Accelerated graphics drivers for several libraries & GPU families
+           '--include=vdpau-driver-all'  # VA/AMD, free
+           '    mesa-vulkan-drivers'     # Intel/AMD/Nvidia, free
+           '    va-driver-all'           # Intel/AMD/Nvidia, free
+           '    i965-va-driver-shaders'  # Intel, non-free, 2013-2017
+           '    intel-media-va-driver-non-free',  # Intel, non-free, 2017+
+           # For https://github.com/cyberitsolutions/bootstrap2020/blob/main/debian-11-desktop/xfce-spice-output-resizer.py
+           *(['--include=python3-xlib python3-dbus spice-vdagent']
+             if not args.physical_only else []),
+           # Seen on H81 and H110 Pioneer AIOs.
+           # Not NEEDED, just makes journalctl -p4' quieter.
+           f'--essential-hook=tar-in {create_tarball("debian-11-desktop")} /'
+           ]
+          if template_wants_GUI else []),
+        # Mike wants this for prisonpc-desktop-staff-amc in spice-html5.
+        # FIXME: WHY?  Nothing in the package description sounds useful.
+        # FIXME: --boot-test's kvm doesn't know to create the device!!!
+        *(['--include=qemu-guest-agent']
+          if not args.physical_only else []),
+        *([f'--include={args.ssh_server}',
+           f'--essential-hook=tar-in {authorized_keys_tar_path} /',
+           # Work around https://bugs.debian.org/594175 (dropbear & openssh-server)
+           '--customize-hook=rm -f $1/etc/dropbear/dropbear_*_host_key',
+           '--customize-hook=rm -f $1/etc/ssh/ssh_host_*_key*',
+           ]
+          if args.optimize != 'simplicity' else []),
+        '--customize-hook=chronic chroot $1 systemctl preset-all',  # enable ALL units!
+        '--customize-hook=chronic chroot $1 systemctl preset-all --user --global',
+        *(['--customize-hook=chroot $1 adduser x --gecos x --disabled-password --quiet',
+           '--customize-hook=echo x:x | chroot $1 chpasswd',
+           '--customize-hook=echo root: | chroot $1 chpasswd --crypt-method=NONE',
+           '--include=strace',
+           '--customize-hook=rm -f $1/etc/sysctl.d/bootstrap2020-hardening.conf',
+           *(['--include=xfce4-terminal']
+             if template_wants_GUI else [])]
+          if args.backdoor_enable else []),
+        *(['--include=fatrace',
+           f'--essential-hook=tar-in {create_tarball("debian-11-main.boot-trace")} /']
+          if args.record_boot_trace else []),
+        *([f'--customize-hook=echo bootstrap:{git_description} >$1/etc/debian_chroot',
+           '--customize-hook=chroot $1 bash -i; false',
+           '--customize-hook=rm -f $1/etc/debian_chroot']
+          if args.debug_shell else []),
+        *(['--customize-hook=upload doc/debian-11-app-reviews.csv /tmp/app-reviews.csv',
+           f'--customize-hook=upload {footprint_cache_path} /tmp/install-footprint-cache.json',
+           '--customize-hook=chroot $1 python3 < debian-11-install-footprint.py',
+           f'--customize-hook=download /tmp/install-footprint-cache.json {footprint_cache_path}',
+           '--customize-hook=download /var/log/install-footprint.csv'
+           f'    doc/debian-11-install-footprint.{args.template}.csv',
+           '--customize-hook=download /var/log/install-footprint-bundle.csv'
+           f'    doc/debian-11-install-footprint.{args.template}.bundle.csv']
+          if args.measure_install_footprints else []),
+        # Make a simple copy for https://kb.cyber.com.au/32894-debsecan-SOEs.sh
+        # FIXME: remove once that can/does use rdsquashfs --cat (master server is Debian 11)
+        *([f'--customize-hook=download /var/lib/dpkg/status {destdir}/dpkg.status']
+          if args.optimize != 'simplicity' else []),
+        *([f'--customize-hook=download vmlinuz {destdir}/vmlinuz',
+           f'--customize-hook=download initrd.img {destdir}/initrd.img']
+          if not args.rpi else [f'--customize-hook=sync-out /boot/firmware/ {destdir}/']),
+        *(['--customize-hook=rm $1/boot/vmlinuz* $1/boot/initrd.img*']  # save 27s 27MB
+          if args.optimize != 'simplicity' else []),
+        *(['--verbose', '--logfile', destdir / 'mmdebstrap.log']
+          if args.reproducible else []),
+        *(['--include=wpasupplicant firmware-realtek firmware-iwlwifi']
+          if template_wants_WiFi else []),
+        *(['--include=python3-cec',  # Needed to control the HDMI devices
+           '--include=python3-pip',  # Needed because python3-androidtvremote2 & python3-snapcast are not packaged for Debian
+           '--include=python3-aiofiles python3-cryptography python3-protobuf',  # Dependencies of python3-androidtvremote2
+           # NOTE: We could use pip from the host system with `--root=$1` but that adds more dependencies in the host,
+           #       and likely to cause version mismatch between the OS and the Python library
+           '--customize-hook=chroot $1 python3 -m pip install --break-system-packages --no-deps androidtvremote2',  # FIXME: Use a venv?
+           '--include=python3-construct python3-packaging',  # Dependencies of python3-snapcast
+           '--customize-hook=chroot $1 python3 -m pip install --break-system-packages --no-deps snapcast',  # FIXME: Use a venv?
+
+           '--include=ir-keytable',  # infrared remote control
+           '--include=cec-utils',  # Useful for investigating the CEC protocol, not actually sued
+           '--include=v4l-utils',  # Needed for the ir-keytable RC passthrough
+
+           '--include=python3-evdev python3-pyudev',  # needed for the Python global keybindings handler
+           '--include=python3-systemd',  # Let logging.py use the Journal
+
+           '--include=snapclient',
+
+           '--include=rsync',  # Great for dev & updates
+
+           # Append to the default /etc/rc_maps.cfg
+           # FIXME: Use pathlib or os.path.join.
+           f'--customize-hook=cat "{args.template}/infrared-tv-remote-control/rc_maps.cfg" >>"$1/etc/rc_maps.cfg"',
+           f'--essential-hook=tar-in {create_tarball(args.template)} /',
+           ]
+          if args.template == 'cec-androidtv-fixes' else []),
+        *(['--include=phoc xwayland',  # Let's try Wayland instead of X11  NOTE: jellyfin-media-player has issues with sway, mako-notifier can't work with weston
+
+           # copied from wants_GUI section above because while this does want a GUI, it's not an X11 GUI so we can't use that entire section
+           '--include=vdpau-driver-all'  # VA/AMD, free
+           '    mesa-vulkan-drivers'     # Intel/AMD/Nvidia, free
+           '    va-driver-all'           # Intel/AMD/Nvidia, free
+           '    i965-va-driver-shaders'  # Intel, non-free, 2013-2017
+           '    intel-media-va-driver-non-free',  # Intel, non-free, 2017+
+           '--include=ir-keytable',   # infrared TV remote control
+           '--include=v4l-utils',   # ir-ctl for *sending* IR signals
+           '--include=plymouth-themes',  # For custom bootup logo
+           # Workaround https://bugs.debian.org/1004001 (FIXME: fix upstream)
+           '--essential-hook=chroot $1 apt install -y fontconfig-config',
+
+           # Having hardware support issues, let's just throw some firmware in and see if it helps
+           '--include=firmware-linux-free firmware-linux firmware-linux-nonfree',  # Lots of generic firmware stuff, normally helps
+           '--include=firmware-amd-graphics firmware-intel-sound',  # I don't think I'm using any of this hardware, but shouldn't hurt
+           # NOTE: firmware-ivtv has an EULA that needs to be agreed to, rather than fixing that I'm just leaving it out
+           '--include=firmware-samsung',  # I don't understand how codec firmwares work, but given this is a media machine I might as well include them
+           # I continued getting errors about failing to load iwlwifi firmware, but it worked.
+           # it did *not* work without the firmware-iwlwifi package though,
+           # so I suspect it fellback on a firmware for an older chipset from the same package
+           # '--include= atmel-firmware firmware-atheros firmware-libertas firmware-ti-connectivity',  # FIXME: Worth including these as well?
+           '--include=firmware-sof-signed',  # Needed this for audio on my Lenovo ThinkPad Yoga when testing for WiFi dev
+
+           '--include=jellyfin-media-player',  # The whole point of this thing
+           '--include=python3-plyvel python3-dnspython',  # Needed for set-jellyfin-server.py & srvdiscovery.py
+           '--include=qtwayland5',  # Wayland support for jellyfin-media-player
+
+           '--include=pulseaudio',  # Pulseaudio's role-corking makes pausing the music when movie starts a lot easier, pipewire does not seem to have this feature
+           # FIXME: Just change the PA config to what I actually want rather than using pacmd in override.conf
+           '--customize-hook=sed -i "/module-role-cork/ s/^load/#load/" $1/etc/pulse/default.pa',  # Disable role corking because the default config sucks, we enable it later in a systemd override.conf
+
+           '--include=snapclient',  # Using this as the whole house audio solution
+           '--include=avahi-daemon',  # Dependency of snapclient missing in control file
+
+           '--include=python3-systemd',  # Used in some of my .py systemd units
+
+           '--include=ydotool',  # Wayland xdotool, needed only to hide the mouse in the bottom-right  FIXME: jellyfin-media-player or phoc should handle this
+
+           '--include=swaybg',  # For setting Phoc's background image.   NOTE Has nothing to do with sway
+
+           # keybinds.py
+           # A daemon that handles system keybindings such as volume +/-
+           '--include=python3-evdev',  # The library I use to get the keypresses
+           '--include=python3-pyudev',  # Used to identify new devices when they come in
+
+           '--include=python3-paho-mqtt',  # Used by tasmota_controller.py
+
+           '--include=python3-psutil',  # Used by snapcontroller.py to get the local mac address
+           '--include=python3-gi gir1.2-notify-0.7 gir1.2-gtk-3.0',  # Libraries for notifyd & gtk icons
+           '--include=mako-notifier',  # Notification daemon that supports Wayland
+
+           '--include=sound-theme-freedesktop',  # Generic sound effects, used to notify when turning speakers/TV on/off
+
+           '--include=grim',  # Wayland screenshot utility, not really using it yet but would like to
+
+           '--include=python3-github',  # Github API library for the auto updater script
+
+           '--include=lvm2',  # So that Ron can recover some data from repuprosed system if necessary
+
+           # Steam Link
+           # Don't actually install the Steam Link app here as it doubles the size of the SOE,
+           # just install the necessary packages for the flatpaks to be installed on the boot media.
+           '--include=flatpak',  # The offical Steam Link app is a flatpak, so just use that because CBFed doing it myself
+           '--include=steam-devices',  # Some udev rules to theoretically help with Steam Controller support
+
+           '--include=rsync',  # I like to manually update the SOE directly sometimes
+
+           # Create the actual user that the GUI runs as
+           '--customize-hook=chroot $1 adduser jellyfinuser --gecos "Jellyfin Client User" --disabled-password --quiet',
+           '--customize-hook=chroot $1 adduser jellyfinuser input --quiet',  # For access to evdev devices for keybinds.py
+           '--customize-hook=chroot $1 adduser jellyfinuser video --quiet',  # For access to /dev/lirc0 device to send IR signals
+
+           '--customize-hook=systemctl disable --quiet --system --root $1 snapclient.service',  # We run snapclient as a user unit, not a system unit
+
+           # Ugly hacks to try and make Plymouth more seamless
+           '--customize-hook=rm $1/lib/systemd/system/multi-user.target.wants/plymouth-quit.service',  # disable doesn't actually work because Debian created the symlink explicitly without putting "WantedBy" in the .service file
+           '--customize-hook=systemctl mask --quiet --system --root $1 plymouth-quit-wait.service',  # This is a service that waits for plymouth to stop before allowing graphical.target to start, that gets stupidly in the way for us.
+           '--customize-hook=systemctl enable --quiet --system --root $1 plymouth-quit.service',  # Instead of disabling plymouth, just have the stop unit start *after* phoc
+
+           f'--customize-hook=sed -i "s|{pathlib.Path.cwd()}/jellyfin-media-player|/etc/apt/trusted.gpg.d|" $1/etc/apt/sources.list.d/*',  # Fix apt sources.list for the correct public key location
+
+           f'--essential-hook=tar-in {create_tarball(args.template)} /']
+          if args.template == 'jellyfin-media-player' else []),
+        *(['--include=openjdk-17-jre-headless rsync',
+
+           '--include=zfs-dkms zfsutils-linux zfs-zed',  # ZFS support
+           '--include=linux-headers-cloud-amd64'
+           if args.virtual_only else
+           '--include=linux-headers-amd64',
+           '--customize-hook=systemctl --root $1 add-wants zfs-import.target zfs-import-scan.service',  # scan & import zfs pools on boot
+
+           # FIXME: Use a systemd ephemeral user thing
+           # NOTE: I've set the user ID because I need it to match the ownership/permissions of the data partition
+           '--customize-hook=chroot $1 adduser minecraft --home /srv/mcdata --no-create-home --system --group --uid 420',
+           '--hook-dir=minecraft-server.hooks',
+           f'--essential-hook=tar-in {create_tarball(args.template)} /']
+          if args.template == 'minecraft-server' else []),
+        f'--customize-hook=echo "BOOTSTRAP2020_TEMPLATE={args.template}" >>$1/etc/os-release',
+        *([f'--architecture={args.rpi}',
+           '--include=raspi-firmware',
+           *(['--include=firmware-atheros firmware-brcm80211 firmware-libertas firmware-misc-nonfree firmware-realtek',
+              '--include=wireless-regdb',  # No idea why this one is necessary, but I had a bunch of erros in the log without it
+              ] if template_wants_WiFi else []),
+           # '--include=python3-rpi.gpio',
+           # I want this to run **before** installing raspi-firmware, or at least before a final `update-initramfs`
+           # is customize-hook good enough anyway?
+           ('--essential-hook=printf >$1/etc/default/raspi-firmware-custom "%s\n"'  # This eventually makes it to /boot/firmware/config.txt
+            # # https://www.raspberrypi.com/documentation/computers/config_txt.html#hdmi_enable_4kp60-raspberry-pi-4-only
+            # # UNTESTED, seems like a good idea if used for media playback purposes, but I don't have an rPi4
+            # ' "hdmi_enable_4kp60=1"'
+            # # https://www.raspberrypi.com/documentation/computers/config_txt.html#disable_fw_kms_setup
+            # # FIXME: Why is "let the kernel handle it" not the default? O.o
+            # ' "disable_fw_kms_setup=1"'
+            # https://www.raspberrypi.com/documentation/computers/config_txt.html#disable_overscan
+            # Overscan is just annoying, ideally disable it everywhere, but some specific TVs will require it
+            ' "disable_overscan=1"'
+           ),
+           # We're using live-boot directly from the fat32 boot/firmware filesystem,
+           # stop using partition 2 as "root".
+           '--essential-hook=echo >>$1/etc/default/raspi-firmware "ROOTPART=/dev/mmcblk0p1"',
+           # https://wiki.debian.org/RaspberryPi4#Root_file_system_on_a_USB_disk
+           # Probably not useful to me, but shouldn't hurt, and might avoid some confusion later down the track
+           # FIXME: Include `raspberrypi_cpufreq` & `raspberrypi_hwmon`?
+           '--essential-hook=printf >$1/etc/initramfs-tools/modules "%s\n" "reset_raspberrypi"',
+           # FIXME: net.ifnames=0 is currently needed for WiFi persistent config... do better.
+           '--essential-hook=echo >$1/etc/default/raspi-extra-cmdline "net.ifnames=0 boot=live live-media-path="',
+           # FIXME: Somehow implement a/b partitions for some form of auto-updates later?
+           #        https://www.raspberrypi.com/documentation/computers/config_txt.html#autoboot-txt
+           #        Likely requires using u-boot or similar.
+          ] if args.rpi else []),
+    ]
+
+    # --deb-pool keeps every .deb any build downloaded in --cache-dir/debs, and
+    # offers them to every later build (of any template) as a local apt repository (listed first).
+    # So e.g. the kernel, firmware & mesa are downloaded once, not once per template.
+    # Builds running at the same time (debian-11-production.py) would each download their own copy, so
+    # it first runs --prefetch-debs for each template (one after another), then starts the builds.
+    # --offline builds from ONLY that repository, for when the mirror or proxy is unreachable.
+    # NOTE: mmdebstrap bind-mounts file:// mirrors into the chroot, so "chroot $1 apt install" also works.
+    # Each build marks the .debs its image installed as used (mtime), and
+    # .debs no build has installed for deb_pool_max_idle_days are removed (superseded versions, dropped packages).
+    deb_pool_max_idle_days = 30
+    deb_pool_dir = args.cache_dir / 'debs'
+    deb_pool_line = f'deb [trusted=yes] file://{deb_pool_dir} ./'
+    deb_pool_usable = args.deb_pool and (deb_pool_dir / 'Packages').exists()
+    if args.offline and not deb_pool_usable:
+        raise FileNotFoundError('--offline needs a --deb-pool from an earlier (online) build', deb_pool_dir)
+    deb_pool_mmdebstrap_args = []
+    if args.deb_pool:
+        deb_pool_dir.mkdir(parents=True, exist_ok=True)
+        (td / 'debs').mkdir()
+        deb_pool_mmdebstrap_args = [
+            # mmdebstrap usually deletes the essential .debs once they are installed.
+            '--skip=essential/unlink',
+            # Collect the .debs BEFORE any "apt clean" hook throws them away.
+            f'--essential-hook=sync-out /var/cache/apt/archives {td}/debs',
+            f'--customize-hook=sync-out /var/cache/apt/archives {td}/debs',
+            # The image should point at the real mirror, not at the build host's pool.
+            *(['--customize-hook=copy-in debian-12.sources /etc/apt/sources.list.d/']
+              if args.offline else []),
+            *([f'--customize-hook=grep -lF "file://{deb_pool_dir}" $1/etc/apt/sources.list.d/* | xargs -r rm']
+              if deb_pool_usable else []),
+        ]
+
+    mirrors = [
+        *([deb_pool_line] if deb_pool_usable else []),
+        *(['debian-12.sources'] if not args.offline else []),
+        # https://github.com/rsnapshot/rsnapshot/issues/279
+        # https://tracker.debian.org/news/1238555/rsnapshot-removed-from-testing/
+        *([f'deb [signed-by={pathlib.Path.cwd()}/jellyfin-media-player/mijofa-archive-pubkey.asc] https://github.com/mijofa/mijofa.github.io/releases/download/apt-bookworm-amd64 ./']
+          if args.template == 'jellyfin-media-player' and not args.offline else []),
+    ]
+
+    # "What is in the archive right now", for cache keys.
+    def get_archive_digest() -> str:
+        if args.offline:
+            return hashlib.sha256((deb_pool_dir / 'Release').read_bytes()).hexdigest()
+        return get_apt_release_digest(pathlib.Path('debian-12.sources'), apt_proxy)
+
+    boot_trace_sort_path = args.cache_dir / 'boot-trace' / f'{args.template}.sort'
+    unchanged_image_path = None
+    if args.skip_if_unchanged and not args.debug_shell:
+        # Everything that decides what ends up in filesystem.squashfs.
+        # Overlay tarballs are content-addressed, so the argv already covers their content.
+        # NOTE: td (and destdir, which has today's date in it) are different every run.
+        fingerprint = hashlib.sha256(json.dumps([
+            [str(arg).replace(str(td), 'TD').replace(str(destdir), 'DESTDIR')
+             for arg in (*base_mmdebstrap_args, *template_mmdebstrap_args, *mirrors)
+             if arg != deb_pool_line],  # the pool only changes where the .debs come from
+            hash_tree(pathlib.Path(name) for name in (
+                'debian-12.sources',
+                *[str(arg).removeprefix('--hook-dir=')
+                  for arg in (*base_mmdebstrap_args, *template_mmdebstrap_args)
+                  if str(arg).startswith('--hook-dir=')],
+                # e.g. jellyfin-media-player/infrared-tv-remote-control/rc_maps.cfg is used directly.
+                *([args.template] if pathlib.Path(args.template).is_dir() else []))),
+            get_archive_digest(),
+            git_description,
+            # How the squashfs is encoded (see below).
+            # Otherwise a new --record-boot-trace sort file or --squashfs-layout is never applied.
+            args.squashfs_layout,
+            (hashlib.sha256(boot_trace_sort_path.read_bytes()).hexdigest()
+             if boot_trace_sort_path.exists() else None),
+            bool(shutil.which('sqfstar')),
+        ]).encode()).hexdigest()
+        fingerprint_record_path = args.cache_dir / 'fingerprints' / f'{args.template}.json'
+        unchanged_image_path = next(
+            (path.parent
+             for path in sorted(args.destdir.glob(f'{args.template}-*/fingerprint.txt'), reverse=True)
+             if all([path.read_text().strip() == fingerprint,
+                     (path.parent / 'filesystem.squashfs').exists()])),
+            None)
+        # Already built (and uploaded), but removed locally afterwards (--remove-afterward)?
+        # Then there is nothing at all to do.
+        fingerprint_record = (
+            json.loads(fingerprint_record_path.read_text())
+            if fingerprint_record_path.exists() else {})
+        if all([not unchanged_image_path,
+                fingerprint_record.get('fingerprint') == fingerprint,
+                set(args.upload_to) <= set(fingerprint_record.get('uploaded-to', [])),
+                not args.boot_test,
+                not args.github_release]):
+            logging.info('Nothing changed since %s, which is already uploaded to %s; nothing to do',
+                         fingerprint_record['image'], ' '.join(fingerprint_record['uploaded-to']))
+            if not any(destdir.iterdir()):
+                destdir.rmdir()
+            sys.exit()
+
+    # If a previous --boot-test --record-boot-trace said which files are read during boot,
+    # put those at the start of filesystem.squashfs, in the order they were read.
+    # Then netboot (over SMB/NFS) reads a few big runs, instead of seeking all over the image.
+    # mmdebstrap's own tar2sqfs can't do this, so have mmdebstrap write a tarball to stdout, and
+    # turn that into a squashfs ourselves.
+    # NOTE: sqfstar is new in squashfs-tools 4.6 (Debian 13).
+    #       Unpacking the tarball for an older mksquashfs -sort would lose owners & device nodes (we aren't root), so
+    #       --record-boot-trace refuses to run without sqfstar, rather than record a trace that is never used.
+    # Ref. doc/30144-readahead-and-mksquashfs-sort.txt
+    #
+    # --squashfs-layout=delta makes an image that rsync --copy-dest can mostly reuse.
+    # mmdebstrap's tarball is already in name order, so files land in the same order every build.
+    # On top of that:
+    #   • small blocks, so one changed file only changes a few small runs of bytes; and
+    #   • no fragments, so small files don't share blocks (every file starts on its own block).
+    # This makes the image a bit bigger (xz has less to work with), but
+    # the upload to each site only sends the packages that actually changed.
+    want_sort = boot_trace_sort_path.exists()
+    want_delta = args.squashfs_layout == 'delta'
+    squashfs_target, squashfs_pipe_to = destdir / 'filesystem.squashfs', None
+    if not unchanged_image_path and not args.prefetch_debs:
+        # On a same-day rebuild, this may be hardlinked as --cache-dir/squashfs-previous/TEMPLATE.squashfs.
+        # Make a new inode, rather than appending to (sqfstar) or truncating (tar2sqfs --force, incl. mmdebstrap's own)
+        # the previous image.
+        (destdir / 'filesystem.squashfs').unlink(missing_ok=True)
+    if (want_sort or want_delta) and shutil.which('sqfstar'):
+        if want_sort:
+            logging.info('Sorting filesystem.squashfs by %s', boot_trace_sort_path)
+        squashfs_target, squashfs_pipe_to = '-', [
+            'sqfstar',
+            '-quiet',
+            '-comp', 'xz',
+            *(['-b', '128K', '-no-fragments']
+              if want_delta else
+              ['-b', '1M']),    # same as mmdebstrap's tar2sqfs
+            *(['-sort', boot_trace_sort_path]
+              if want_sort else []),
+            destdir / 'filesystem.squashfs']
+    elif want_delta:
+        if want_sort:
+            logging.warning('Ignoring %s (no sqfstar)', boot_trace_sort_path)
+        # tar2sqfs has no -no-fragments, but it can at least stop packing tail ends of big files.
+        squashfs_target, squashfs_pipe_to = '-', [
+            'tar2sqfs',
+            '--quiet', '--no-skip', '--force', '--exportable',
+            '--compressor', 'xz',
+            '--block-size', str(128 * 1024),
+            '--no-tail-packing',
+            destdir / 'filesystem.squashfs']
+    elif want_sort:
+        logging.warning('Ignoring %s (no sqfstar)', boot_trace_sort_path)
+
+    with timed('waiting for overlay tarballs'):
+        wait_for_tarballs()
+    # Every tarball this build uses is fresh by now, so these are from e.g. old commits or old keys.
+    for path in remove_unused([*overlays_dir.glob('*.tar'), *authorized_keys_tar_path.parent.glob('*.tar')],
+                              tarball_max_idle_days):
+        logging.info('Removed %s (unused for %d days)', path, tarball_max_idle_days)
+
+    if args.prefetch_debs:
+        # Bootstrap just enough to run apt, then have it download (not install) every --include.
+        # Its dependencies come too, and anything already in the pool is not downloaded again.
+        # The pool's own hooks (above) collect the .debs; the rootfs itself is thrown away (/dev/null).
+        # NOTE: no Recommends, same as mmdebstrap's own --include.
+        with timed('prefetch .debs'):
+            subprocess.check_call([
+                *mmdebstrap,
+                '--variant=apt',
+                *[arg for arg in (*base_mmdebstrap_args, *template_mmdebstrap_args)
+                  if isinstance(arg, str) and arg.startswith(('--aptopt=', '--components=', '--architecture='))],
+                '--customize-hook=chroot $1 apt-get install --download-only --yes --no-install-recommends ' + ' '.join(
+                    word
+                    for arg in (*base_mmdebstrap_args, *template_mmdebstrap_args)
+                    if isinstance(arg, str) and arg.startswith('--include=')
+                    for word in re.split(r'[\s,]+', arg.removeprefix('--include='))
+                    if word),
+                *deb_pool_mmdebstrap_args,
+                'bookworm',
+                '/dev/null',
+                *mirrors])
+    elif unchanged_image_path:
+        logging.info('Nothing changed since %s; reusing it', unchanged_image_path)
+        if unchanged_image_path != destdir:
+            # Hard link (not copy) what mmdebstrap made.
+            # The rest is regenerated below, and must not be linked (write_text() would change BOTH copies).
+            for path in unchanged_image_path.iterdir():
+                if path.is_file() and path.name not in post_build_file_names:
+                    (destdir / path.name).unlink(missing_ok=True)
+                    (destdir / path.name).hardlink_to(path)
+    else:
+        check_call_mmdebstrap_timed(
+            mmdebstrap,
+            [*deb_pool_mmdebstrap_args,
+             *base_mmdebstrap_args,
+             *template_mmdebstrap_args],
+            ['bookworm',
+             squashfs_target,
+             *mirrors],
+            td / 'timings.log',
+            'mmdebstrap: cleanup & squashfs compression',
+            squashfs_pipe_to,
+            mmdebstrap_tmpdir)
+
+    if args.deb_pool:
+        # Several builds can finish at once; only one updates the pool at a time.
+        with timed('deb pool'), (deb_pool_dir / '.lock').open('w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            new_deb_paths = [path for path in (td / 'debs').glob('*.deb')
+                             if not (deb_pool_dir / path.name).exists()]
+            for path in new_deb_paths:
+                # .deb names are name_version_arch, which the archive never reuses for different content.
+                shutil.copy(path, deb_pool_dir / f'.{path.name}.tmp')
+                (deb_pool_dir / f'.{path.name}.tmp').rename(deb_pool_dir / path.name)
+            stale_deb_paths = []
+            # Without a dpkg.status (--optimize=simplicity) we can't tell what was used, so don't prune anything.
+            if (destdir / 'dpkg.status').exists():
+                for fields in parse_dpkg_status(destdir / 'dpkg.status').values():
+                    # apt names them like this, with the epoch's ':' as '%3a'.
+                    version = fields['Version'].replace(':', '%3a')
+                    mark_used(deb_pool_dir / f'{fields["Package"]}_{version}_{fields["Architecture"]}.deb')
+                stale_deb_paths = remove_unused(deb_pool_dir.glob('*.deb'), deb_pool_max_idle_days)
+            if new_deb_paths or stale_deb_paths or not (deb_pool_dir / 'Packages').exists():
+                logging.info('Adding %d .debs to %s, removing %d unused for %d days',
+                             len(new_deb_paths), deb_pool_dir, len(stale_deb_paths), deb_pool_max_idle_days)
+                for name in ('Packages', 'Release'):  # Release has the hash of Packages, so do it second.
+                    (deb_pool_dir / f'.{name}.tmp').write_bytes(subprocess.check_output(
+                        ['apt-ftparchive', '--db=.cache.db', name.lower(), '.'],
+                        cwd=deb_pool_dir))
+                    (deb_pool_dir / f'.{name}.tmp').rename(deb_pool_dir / name)
+
+if args.prefetch_debs:
+    logging.info('Prefetched the .debs %s needs into %s', args.template, deb_pool_dir)
+    if not any(destdir.iterdir()):
+        destdir.rmdir()
+    sys.exit()
+
+if args.skip_if_unchanged and not args.debug_shell:
+    (destdir / 'fingerprint.txt').write_text(fingerprint + '\n')
 
 subprocess.check_call(
     ['du', '--human-readable', '--all', '--one-file-system', destdir])
 
+if args.squashfs_layout == 'delta':
+    # How much of this image could rsync --copy-dest reuse from the previous one?
+    # Keep (a hardlink to) the previous build's image around to find out, because
+    # the previous destdir might be gone (--remove-afterward).
+    previous_squashfs_path = args.cache_dir / 'squashfs-previous' / f'{args.template}.squashfs'
+    previous_squashfs_path.parent.mkdir(parents=True, exist_ok=True)
+    if previous_squashfs_path.exists() and previous_squashfs_path.samefile(destdir / 'filesystem.squashfs'):
+        # e.g. --skip-if-unchanged reused the previous image; comparing it with itself would say "100% reused".
+        logging.info('filesystem.squashfs is the same file as %s; no delta to report', previous_squashfs_path)
+    elif previous_squashfs_path.exists():
+        with timed('squashfs delta report'):
+            delta_report = measure_rsync_delta(previous_squashfs_path, destdir / 'filesystem.squashfs')
+        (destdir / 'squashfs-delta.json').write_text(json.dumps(delta_report, indent=2) + '\n')
+        logging.info('rsync would reuse %.0f%% of filesystem.squashfs (%d MiB new, %d MiB reused)',
+                     100 * delta_report['matched_bytes'] / max(1, delta_report['total_bytes']),
+                     delta_report['literal_bytes'] // 2**20,
+                     delta_report['matched_bytes'] // 2**20)
+    tmp_path = previous_squashfs_path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        tmp_path.hardlink_to(destdir / 'filesystem.squashfs')
+    except OSError:             # e.g. different filesystems
+        shutil.copy(destdir / 'filesystem.squashfs', tmp_path)
+    tmp_path.rename(previous_squashfs_path)
+
+if (destdir / 'dpkg.status').exists():
+    # NOTE: previous report is kept in cache_dir, because the previous destdir might be gone (--remove-afterward).
+    previous_size_report_path = args.cache_dir / 'size-report' / f'{args.template}.json'
+    with timed('size report'):
+        new_size_report = size_report(
+            destdir / 'dpkg.status',
+            [word
+             for arg in (*base_mmdebstrap_args, *template_mmdebstrap_args)
+             if isinstance(arg, str) and arg.startswith('--include=')
+             for word in re.split(r'[\s,]+', arg.removeprefix('--include='))
+             if word])
+        new_size_report['squashfs_bytes'] = (destdir / 'filesystem.squashfs').stat().st_size
+    (destdir / 'size-report.json').write_text(json.dumps(new_size_report, indent=2) + '\n')
+    if not previous_size_report_path.exists():
+        logging.info('No previous %s size report to compare with', args.template)
+    else:
+        old_size_report = json.loads(previous_size_report_path.read_text())
+        compare_size_reports(old_size_report, new_size_report)
+        growth_MiB = (new_size_report['squashfs_bytes'] - old_size_report['squashfs_bytes']) / 2**20
+        if args.max_image_growth is not None and growth_MiB > args.max_image_growth:
+            # Don't update previous_size_report_path, so the next build is compared with the last GOOD one.
+            raise RuntimeError('Image grew past --max-image-growth', f'{growth_MiB:.0f} MiB', destdir / 'size-report.json')
+    previous_size_report_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = previous_size_report_path.with_suffix(f'.{os.getpid()}.tmp')
+    tmp_path.write_text(json.dumps(new_size_report, indent=2) + '\n')
+    tmp_path.rename(previous_size_report_path)
+elif args.max_image_growth is not None:
+    logging.warning('No dpkg.status (--optimize=simplicity?), so cannot check --max-image-growth')
+
+
+def write_timings(path: pathlib.Path) -> None:
+    path.write_text(json.dumps({
+        'template': args.template,
+        'git-description': git_description,
+        'phases': timings}, indent=2) + '\n')
+
+
+# Written now so it goes into B2SUMS & gets uploaded with the image.
+# The full timings (incl. uploads) go only into --cache-dir/timings/ at the end, so
+# this file never changes after it's summed & signed.
+write_timings(destdir / 'timings.json')
+
+
+# Every digest we publish (B2SUMS, SHA3SUMS), computed in ONE pass over each file.
+# Read in chunks, so memory use doesn't depend on how big filesystem.squashfs is.
+# Remembered (until the file changes), so --reproducible then --github-release doesn't read it twice.
+# NOTE: hashlib releases the GIL for big update()s, so hashing several files in threads is parallel.
+file_digests_cache = {}
+
+
+def file_digests(path: pathlib.Path) -> dict:
+    stat = path.stat()
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in file_digests_cache:
+        digests = {'blake2b': hashlib.blake2b(),  # same as b2sum
+                   'sha3_224': hashlib.sha3_224()}
+        with path.open('rb') as f:
+            while chunk := f.read(2**20):
+                for digest in digests.values():
+                    digest.update(chunk)
+        file_digests_cache[key] = {name: digest.hexdigest() for name, digest in digests.items()}
+    return file_digests_cache[key]
+
+
+def write_sums(sums_path: pathlib.Path, algorithm: str, separator: str = '  ') -> None:
+    paths = sorted(path for path in sums_path.parent.iterdir()
+                   if path.is_file() and path != sums_path)
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        digests = list(pool.map(file_digests, paths))
+    sums_path.write_text(''.join(
+        f'{digest[algorithm]}{separator}{path.name}\n'
+        for path, digest in zip(paths, digests)))
+
+
 if args.reproducible:
     (destdir / 'args.txt').write_text(pprint.pformat(args))
     (destdir / 'git-description.txt').write_text(git_description)
-    (destdir / 'B2SUMS').write_bytes(subprocess.check_output(
-        ['b2sum', *sorted(path.name for path in destdir.iterdir())],
-        cwd=destdir))
+    with timed('B2SUMS'):
+        write_sums(destdir / 'B2SUMS', 'blake2b')
     if False:
         # Disabled for now because:
         #   1. you have to babysit the build (otherwise "gpg: signing failed: Timeout"); and
@@ -628,6 +1503,203 @@ def maybe_dummy_DVD(testdir: pathlib.Path) -> list:
          '--boot', 'order=n'])  # don't try to boot off the dummy disk
 
 
+# Turn fatrace output like "systemd(1): RO /usr/lib/systemd/systemd" into
+# a mksquashfs/sqfstar sort file, so files read earlier in boot go earlier in the image.
+# Higher priority goes first.  Priority must fit in a short.
+# Ref. https://manpages.debian.org/fatrace
+# Ref. https://manpages.debian.org/mksquashfs (-sort)
+def record_boot_trace(trace_path: pathlib.Path, sort_path: pathlib.Path) -> None:
+    paths = {}                  # dict (not set) to keep "first read" order
+    for line in trace_path.read_bytes().rstrip(b'\0').decode(errors='replace').splitlines():
+        if m := re.fullmatch(r'.*\(\d+\): [A-Z<>+]+ /(\S+)', line):
+            # These are not in filesystem.squashfs.
+            if not m[1].startswith(('proc/', 'sys/', 'dev/', 'run/', 'tmp/')):
+                paths.setdefault(m[1])
+    if not paths:
+        logging.warning('Boot trace is empty (did the boot finish?); keeping old %s', sort_path)
+        return
+    sort_path.parent.mkdir(parents=True, exist_ok=True)
+    sort_path.write_text(''.join(
+        f'{path}\t{max(1, 32767 - i)}\n'
+        for i, path in enumerate(paths)))
+    logging.info('Wrote %s (%d files); the next build will use it', sort_path, len(paths))
+
+
+# "1min 2.345s" or "512ms" (as printed by systemd-analyze) to seconds.
+def parse_systemd_timespan(s: str) -> float:
+    units = {'min': 60, 's': 1, 'ms': 0.001, 'us': 0.000001, 'µs': 0.000001, 'h': 3600}
+    return sum(float(number) * units[unit]
+               for number, unit in re.findall(r'([0-9.]+)(min|ms|us|µs|s|h)\b', s))
+
+
+# Boot the image N times without a display, and
+# ask systemd (via ssh) how long each boot took once it says boot has finished.
+# NOTE: ssh in as root with the --authorized-keys-urls keys (i.e. your ssh-agent).
+def boot_test_benchmark(qemu_command: list, serial_log_path: pathlib.Path, timeout: int = 600) -> None:
+    ssh = ['ssh', '-p', str(args.host_port_for_boot_test_ssh),
+           '-o', 'BatchMode=yes',
+           '-o', 'ConnectTimeout=5',
+           # The host keys are different every boot.
+           '-o', 'StrictHostKeyChecking=no',
+           '-o', 'UserKnownHostsFile=/dev/null',
+           '-o', 'LogLevel=ERROR',
+           'root@localhost']
+    runs = []
+    for i in range(args.boot_test_benchmark):
+        start = time.monotonic()
+        if netboot_http_server:
+            netboot_http_server.new_boot()
+        with subprocess.Popen(qemu_command) as qemu:
+            try:
+                while True:
+                    if time.monotonic() - start > timeout:
+                        shutil.copy(serial_log_path, destdir / 'boot-benchmark-serial.log')
+                        raise RuntimeError('Boot did not finish (see serial log)', i, destdir / 'boot-benchmark-serial.log')
+                    if qemu.poll() is not None:
+                        raise subprocess.CalledProcessError(qemu.returncode, qemu.args)
+                    # Fails with "Bootup is not yet finished" (or no ssh yet) until boot has finished.
+                    proc = subprocess.run([*ssh, 'systemd-analyze'],
+                                          text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                    if proc.returncode == 0:
+                        break
+                    time.sleep(1)
+                wall_seconds = time.monotonic() - start
+                blame = subprocess.check_output([*ssh, 'systemd-analyze', 'blame', '--no-pager'], text=True)
+            finally:
+                qemu.terminate()
+        # e.g. "Startup finished in 2.1s (kernel) + 3.4s (initrd) + 9.8s (userspace) = 15.3s"
+        #      "graphical.target reached after 9.1s in userspace"
+        finished, = re.findall(r'^Startup finished in (.*) = (.*)$', proc.stdout, flags=re.MULTILINE)
+        parts = dict((where, parse_systemd_timespan(span))
+                     for span, where in re.findall(r'([^+]+?) \((\w+)\)', finished[0]))
+        reached = re.search(r'reached after (.*) in userspace', proc.stdout)
+        runs.append({
+            'wall_seconds': round(wall_seconds, 3),
+            'startup_seconds': parse_systemd_timespan(finished[1]),
+            # "Time to login" is when the default target (login prompt / display manager) is reached.
+            'login_seconds': round(
+                parts.get('kernel', 0) + parts.get('initrd', 0) + parse_systemd_timespan(reached[1])
+                if reached else parse_systemd_timespan(finished[1]), 3),
+            'units': {unit: parse_systemd_timespan(span)
+                      for line in blame.splitlines() if line.strip()
+                      for span, unit in [line.strip().rsplit(' ', 1)]}})
+        logging.info('Boot %d/%d: %.1fs to login', i + 1, args.boot_test_benchmark, runs[-1]['login_seconds'])
+
+    def p95(xs: list) -> float:
+        return sorted(xs)[math.ceil(0.95 * len(xs)) - 1]  # nearest-rank
+
+    summary = {
+        key: {'median': statistics.median(run[key] for run in runs),
+              'p95': p95([run[key] for run in runs])}
+        for key in ('login_seconds', 'startup_seconds', 'wall_seconds')}
+    unit_medians = {
+        unit: statistics.median(run['units'].get(unit, 0) for run in runs)
+        for unit in {unit for run in runs for unit in run['units']}}
+    summary['slowest_units'] = dict(sorted(unit_medians.items(), key=lambda kv: kv[1], reverse=True)[:20])
+    (destdir / 'boot-benchmark.json').write_text(
+        json.dumps({'summary': summary, 'runs': runs}, indent=2) + '\n')
+    print('Boot time to login (median/p95):',
+          summary['login_seconds']['median'], '/', summary['login_seconds']['p95'], 'seconds')
+    print('Slowest units (median seconds):')
+    for unit, seconds in list(summary['slowest_units'].items())[:10]:
+        print('', f'{seconds:8.3f}', unit, sep='\t')
+
+
+# A minimal HTTP/1.1 server for --boot-test --netboot-only (fetch=http://).
+# Unlike python3 -m http.server, it does keep-alive and single-range "Range: bytes=N-M" requests, and
+# it sends with sendfile(2), so a multi-GiB filesystem.squashfs isn't copied through python.
+# It also remembers every GET, so we can report throughput and time-to-rootfs.
+# Ref. https://www.rfc-editor.org/rfc/rfc9110#name-range-requests
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def log_message(self, format, *args):
+        logging.debug('netboot HTTP: ' + format, *args)
+
+    def do_GET(self):
+        self.send_range(head_only=False)
+
+    def do_HEAD(self):
+        self.send_range(head_only=True)
+
+    def send_range(self, head_only: bool):
+        path = pathlib.Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(http.HTTPStatus.NOT_FOUND)
+            return
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        # "bytes=N-", "bytes=N-M", or "bytes=-N" (the last N bytes).
+        # Anything else (e.g. "bytes=-") is invalid, so ignore it and send the whole file, per RFC 9110.
+        if m := re.fullmatch(r'bytes=(?:(\d+)-(\d*)|-(\d+))', self.headers.get('Range', '')):
+            start, end = (
+                (int(m[1]), min(end, int(m[2] or end))) if m[1] else
+                (max(0, size - int(m[3])), end))
+            if start > end:
+                self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(http.HTTPStatus.OK)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        if head_only:
+            return
+        began = time.monotonic()
+        with path.open('rb') as f:
+            sent = self.connection.sendfile(f, start, end + 1 - start)
+        self.server.record(path.name, start, sent, began)
+
+
+class NetbootHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Port 0 means "any free port", so two boot tests can run at once.
+    # qemu's user-mode network forwards the guest's gateway address (tftp_address) to the host's 127.0.0.1.
+    def __init__(self, directory: pathlib.Path):
+        super().__init__(('127.0.0.1', 0), functools.partial(RangeRequestHandler, directory=directory))
+        self.lock = threading.Lock()
+        self.boots = []
+
+    # Call this just before starting qemu, so time-to-rootfs is measured from power-on.
+    def new_boot(self):
+        with self.lock:
+            self.boots.append({'started': time.monotonic(), 'requests': []})
+
+    def record(self, name: str, offset: int, sent: int, began: float):
+        with self.lock:
+            self.boots[-1]['requests'].append({
+                'name': name, 'offset': offset, 'bytes': sent,
+                'began': began, 'finished': time.monotonic()})
+
+    def report(self) -> list:
+        report = []
+        for boot in self.boots:
+            fetches = [r for r in boot['requests'] if r['name'] == 'filesystem.squashfs']
+            if not fetches:
+                logging.warning('Boot test never fetched filesystem.squashfs over HTTP')
+                continue
+            first, last = min(r['began'] for r in fetches), max(r['finished'] for r in fetches)
+            total = sum(r['bytes'] for r in fetches)
+            report.append({
+                'requests': len(fetches),
+                'bytes': total,
+                'MiB_per_second': round(total / 2**20 / max(last - first, 0.001), 1),
+                'seconds_to_first_request': round(first - boot['started'], 3),
+                'seconds_to_rootfs': round(last - boot['started'], 3)})
+            logging.info('Netboot over HTTP: %d MiB in %d requests at %.1f MiB/s; rootfs fetched %.1fs after power-on',
+                         total // 2**20, len(fetches), report[-1]['MiB_per_second'], report[-1]['seconds_to_rootfs'])
+        return report
+
+
+netboot_http_server = None
+
 if args.template == 'jellyfin-media-player':
     # This template uses Wayland instead of X11, so all other wants_GUI things aren't valid, but we still want the VM layer to do GUI things
     template_wants_GUI = True
@@ -662,11 +1734,19 @@ if args.boot_test:
                                    f'mkpart root {size0+size1}MiB {size0+size1+size2}MiB'])
             subprocess.check_call(['/sbin/mkfs.fat', dummy_path, '-nESP', '-F32', f'--offset={size0*2048}', f'{size1*1024}', '-v'])
             subprocess.check_call(['/sbin/mkfs.ext4', dummy_path, '-Lroot', f'-FEoffset={(size0+size1)*1024*1024}', f'{size2}M'])
+        if args.record_boot_trace:
+            # bootstrap2020-boot-trace-save.service writes the trace here (raw, no filesystem).
+            boot_trace_path = testdir / 'boot-trace.img'
+            subprocess.check_call(['truncate', '-s64M', boot_trace_path])
         if args.netboot_only:
             subprocess.check_call(['cp', '-t', testdir, '--',
                                    '/usr/lib/PXELINUX/pxelinux.0',
                                    '/usr/lib/syslinux/modules/bios/ldlinux.c32'])
             (testdir / 'pxelinux.cfg').mkdir(exist_ok=True)
+            if netboot_transport == 'http':
+                # pxelinux.0 still gets vmlinuz & initrd.img over TFTP (they're small); only the rootfs is HTTP.
+                netboot_http_server = NetbootHTTPServer(testdir)
+                threading.Thread(target=netboot_http_server.serve_forever, daemon=True).start()
             (testdir / 'pxelinux.cfg/default').write_text(
                 'DEFAULT linux\n'
                 'LABEL linux\n'
@@ -676,14 +1756,16 @@ if args.boot_test:
                 '  APPEND ' + ' '.join([
                     'boot=live',
                     (f'netboot=cifs nfsopts=ro,guest,vers=3.1.1 nfsroot=//{smb_address}/qemu live-media-path='
-                     if have_smbd else
+                     if netboot_transport == 'smb' else
+                     f'fetch=http://{tftp_address}:{netboot_http_server.server_port}/filesystem.squashfs'
+                     if netboot_transport == 'http' else
                      f'fetch=tftp://{tftp_address}/filesystem.squashfs'),
                     common_boot_args]))
         domain = subprocess.check_output(['hostname', '--domain'], text=True).strip()
         # We use guestfwd= to forward ldaps://10.0.2.100 to the real LDAP server.
         # We need a simple A record in the guest.
         # This is a quick-and-dirty way to achieve that (FIXME: do better).
-        subprocess.check_call([
+        qemu_command = [
             # NOTE: doesn't need root privs
             'qemu-system-x86_64',
             '--enable-kvm',
@@ -693,7 +1775,11 @@ if args.boot_test:
             '--smp', '2',
             # no virtio-sound in qemu 6.1 ☹
             '--device', 'ich9-intel-hda', '--device', 'hda-output',
-            *(['--nographic', '--vga', 'none']
+            *([*(['--vga', 'none'] if not template_wants_GUI else ['--device', 'virtio-vga']),
+               '--display', 'none',
+               '--serial', f'file:{testdir}/serial.log']
+              if args.boot_test_benchmark else
+              ['--nographic', '--vga', 'none']
               if not template_wants_GUI else
               ['--device', 'qxl-vga']
               if args.virtual_only else
@@ -722,61 +1808,148 @@ if args.boot_test:
             *maybe_dummy_DVD(testdir),
             *(['--drive', f'file={dummy_path},format=raw,media=disk,if=virtio',
                '--boot', 'order=n']  # don't try to boot off the dummy disk
-              if template_wants_disks else [])])
-
-for host in args.upload_to:
-    subprocess.check_call(
-        ['rsync', '-aihh', '--info=progress2', '--protect-args',
-         # FIXME: remove the next line once omega-understudy is gone!
-         '--chown=dnsmasq:nogroup' if re.fullmatch(r'(root@)light(\.cyber\.com\.au)?', host) else
-         '--chown=0:0',  # don't use UID:GID of whoever built the images!
-         # FIXME: need --bwlimit=1MiB here if-and-only-if the host is a production server.
-         f'--copy-dest=/srv/netboot/images/{args.template}-latest',
-         f'{destdir}/',
-         f'{host}:/srv/netboot/images/{destdir.name}/'])
-    rename_proc = subprocess.run(
-        ['ssh', host, f'mv -vT /srv/netboot/images/{args.template}-latest /srv/netboot/images/{args.template}-previous'],
-        check=False)
-    if rename_proc.returncode != 0:
-        # This is the first time uploading this template to this host.
-        # Create a fake -previous so later commands can assume there is ALWAYS a -previous.
+              if template_wants_disks else []),
+            *(['--drive', f'file={boot_trace_path},format=raw,media=disk,if=virtio,serial=boottrace']
+              if args.record_boot_trace else [])]
+        if not args.boot_test_benchmark:
+            if netboot_http_server:
+                netboot_http_server.new_boot()
+            subprocess.check_call(qemu_command)
+        else:
+            boot_test_benchmark(qemu_command, testdir / 'serial.log')
+        if netboot_http_server:
+            netboot_http_server.shutdown()
+            (destdir / 'netboot-transport.json').write_text(
+                json.dumps({'transport': netboot_transport, 'boots': netboot_http_server.report()}, indent=2) + '\n')
+        if args.record_boot_trace:
+            record_boot_trace(boot_trace_path, args.cache_dir / 'boot-trace' / f'{args.template}.sort')
+
+
+# Upload to every host at once, so publishing takes as long as the slowest link, not the sum of all links.
+# Each host gets ONE ssh connection (ControlMaster), shared by rsync and the remote steps, and
+# the remote steps run as one script (one round trip, and they stop at the first failure).
+def upload(host: str, control_dir: pathlib.Path) -> None:
+    ssh = ['ssh',
+           '-o', 'ControlMaster=auto',
+           '-o', f'ControlPath={control_dir}/%C',
+           '-o', 'ControlPersist=60']
+    is_light = re.fullmatch(r'(root@)light(\.cyber\.com\.au)?', host)
+    is_tweak = re.fullmatch(r'(root@)tweak(\.prisonpc\.com)?', host)
+    # FIXME: remove this once omega-understudy is gone!
+    maybe_runuser = 'runuser -u dnsmasq -- ' if is_light else ''
+    # debian-11-production.py builds several templates at once.
+    # Don't let two of them upload to the same host at the same time, because
+    # "tca get soes" then "tca set soes" is read-modify-write (last one wins).
+    with (args.destdir / f'upload-{host}.lock').open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        upload_start = time.monotonic()
         subprocess.check_call(
-            ['ssh', host, f'ln -vnsf {destdir.name} /srv/netboot/images/{args.template}-previous'])
-    # NOTE: this stuff all assumes PrisonPC.
-    subprocess.check_call([
-        'ssh', host,
-        f'[ ! -d /srv/netboot/images/{args.template}-previous/site.dir ] || '
-        f'cp -at /srv/netboot/images/{destdir.name}/ /srv/netboot/images/{args.template}-previous/site.dir'])
-    subprocess.check_call(
-        ['ssh', host,
-         # FIXME: remove the next line once omega-understudy is gone!
-         'runuser -u dnsmasq -- ' if re.fullmatch(r'(root@)light(\.cyber\.com\.au)?', host) else '',
-         f'ln -vnsf {destdir.name} /srv/netboot/images/{args.template}-latest'])
-    # FIXME: https://alloc.cyber.com.au/task/task.php?taskID=34581
-    if re.fullmatch(r'(root@)tweak(\.prisonpc\.com)?', host):
-        soes = set(subprocess.check_output(
-            ['ssh', host, 'tca get soes'],
-            text=True).strip().splitlines())
-        soes |= {f'{args.template}-latest',
-                 f'{args.template}-previous'}
-        subprocess.run(
-            ['ssh', host, 'tca set soes'],
-            text=True,
-            check=True,
-            input='\n'.join(sorted(soes)))
-        # Sync /srv/netboot to /srv/tftp &c.
-        subprocess.check_call(['ssh', host, 'tca', 'commit'])
-    # FIXME: remove the next line once omega-understudy is gone!
-    if re.fullmatch(r'(root@)light(\.cyber\.com\.au)?', host) and args.template == 'understudy':
-        subprocess.check_call([
-            'ssh', host,
-            'runuser -u dnsmasq -- '
-            f'ln -nsf ../understudy-omega.cpio /srv/netboot/images/{destdir.name}/omega.cpio'])
+            ['rsync', '-aihh', '--info=progress2', '--protect-args',
+             '--rsh', ' '.join(ssh),
+             # FIXME: remove the next line once omega-understudy is gone!
+             '--chown=dnsmasq:nogroup' if is_light else
+             '--chown=0:0',  # don't use UID:GID of whoever built the images!
+             # FIXME: need --bwlimit=1MiB here if-and-only-if the host is a production server.
+             f'--copy-dest=/srv/netboot/images/{args.template}-latest',
+             f'{destdir}/',
+             f'{host}:/srv/netboot/images/{destdir.name}/'])
+        # NOTE: this stuff all assumes PrisonPC.
+        script = '\n'.join([
+            'cd /srv/netboot/images',
+            # If this is the first time uploading this template to this host,
+            # create a fake -previous so later commands can assume there is ALWAYS a -previous.
+            f'mv -vT {args.template}-latest {args.template}-previous ||'
+            f' ln -vnsf {destdir.name} {args.template}-previous',
+            f'[ ! -d {args.template}-previous/site.dir ] ||'
+            f' cp -at {destdir.name}/ {args.template}-previous/site.dir',
+            f'{maybe_runuser}ln -vnsf {destdir.name} {args.template}-latest',
+            # FIXME: https://alloc.cyber.com.au/task/task.php?taskID=34581
+            # NOTE: read the list on its own line, so "sh -e" stops if "tca get soes" fails.
+            #       In a pipeline (no pipefail in dash) it would "tca set soes" to ONLY this template.
+            *(['soes=$(tca get soes)',
+               f'printf "%s\\n" "$soes" {args.template}-latest {args.template}-previous |'
+               ' sed /^$/d | sort -u | tca set soes',
+               # Sync /srv/netboot to /srv/tftp &c.
+               'tca commit']
+              if is_tweak else []),
+            # FIXME: remove the next line once omega-understudy is gone!
+            *(['runuser -u dnsmasq -- '
+               f'ln -nsf ../understudy-omega.cpio {destdir.name}/omega.cpio']
+              if is_light and args.template == 'understudy' else []),
+        ])
+        subprocess.check_call([*ssh, host, 'sh', '-euc', shlex.quote(script)])
+        # NOTE: not "with timed()", because that would also count waiting for the lock.
+        timings.append({'phase': f'upload to {host}', 'seconds': round(time.monotonic() - upload_start, 3)})
+    subprocess.run([*ssh, '-O', 'exit', host], stderr=subprocess.DEVNULL)
+
+
+if args.upload_to:
+    with tempfile.TemporaryDirectory() as control_dir, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=len(args.upload_to)) as upload_pool:
+        upload_futures = {upload_pool.submit(upload, host, pathlib.Path(control_dir)): host
+                          for host in args.upload_to}
+        upload_failures = []
+        for future in concurrent.futures.as_completed(upload_futures):
+            host = upload_futures[future]
+            try:
+                future.result()
+                logging.info('Uploaded %s to %s', destdir.name, host)
+            except subprocess.CalledProcessError as e:
+                logging.error('Upload to %s FAILED: %s', host, e)
+                upload_failures.append(host)
+    if upload_failures:
+        raise RuntimeError('Upload failed', sorted(upload_failures))
+
+
+# Wrap a file's read(), so we can log how far through the upload we are.
+class ProgressReader:
+    def __init__(self, path: pathlib.Path):
+        self.path, self.size, self.done, self.reported = path, path.stat().st_size, 0, 0
+        self.f = path.open('rb')
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.f.read(size)
+        self.done += len(chunk)
+        if self.done - self.reported >= self.size / 10:  # every 10%
+            self.reported = self.done
+            logging.info('Uploading %s to Github: %d%%', self.path.name, 100 * self.done // max(1, self.size))
+        return chunk
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        return iter(lambda: self.read(2**16), b'')
+
+
+# Upload one file to a Github release, retrying (with backoff) if Github or the network has a hiccup.
+def upload_github_asset(gh_release, path: pathlib.Path, attempts: int = 3) -> None:
+    for attempt in range(1, attempts + 1):
+        try:
+            # A failed attempt can leave a half-uploaded asset, which blocks the next attempt.
+            for asset in gh_release.get_assets():
+                if asset.name == path.name:
+                    asset.delete_asset()
+            if hasattr(gh_release, 'upload_asset_from_memory'):  # PyGithub 1.57+
+                progress = ProgressReader(path)
+                with progress.f:
+                    gh_release.upload_asset_from_memory(
+                        progress, progress.size, path.name, content_type='application/octet-stream')
+            else:
+                logging.info('Uploading %s to Github', path.name)
+                gh_release.upload_asset(str(path.resolve()))  # upload_asset does not support pathlib.
+            return
+        except (github.GithubException, requests.exceptions.RequestException):
+            if attempt == attempts:
+                raise
+            logging.warning('Upload of %s failed (attempt %d/%d); retrying', path.name, attempt, attempts, exc_info=True)
+            time.sleep(2 ** attempt)
+
 
 if args.github_release:
     # FIXME: Just put these imports up the top with the other imports
-    import hashlib
     import github
+    github_start = time.monotonic()
 
     # NOTE: Uploading release assets simply will not work with user/pass credentials,
     #       you must generate a personal access token as documented here:
@@ -798,21 +1971,38 @@ if args.github_release:
     )
     # gh_release = gh_repo.get_release(args.github_release.split(':', 1)[1])
 
-    sha3sums = {}
-    for f in destdir.iterdir():
-        # FIXME: upload_asset does not support pathlib.
-        #        In a later version there is an upload_asset_from_memory function which will take a file-like object instead.
-        # FIXME: Theoretically we can add a progress bar of some sort if we were to wrap the read() of a file-like object.
-        sha3sums[f.name] = hashlib.sha3_224(f.read_bytes())
-        print("Uploading", f.name, "to Github, with SHA3:", sha3sums[f.name].hexdigest())
-        gh_release.upload_asset(str(f.resolve()))
-
     # FIXME: Sign this like --reproducible does?
     #        Would it be better to sign the tag? Would that even solve the same problems?
-    (destdir / 'SHA3SUMS').write_text('\n'.join(
-        # NOTE: sha3sum doesn't actually use '\t', but it still supports that for --check, and makes more sense to me
-        f'{sha3sums[filename].hexdigest()}\t{filename}' for filename in sha3sums) + '\n')
-    gh_release.upload_asset(str((destdir / 'SHA3SUMS').resolve()))
+    # NOTE: sha3sum doesn't actually use '\t', but it still supports that for --check, and makes more sense to me
+    write_sums(destdir / 'SHA3SUMS', 'sha3_224', '\t')
+    print((destdir / 'SHA3SUMS').read_text(), end='')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        for _ in pool.map(lambda path: upload_github_asset(gh_release, path),
+                          sorted(path for path in destdir.iterdir() if path.is_file())):
+            pass                # re-raise any exception
+    timings.append({'phase': 'github release', 'seconds': round(time.monotonic() - github_start, 3)})
+
+if args.skip_if_unchanged and not args.debug_shell:
+    fingerprint_record_path.parent.mkdir(parents=True, exist_ok=True)
+    fingerprint_record_path.write_text(json.dumps({
+        'fingerprint': fingerprint,
+        'image': destdir.name,
+        'uploaded-to': args.upload_to}))
+# Keep the full timings outside destdir, because
+# destdir/timings.json is already in B2SUMS (so can't change now),
+# --remove-afterward deletes destdir, and
+# a second build on the same day reuses (overwrites) destdir.
+timings_dir = args.cache_dir / 'timings'
+timings_dir.mkdir(parents=True, exist_ok=True)
+if args.compare_timings:
+    previous_timings_path = get_previous_timings_path()
+    if not previous_timings_path:
+        logging.warning('No previous %s build to compare timings with', args.template)
+    else:
+        logging.info('Comparing timings with %s', previous_timings_path)
+        compare_timings(json.loads(previous_timings_path.read_text())['phases'], timings)
+write_timings(timings_dir / f'{destdir.name}.json')
 
 if args.remove_afterward:
     shutil.rmtree(destdir)
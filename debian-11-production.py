@@ -1,23 +1,171 @@
 #!/usr/bin/python3
-# FIXME: merge this "preset" and "loop" functionality into main.py
-
-import subprocess
+import argparse
+import concurrent.futures
 import datetime
-for template in (
-        'understudy',
-        'tvserver',
-        'desktop-staff-amc',
-        'desktop-inmate-amc',
-        'desktop-inmate-amc-library'):
-    subprocess.check_call([
-        './debian-11-main.py',
-        '--remove',
-        '--netboot-only',       # no ISO/USB
-        # No qemu, **EXCEPT FOR** desktop-staff-amc, which
-        # Mike wants to expose via spice-html5.
-        *(['--physical-only']
-          if template != 'desktop-staff-amc' else []),
-        '--ssh=openssh-server',  # PrisonPC needs this
-        f'--reproducible={datetime.date.today()}',
-        '--upload-to', 'root@tweak.prisonpc.com', 'root@amc.prisonpc.com',
-        '--template', template])
+import logging
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+__doc__ = """ build every PrisonPC SOE at once
+
+This used to build one template at a time, so
+the nightly run took the SUM of five mmdebstrap runs (plus uploads).
+Now several ./debian-11-main.py run at once, within a CPU/RAM/tmp budget, so
+it should take about as long as the SLOWEST template.
+
+debian-11-main.py itself takes a per-host lock around --upload-to, so
+uploads to any one host still happen one at a time (never interleaved).
+
+Before any of that, the .debs every template needs are fetched into --deb-pool,
+one template at a time, so the builds don't each download the same kernel, firmware & mesa.
+
+FIXME: merge this "preset" and "loop" functionality into main.py
+"""
+
+# Rough peak cost of ONE build of each template, measured by hand on the build box.
+# The desktops are much bigger than the servers.
+# FIXME: get these from the previous build's report instead of hard-coding them.
+templates = {
+    'understudy': {'ram_GiB': 1, 'tmp_GiB': 3},
+    'tvserver': {'ram_GiB': 1, 'tmp_GiB': 3},
+    'desktop-staff-amc': {'ram_GiB': 2, 'tmp_GiB': 8},
+    'desktop-inmate-amc': {'ram_GiB': 2, 'tmp_GiB': 8},
+    'desktop-inmate-amc-library': {'ram_GiB': 2, 'tmp_GiB': 8},
+}
+
+
+# "8", "8G", "8GB" and "8GiB" all mean 8GiB (close enough for a budget).
+def GiB(s: str) -> float:
+    if m := re.fullmatch(r'(\d+(?:\.\d+)?) *(?:G|GB|GiB)?', s.strip(), flags=re.IGNORECASE):
+        return float(m[1])
+    raise argparse.ArgumentTypeError(f'{s!r} is not a size in GiB (e.g. 8, 8G, 8GiB)')
+
+
+def default_ram_GiB() -> float:
+    # Leave a quarter of the host's RAM for everything else.
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30 * 3 / 4
+
+
+def default_tmp_GiB() -> float:
+    # mmdebstrap stages the chroot in $TMPDIR.
+    return shutil.disk_usage(os.environ.get('TMPDIR', '/tmp')).free / 2**30 * 3 / 4
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--templates', nargs='+', default=list(templates), choices=list(templates),
+                    help='which SOEs to build (default: all of them)')
+parser.add_argument('--max-jobs', type=int, metavar='N',
+                    default=max(1, (os.cpu_count() or 1) // 2),
+                    help='build at most N templates at once (default: half the CPUs)')
+parser.add_argument('--max-ram', type=GiB, metavar='GiB', default=default_ram_GiB(),
+                    help='total RAM all concurrent builds may use (default: 3/4 of RAM)')
+parser.add_argument('--max-tmp', type=GiB, metavar='GiB', default=default_tmp_GiB(),
+                    help='total $TMPDIR space all concurrent builds may use (default: 3/4 of free space)')
+parser.add_argument('--logdir', type=lambda s: pathlib.Path(s).resolve(),
+                    default='/tmp/bootstrap2020/',
+                    help='where to put each template\'s build log')
+args = parser.parse_args()
+
+
+class Budget:
+    """Hand out CPU/RAM/tmp to builds; block until enough is free."""
+
+    def __init__(self, jobs: int, ram_GiB: float, tmp_GiB: float):
+        self.total = {'jobs': jobs, 'ram_GiB': ram_GiB, 'tmp_GiB': tmp_GiB}
+        self.free = dict(self.total)
+        self.condition = threading.Condition()
+
+    def fits(self, cost: dict) -> bool:
+        return all(self.free[k] >= v for k, v in cost.items())
+
+    def acquire(self, cost: dict) -> None:
+        with self.condition:
+            # If one build is bigger than the WHOLE budget, we would wait forever.
+            # Instead, let it run on its own once everything else has finished.
+            self.condition.wait_for(lambda: self.fits(cost) or self.free['jobs'] == self.total['jobs'])
+            for k, v in cost.items():
+                self.free[k] -= v
+
+    def release(self, cost: dict) -> None:
+        with self.condition:
+            for k, v in cost.items():
+                self.free[k] += v
+            self.condition.notify_all()
+
+
+# The options that decide which packages a template's image gets.
+# The prefetch must use the same ones as the build, or it fetches the wrong .debs.
+def package_args(template: str) -> list:
+    return ['--netboot-only',       # no ISO/USB
+            # No qemu, **EXCEPT FOR** desktop-staff-amc, which
+            # Mike wants to expose via spice-html5.
+            *(['--physical-only']
+              if template != 'desktop-staff-amc' else []),
+            '--ssh=openssh-server',  # PrisonPC needs this
+            '--template', template]
+
+
+# Fetch what the template needs into --deb-pool, without building it.
+# One template at a time, so each only downloads what the ones before it didn't.
+# If it fails, just carry on: the build will download whatever is missing itself.
+def prefetch(template: str) -> None:
+    logging.info('Prefetching .debs for %s', template)
+    with (args.logdir / f'{template}.prefetch.log').open('w') as log:
+        proc = subprocess.run(
+            ['./debian-11-main.py', '--prefetch-debs', *package_args(template)],
+            stdout=log,
+            stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        logging.warning('Prefetch failed for %s (see %s); its build will download for itself',
+                        template, args.logdir / f'{template}.prefetch.log')
+
+
+def build(template: str) -> float:
+    cost = {'jobs': 1, **templates[template]}
+    budget.acquire(cost)
+    try:
+        logging.info('Starting %s', template)
+        start = time.monotonic()
+        # Each build gets its own log, otherwise five mmdebstraps interleave into gibberish.
+        with (args.logdir / f'{template}.log').open('w') as log:
+            subprocess.check_call(
+                ['./debian-11-main.py',
+                 '--remove',
+                 '--skip-if-unchanged',   # most nights, nothing changed
+                 '--deb-pool',            # install from the .debs prefetch() (and earlier builds) downloaded
+                 '--compare-timings',     # complain in the log if a phase got slower
+                 f'--reproducible={datetime.date.today()}',
+                 '--upload-to', 'root@tweak.prisonpc.com', 'root@amc.prisonpc.com',
+                 *package_args(template)],
+                stdout=log,
+                stderr=subprocess.STDOUT)
+        return time.monotonic() - start
+    finally:
+        budget.release(cost)
+
+
+logging.basicConfig(level=logging.INFO)
+args.logdir.mkdir(parents=True, exist_ok=True)
+budget = Budget(args.max_jobs, args.max_ram, args.max_tmp)
+start = time.monotonic()
+for template in args.templates:
+    prefetch(template)
+logging.info('Prefetched .debs for %d templates in %ds', len(args.templates), time.monotonic() - start)
+with concurrent.futures.ThreadPoolExecutor(max_workers=len(args.templates)) as pool:
+    futures = {pool.submit(build, template): template for template in args.templates}
+    failed = []
+    for future in concurrent.futures.as_completed(futures):
+        template = futures[future]
+        try:
+            logging.info('Finished %s in %ds', template, future.result())
+        except subprocess.CalledProcessError:
+            logging.error('Failed %s (see %s)', template, args.logdir / f'{template}.log')
+            failed.append(template)
+logging.info('Built %d templates in %ds', len(args.templates), time.monotonic() - start)
+if failed:
+    raise RuntimeError('Some templates failed', sorted(failed))
@@ -184,6 +184,17 @@ async def send_to_inputSocket(keycode, source="Keyboard", client=sys.argv[0]):
             print("Socket not connected, can't send data", keycode, file=sys.stderr)
 
 
+snap = None
+def get_snap():  # noqa: E302 "expected 2 blank lines, found 0"
+    """Return a connection to the snapserver, reconnecting if the last one was lost."""
+    global snap  # FIXME
+    if snap is None or not snap.is_connected():
+        if snap is not None:
+            snap.close()
+        snap = snapcontroller.connect()
+    return snap
+
+
 def increment_snap_channel(increment):
     """Increment the stream associated with the current snapcast group."""
     notif = Notify.Notification.new("Snapcast stream")
@@ -195,17 +206,19 @@ def increment_snap_channel(increment):
     #        But that can take so long that it's annoying and defeats the purpose of the notification
     subprocess.Popen(['pactl', 'play-sample', 'device-added' if increment > 0 else 'device-removed'])
 
-    with snapcontroller.SnapController() as snap:
-        snap_group = snap.get_group_of_client(snapcontroller.get_physical_mac())
-        current_stream = snap.run_command('Group.GetStatus', params={'id': snap_group})['group']['stream_id']
+    # Which group we're in, what it's tuned to, and what else there is, all come from the local mirror.
+    # Only the actual SetStream is a round trip to the snapserver.
+    snap = get_snap()
+    snap_group = snap.get_group_of_client(snapcontroller.get_physical_mac())
+    current_stream = snap.get_group(snap_group)['stream_id']
 
-        snap_streams = snap.get_all_streams()
-        current_index = snap_streams.index(current_stream)
+    snap_streams = snap.get_all_streams()
+    current_index = snap_streams.index(current_stream)
 
-        new_index = (current_index + increment) % len(snap_streams)
-        new_stream_id = snap_streams[new_index]
+    new_index = (current_index + increment) % len(snap_streams)
+    new_stream_id = snap_streams[new_index]
 
-        result = snap.run_command('Group.SetStream', params={'id': snap_group, 'stream_id': new_stream_id})
+    result = snap.run_command('Group.SetStream', params={'id': snap_group, 'stream_id': new_stream_id})
 
     notif.set_property('body', f"Tuned to: {result['stream_id']}")
     notif.show()
@@ -6,14 +6,14 @@ import json
 import os
 import pathlib
 import shlex
-import subprocess
 import urllib.parse
 import urllib.request
 import uuid
 
-import dns.resolver
 import plyvel
 
+import srvdiscovery
+
 
 # These are the keys in local storage that we want to update
 # NOTE: I don't know why there's the '_' before hand, or the '\x00\x01',
@@ -24,32 +24,6 @@ AUTOLOGIN_KEY = b'_file://\x00\x01enableAutoLogin'
 DEVICEID_KEY = b'_file://\x00\x01_deviceId2'
 
 
-def get_sorted_SRV(SRV):
-    """Get the top SRV record for the given query."""
-    # Python was doing some really weird & stupid things when trying to get the search domain.
-    # So I gave up and called out to resolvectl instead
-    # FIXME: Why the fuck didn't python's socket module work?!?
-    #        Often gethostname & getfqdn swapped responses,
-    #        and when they did the fqdn (returned by gethostname) was cut short such that it couldn't fit the full domain
-    #        NOTE: the 'hostname' command does the same thing
-    domains = subprocess.check_output(['resolvectl', 'domain'], text=True)
-    for line in domains.splitlines():
-        _, domain = line.split(':', 1)
-        domain = domain.strip()
-
-        if domain:
-            break
-
-    # Get all SRV records and sort them by priority,
-    # then grab only the first one
-    # FIXME: Try them in order until 1 works?
-    # FIXME: Is this sorted in the right order?
-    srv_records = list(dns.resolver.resolve(f'{SRV}.{domain}', 'SRV'))
-    srv_records.sort(key=lambda i: i.priority)
-
-    return srv_records
-
-
 def get_JF_info(base_url):
     """Query the info directly from the Jellyfin server (similar to how the Chromecast does)."""
     # FIXME: If the LocalAddress is missing we're supposed to use the ManualAddress,
@@ -66,11 +40,9 @@ def guess_JF_base_url():
 
     FIXME: Does Jellyfin already use avahi? Can we use that instead of SRV records?
     """
-    SRV_records = get_sorted_SRV('_jellyfin._tcp')
-
-    for record in SRV_records:
+    for record in srvdiscovery.resolve_srv('_jellyfin._tcp'):
         jf_port = record.port
-        jf_target = str(record.target).rstrip('.')
+        jf_target = record.target
         # If the port is a usual https port, then do https, otherwise http
         # NOTE: Jellyfin defaults to 8920 for https
         if jf_port in (443, 8920):
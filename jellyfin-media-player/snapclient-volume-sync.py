@@ -116,7 +116,8 @@ class PulseSnapgroupHandler(object):
         else:
             print("Updating snapclient volume to", snapclient_volume)
             self.prev_snapclient_volume = snapclient_volume
-            # FIXME: Do some sort of time-based memoization for the group ID
+            # NOTE: get_group_of_client() reads snapcontroller's local mirror of the server state,
+            #       which follows the server's notifications, so this is no extra round trip.
             self.snap_conn.run_command(method='Group.SetVolume',
                                        params={'id': self.snap_conn.get_group_of_client(self.snap_client_id),
                                                'percent': snapclient_volume})
@@ -139,7 +140,7 @@ dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 mainloop = GLib.MainLoop()
 
 pulse = PulseSnapgroupHandler(multiplier=args.multiplier,
-                              snap_conn=snapcontroller.SnapController(),
+                              snap_conn=snapcontroller.connect(),
                               mainloop=mainloop)
 
 systemd.daemon.notify('READY=1')
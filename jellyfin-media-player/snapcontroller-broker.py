@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+"""
+Share one snapserver connection between everything on this machine.
+
+keybinds.py, snapclient-volume-sync.py & the snapclient-group-cork.service ExecStart/ExecStop
+each used to find the snapserver (resolvectl + DNS SRV), connect, and fetch Server.GetStatus for themselves.
+This owns the one connection & its state mirror (see snapcontroller.AsyncSnapController),
+and serves them to snapcontroller.SnapBrokerClient on a UNIX socket,
+so corking the group when a film starts is one local round trip.
+
+The protocol is newline-delimited JSON-RPC 2.0, like snapserver's own, where methods are
+anything snapcontroller.py's run_command() accepts (including Group.SetVolume & Group.SetMute --toggle),
+plus a few Broker.* methods that answer from the state mirror.
+"""
+import asyncio
+import json
+import socket
+import sys
+import traceback
+
+import systemd.daemon
+
+import snapcontroller
+
+
+class Broker(object):
+    """Serve one AsyncSnapController to many local clients."""
+
+    def __init__(self):
+        """Don't connect to snapserver until someone actually wants it."""
+        self.controller = snapcontroller.AsyncSnapController()
+        self.connecting = asyncio.Lock()
+        self.methods = {
+            'Broker.GetGroupOfClient': lambda params: self.controller.get_group_of_client(params['id']),
+            'Broker.GetGroup': lambda params: self.controller.get_group(params['id']),
+            'Broker.GetAllStreams': lambda params: self.controller.get_all_streams(),
+            'Broker.Batch': lambda params: self.controller.batch([tuple(call) for call in params['calls']]),
+        }
+
+    async def ensure_connected(self):
+        """(Re)connect to snapserver, if it's not already connected."""
+        async with self.connecting:
+            if not self.controller.is_connected():
+                await self.controller.connect()
+                snapcontroller.check_rpc_version(await self.controller.request('Server.GetRPCVersion'))
+                # Load the mirror now, rather than on the first key press.
+                await self.controller.get_status()
+
+    async def call(self, request: dict):
+        """Answer one request from a client."""
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            await self.ensure_connected()
+            method, params = request['method'], request.get('params') or {}
+            if method in self.methods:
+                response['result'] = await self.methods[method](params)
+            else:
+                response['result'] = await self.controller.run_command(method, params)
+        except snapcontroller.SnapException as e:
+            response['error'] = {'code': e.code, 'message': e.message, 'data': e.data}
+        except Exception as e:
+            # Report it to the client, but keep serving everyone else.
+            traceback.print_exc()
+            response['error'] = {'code': -32603, 'message': 'Internal error', 'data': repr(e)}
+        return response
+
+    async def handle_client(self, reader, writer):
+        """Answer one client's requests, in order, until it hangs up."""
+        try:
+            while line := await reader.readline():
+                writer.write(json.dumps(await self.call(json.loads(line))).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, json.JSONDecodeError) as e:
+            print("Dropping client:", repr(e), file=sys.stderr)
+        finally:
+            writer.close()
+
+
+def get_listening_socket():
+    """Use the socket systemd passed us (snapcontroller-broker.socket), or make our own."""
+    fds = systemd.daemon.listen_fds()
+    if fds:
+        return socket.socket(fileno=fds[0])
+    path = snapcontroller.get_broker_path()
+    path.unlink(missing_ok=True)  # left over from last time
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(path))
+    path.chmod(0o600)
+    return sock
+
+
+async def main():
+    """Serve until killed."""
+    broker = Broker()
+    server = await asyncio.start_unix_server(broker.handle_client, sock=get_listening_socket())
+    systemd.daemon.notify('READY=1')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -6,15 +6,18 @@ ref: https://github.com/badaix/snapcast/blob/master/doc/json_rpc_api/control.md
 """
 
 import argparse
+import asyncio
+import copy
 import json
+import os
+import pathlib
 import pprint  # noqa: F401 "imported but unused"  # This is useful for debugging
 import socket
-import subprocess
 import sys
-import time
+import threading
 
-import dns.resolver
-import psutil
+# NOTE: srvdiscovery & psutil are imported where they're used,
+#       so that going via snapcontroller-broker.py doesn't pay to load them.
 
 
 API_CMD_ARGS = {
@@ -91,6 +94,8 @@ def get_physical_mac():
     Returns None for anything other than 1 valid MAC address,
     because there's no way to identify which is valid of multiple MAC addresses
     """
+    import psutil
+
     active_macs = []
     all_addresses = psutil.net_if_addrs()
 
@@ -127,115 +132,344 @@ class SnapException(Exception):
         super().__init__(f'{self.message} {self.code}: {self.data}')
 
 
-class SnapController(object):
-    """Snapserver controller."""
+class BatchNotSupported(SnapException):
+    """Snapserver rejected a JSON-RPC batch as a whole."""
 
-    last_command_id = 42  # Might make more sense to start from 0, but it helped with debugging to start higher
 
-    def __init__(self, host: str = None, port: int = None):
-        """Initialise the socket connections."""
-        default_host, default_port = get_defaults_from_srv()
+class SnapServerState(object):
+    """
+    Local mirror of the snapserver's state (the 'server' part of Server.GetStatus).
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host or default_host, port or default_port))
-        self.sock.setblocking(0)
+    It is loaded once, then kept current by applying notifications
+    (and the results of our own requests, which the server doesn't notify us about),
+    so "which group am I in?" & "what streams are there?" don't need a round trip.
+    If anything arrives that can't be applied, the mirror is dropped and reloaded on next use.
+    """
 
-    def __enter__(self):  # noqa: D105 "Missing docstring in magic method"
+    # notification: (what its id refers to, key in its params, where that goes in the object)
+    simple_updates = {
+        'Client.OnVolumeChanged': ('client', 'volume', ('config', 'volume')),
+        'Client.OnLatencyChanged': ('client', 'latency', ('config', 'latency')),
+        'Client.OnNameChanged': ('client', 'name', ('config', 'name')),
+        'Group.OnMute': ('group', 'mute', ('muted',)),
+        'Group.OnStreamChanged': ('group', 'stream_id', ('stream_id',)),
+        'Group.OnNameChanged': ('group', 'name', ('name',)),
+        'Stream.OnProperties': ('stream', 'properties', ('properties',)),
+    }
+
+    # request: the notification other controllers get for it (its result has the same keys)
+    result_notifications = {
+        'Client.SetVolume': 'Client.OnVolumeChanged',
+        'Client.SetLatency': 'Client.OnLatencyChanged',
+        'Client.SetName': 'Client.OnNameChanged',
+        'Group.SetMute': 'Group.OnMute',
+        'Group.SetStream': 'Group.OnStreamChanged',
+        'Group.SetName': 'Group.OnNameChanged',
+        'Group.SetClients': 'Server.OnUpdate',
+        'Server.DeleteClient': 'Server.OnUpdate',
+        'Server.GetStatus': 'Server.OnUpdate',
+    }
+
+    def __init__(self):
+        """Start out empty."""
+        self.server = None
+
+    def find(self, kind: str, object_id: str):
+        """Return the client/group/stream with the given id, or None."""
+        if kind == 'client':
+            objects = [client for group in self.server['groups'] for client in group['clients']]
+        else:
+            objects = self.server[f'{kind}s']
+        return next((o for o in objects if o['id'] == object_id), None)
+
+    def apply(self, method: str, params: dict):
+        """Update the mirror from one notification."""
+        if method == 'Server.OnUpdate':
+            self.server = params['server']
+        elif self.server is None:
+            pass                # Nothing loaded yet, and the Server.GetStatus we load will be newer.
+        elif method in self.simple_updates:
+            kind, key, path = self.simple_updates[method]
+            target = self.find(kind, params['id'])
+            if target is None:
+                self.server = None
+                return
+            for k in path[:-1]:
+                target = target[k]
+            target[path[-1]] = params[key]
+        elif method in ('Client.OnConnect', 'Client.OnDisconnect', 'Stream.OnUpdate'):
+            kind = method.split('.')[0].lower()
+            self.replace(kind, params[kind])
+        else:
+            # FIXME: Snapserver grows new notifications now and then; just start over rather than guess.
+            self.server = None
+
+    def apply_result(self, method: str, params: dict, result):
+        """Update the mirror from the result of one of our own requests."""
+        if method in self.result_notifications:
+            self.apply(self.result_notifications[method], {'id': (params or {}).get('id'), **result})
+
+    def replace(self, kind: str, new: dict):
+        """Replace a whole client/stream object, e.g. when a client reconnects."""
+        old = self.find(kind, new['id'])
+        if old is not None:
+            old.clear()
+            old.update(new)
+        elif kind == 'stream':
+            self.server['streams'].append(new)
+        else:
+            # A new client also means a new group, and we don't know which.
+            self.server = None
+
+    def group_of_client(self, client_id: str):
+        """Return the id of the group that has the given client as a member."""
+        for group in self.server['groups']:
+            if client_id in [client['id'] for client in group['clients']]:
+                return group['id']
+        return None
+
+    def stream_ids(self):
+        """Return the ids of every stream, sorted."""
+        return sorted([s['id'] for s in self.server['streams']])
+
+
+class AsyncSnapController(object):
+    """
+    Snapserver controller, over one persistent connection.
+
+    One task reads frames as they arrive and hands each result back to
+    whichever request has the same JSON-RPC id, so there's no sleeping/polling,
+    and several requests can be in flight at once.
+    Frames without an id are notifications (e.g. Client.OnVolumeChanged),
+    those update self.state, then get passed to anything that subscribe()d to them.
+    """
+
+    # Server.GetStatus is ONE line with every client, group & stream in it,
+    # which is bigger than asyncio's default 64KiB line limit.
+    line_limit = 2**24
+    timeout = 10                # seconds
+
+    def __init__(self, host: str = None, port: int = None):
+        """Remember where to connect to, don't actually connect yet."""
+        self.requested_host, self.requested_port = host, port
+        self.host = self.port = None  # what we actually connected to
+        self.last_command_id = 42  # Might make more sense to start from 0, but it helped with debugging to start higher
+        self.pending = {}          # JSON-RPC id => (future, method, params)
+        self.subscribers = []      # (method, callback) pairs
+        self.state = SnapServerState()
+        self.pending_batches = []  # futures of each batch, oldest first
+        self.batch_supported = None  # don't know until we try
+        self.reader = self.writer = self.reader_task = None
+
+    async def __aenter__(self):  # noqa: D105 "Missing docstring in magic method"
+        await self.connect()
         return self
 
-    def __exit__(self, *exc_info):  # noqa: D105 "Missing docstring in magic method"
-        self.sock.close()
+    async def __aexit__(self, *exc_info):  # noqa: D105 "Missing docstring in magic method"
+        await self.close()
+
+    async def connect(self):
+        """Open the connection and start reading from it."""
+        self.host, self.port = self.requested_host, self.requested_port
+        if not (self.host and self.port):
+            # Looked up again on every (re)connect, in case the snapserver moved.
+            # NOTE: this blocks (D-Bus & DNS), so run it in a thread rather than
+            #       stall everything else on this event loop (e.g. snapcontroller-broker.py's other clients).
+            default_host, default_port = await asyncio.get_running_loop().run_in_executor(None, get_defaults_from_srv)
+            self.host, self.port = self.host or default_host, self.port or default_port
+        self.batch_supported = None  # might be a different snapserver this time
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=self.line_limit)
+        self.reader_task = asyncio.ensure_future(self._read_frames())
+
+    async def close(self):
+        """Close the connection."""
         # FIXME: Is there any protocol specific hangup command?
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass            # It was already gone, that's fine.
+
+    def is_connected(self):
+        """Return whether the connection is still up."""
+        return self.reader_task is not None and not self.reader_task.done()
+
+    def subscribe(self, callback, method: str = None):
+        """
+        Call callback(method, params) for each notification.
 
-    def _recv_all_rawdata(self, blocking: bool = True, chunksize: int = 1024):
-        """Keep recieving data until there's no more to recieve."""
-        start_time = time.monotonic()
-        blocked = 0
-        data = b''
-        # FIXME: Maximum run time is 10s, that's a lot.
-        while not data.endswith(b'}\r\n') and time.monotonic() < (start_time + 10):
-            while blocked <= 1:
-                try:
-                    data += self.sock.recv(chunksize)
-                except BlockingIOError:
-                    time.sleep(0.25)
-                    blocked += 1
-
-        return data
-
-    def recv_result(self, result_id=None):
-        """Recv data as json."""
-        raw_data = self._recv_all_rawdata()
-        data = []
-        for line in raw_data.decode().split('\n'):
-            if line and line.endswith('\r'):
+        If method is given (e.g. 'Group.OnMute'), only for that one.
+        NOTE: callbacks run in the event loop, so they must not block.
+        """
+        self.subscribers.append((method, callback))
+
+    def unsubscribe(self, callback, method: str = None):
+        """Undo subscribe()."""
+        self.subscribers.remove((method, callback))
+
+    async def _read_frames(self):
+        """Read frames until the connection is closed, and dispatch each one."""
+        try:
+            # NOTE: the server ends each frame with '\r\n', readline() only cares about the '\n'.
+            while line := await self.reader.readline():
                 line = line.strip()
+                if not line:
+                    continue
                 try:
-                    data.append(json.loads(line))
-                except json.decoderJSONDecodeError:
-                    print("Attempted to decode:", line, file=sys.stderr)
-                    print("Continuing with what we've got.", file=sys.stderr)
-
-        # The snapserver sends status updates every now and then, we don't care about those at all.
-        # This has only really been a problem for me with snapclient-pa-role-cork.py, not when running this by hand.
-        # FIXME: Have a separate thread for recieving data and updating state variables accordingly.
-        #        That thread could then send the 'result' values into a queue that is picked up here.
-        #        Doing so would also help snapclient-pa-role-cork with *keeping* the group muted when multiple devices disagree.
-        for possible_result in data:
-            if 'result' not in possible_result and 'error' not in possible_result:
-                # Not a result or error, probably one of the status updates, ignore it.
-                continue
-            elif result_id is None:
-                # Since we don't know what result we're looking for, just assume the first is valid
-                break
-            elif possible_result['id'] == result_id:
-                break
+                    frame = json.loads(line)
+                except json.JSONDecodeError:
+                    print("Ignoring garbled frame from snapserver:", line, file=sys.stderr)
+                    continue
+                self._dispatch(frame)
+            error = ConnectionResetError('snapserver closed the connection')
+        except Exception as e:
+            error = e
+        except asyncio.CancelledError:
+            error = ConnectionAbortedError('connection closed')
+        # Nothing else is going to arrive, so don't leave anyone waiting for up to self.timeout.
+        # Nor trust the mirror, since we'll miss any notifications from now on.
+        self.state.server = None
+        for future, _, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    def _dispatch(self, frame):
+        """Resolve the request this frame answers, or pass the notification to subscribers."""
+        if isinstance(frame, list):
+            # The response to a batch is an array of ordinary responses.
+            for response in frame:
+                self._dispatch(response)
+            return
+        if 'id' not in frame:
+            self._notify(frame.get('method'), frame.get('params'))
+            return
+        if frame['id'] is None and 'error' in frame and self.pending_batches:
+            # A server that doesn't understand batches answers the whole array with ONE error, with no id.
+            # Requests are answered in order, so it must be about the oldest batch still waiting.
+            for future in self.pending_batches.pop(0):
+                if not future.done():
+                    future.set_exception(BatchNotSupported(**frame['error']))
+            return
+        future, method, params = self.pending.pop(frame['id'], (None, None, None))
+        if future is None or future.done():
+            # e.g. a parse error (id null), or the caller already timed out.
+            print("Ignoring unexpected response from snapserver:", frame, file=sys.stderr)
+        elif 'error' in frame:
+            future.set_exception(SnapException(**frame['error']))
+        elif 'result' in frame:
+            # Apply it to the mirror HERE, in the order frames arrived.
+            # By the time the caller wakes up, a later notification may already have been applied.
+            self.state.apply_result(method, params, frame['result'])
+            future.set_result(frame['result'])
         else:
-            print(data, file=sys.stderr)
-            raise Exception(f"Did not recieve relevant result ID ({result_id}) from Snapserver")
-
-        return possible_result
-
-    def send_data(self, data):
-        """Send data as json."""
-        self.sock.send(json.dumps(data).encode())
+            future.set_exception(NotImplementedError(frame))
+
+    def _notify(self, method: str, params: dict):
+        """Apply a notification to the mirror, then pass it to subscribers."""
+        self.state.apply(method, params)
+        for subscribed_method, callback in list(self.subscribers):
+            if subscribed_method in (None, method):
+                callback(method, params)
+
+    async def _send(self, calls: list, as_batch: bool):
+        """Send (method, params) calls in one write, and wait for all their results."""
+        frames = []
+        for method, params in calls:
+            data = {
+                "jsonrpc": "2.0",
+                "id": self.last_command_id,
+                "method": method,
+            }
+            self.last_command_id += 1  # Increment the ID for the next command
+            if params:
+                data['params'] = params
+            frames.append(data)
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for data in frames:
+            futures.append(loop.create_future())
+            self.pending[data['id']] = (futures[-1], data['method'], data.get('params'))
         # NOTE: My older version of snapserver does *not* support '\n', I don't know if that gets better with newer versions
-        self.sock.send(b'\r\n')
+        if as_batch:
+            self.pending_batches.append(futures)
+            self.writer.write(json.dumps(frames).encode() + b'\r\n')
+        else:
+            # Pipelined: every request goes out before any response comes back, so it's still about one round trip.
+            self.writer.write(b''.join(json.dumps(data).encode() + b'\r\n' for data in frames))
+        try:
+            await self.writer.drain()
+            # Wait for ALL of them (not just the first failure), so no stray response arrives after we stop listening.
+            results = await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), self.timeout)
+        finally:
+            for data in frames:
+                self.pending.pop(data['id'], None)
+            if futures in self.pending_batches:
+                self.pending_batches.remove(futures)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    async def request(self, method: str, params: dict = None):
+        """Send one JSON-RPC request and wait for its result (no placeholders or fake methods)."""
+        result, = await self._send([(method, params)], as_batch=False)
+        return result
+
+    async def batch(self, calls: list):
+        """
+        Send several JSON-RPC requests at once, and wait for all their results.
 
-        # FIXME: Sockets have no 'flush' function, it takes a sec for the other end to respond
-        # 0.1 was definitely not enough to recieve the response data, 0.25 was enough most of the time, but not quite.
-        # Fuck it 0.5 will do.
-        # FIXME: Just keep reading response data until there's a '\n'.
-        time.sleep(0.5)
+        calls is a list of (method, params) pairs (no placeholders or fake methods),
+        the results come back in the same order.
+        If the server doesn't support JSON-RPC batches, the requests are pipelined instead.
+        """
+        if not calls:
+            return []
+        if self.batch_supported is not False:
+            try:
+                results = await self._send(calls, as_batch=True)
+            except BatchNotSupported:
+                print("snapserver does not support batches, pipelining instead", file=sys.stderr)
+                self.batch_supported = False
+            else:
+                self.batch_supported = True
+                return results
+        return await self._send(calls, as_batch=False)
 
-    def get_group_of_client(self, client_id):
-        """Find the group that has the given client as a member."""
-        server_status = self.run_command('Server.GetStatus')
-        clients_by_group = {group['id']: [client['id'] for client in group['clients']]
-                            for group in server_status['server']['groups']}
+    async def get_status(self):
+        """Return the local mirror of the server's state, loading it first if need be."""
+        if self.state.server is None:
+            await self.request('Server.GetStatus')  # apply_result() loads it
+        return self.state
 
-        for group_id, clients in clients_by_group.items():
-            if client_id in clients:
-                return group_id
+    async def get_group_of_client(self, client_id):
+        """Find the group that has the given client as a member."""
+        return (await self.get_status()).group_of_client(client_id)
 
-        return None
+    async def get_group(self, group_id):
+        """Get the given group (like Group.GetStatus), from the local mirror."""
+        return copy.deepcopy((await self.get_status()).find('group', group_id))
 
-    def get_all_streams(self):
+    async def get_all_streams(self):
         """Get all streams available on server."""
-        server_status = self.run_command('Server.GetStatus')
-        return sorted([s['id'] for s in server_status['server']['streams']])
+        return (await self.get_status()).stream_ids()
 
-    def _toggle_mute(self, params: dict):
+    async def _toggle_mute(self, params: dict):
         """Toggle the mute state for the given group."""
         assert 'toggle' in params and params.pop('toggle'), "Toggle function called without --toggle"
         assert not params.pop('mute'), "--toggle and --mute are mutually exclusive"
 
-        # Sending the params here to ensure the group ID gets goes through as well
-        params['mute'] = not self.run_command('Group.GetStatus', params)['group']['muted']
+        params['mute'] = not (await self.get_group(params['id']))['muted']
 
-        return self.run_command('Group.SetMute', params)
+        return await self.run_command('Group.SetMute', params)
 
-    def _group_setvolume(self, group_params: dict):
+    async def _group_setvolume(self, group_params: dict):
         """
         Set the volume for every client in a group.
 
@@ -243,59 +477,217 @@ class SnapController(object):
         """
         assert 'percent' in group_params
 
-        group_status = self.run_command(method='Group.GetStatus', params={'id': group_params['id']})['group']
-        for client in group_status['clients']:
-            client['config'].update(self.run_command(method='Client.SetVolume',
-                                                     params={'id': client['id'],
-                                                             'percent': group_params['percent'],
-                                                             # Don't change mute state
-                                                             'muted': client['config']['volume']['muted']}))
+        group_status = await self.get_group(group_params['id'])
+        # All of them in one batch, so the speakers change together rather than stepping one by one.
+        results = await self.batch([
+            ('Client.SetVolume', {'id': client['id'],
+                                  'volume': {'percent': group_params['percent'],
+                                             # Don't change mute state
+                                             'muted': client['config']['volume']['muted']}})
+            for client in group_status['clients']])
+        for client, result in zip(group_status['clients'], results):
+            client['config'].update(result)
 
         return group_status
 
-    def run_command(self, method: str, params: dict = {}):
+    async def run_command(self, method: str, params: dict = {}):
         """Send the specific command & params."""
+        params = dict(params)
+        for k, v in params.items():
+            if v == '[local mac address]':
+                assert k == 'id'
+                params[k] = get_physical_mac()
+            elif v == "[local machine's group]":
+                assert k == 'id'
+                params[k] = await self.get_group_of_client(get_physical_mac())
+
         if method == 'Group.SetMute' and params.get('toggle'):
             # The main API does not have a way to toggle the mute state, so I've carved that off into it's own function
-            return self._toggle_mute(params)
+            return await self._toggle_mute(params)
         elif method == 'Group.SetVolume':
-            return self._group_setvolume(params)
-
-        # FIXME: I believe this ID here is to ensure the result string we recieve is specifically for this command.
-        #        So theoretically I could make this whole asyncio or threading friendly by recieving responses in separate a thread
-        #        then using the ID to map it back to required run_command function to return it to the caller
-        data = {
-            "jsonrpc": "2.0",
-            "id": self.last_command_id,
-            "method": method,
-        }
-        self.last_command_id += 1  # Increment the ID for the next command
-
-        if params:
-            data['params'] = params
-            if 'percent' in data['params'] and 'muted' in data['params']:
-                data['params']['volume'] = {'percent': data['params'].pop('percent'),
-                                            'muted': data['params'].pop('muted')}
-
-            for k, v in data['params'].items():
-                if v == '[local mac address]':
-                    assert k == 'id'
-                    data['params'][k] = get_physical_mac()
-                elif v == "[local machine's group]":
-                    assert k == 'id'
-                    data['params'][k] = self.get_group_of_client(get_physical_mac())
-
-        self.send_data(data)
-
-        response = self.recv_result(result_id=data['id'])
-        assert response['id'] == data['id'], response
+            return await self._group_setvolume(params)
+
+        if 'percent' in params and 'muted' in params:
+            params['volume'] = {'percent': params.pop('percent'),
+                                'muted': params.pop('muted')}
 
+        return await self.request(method, params)
+
+
+class SnapController(object):
+    """
+    Snapserver controller, for code that isn't asyncio.
+
+    This is a thin wrapper around AsyncSnapController.
+    Its event loop runs in a background thread, so
+    each call blocks only for one round trip (not a fixed sleep).
+    """
+
+    def __init__(self, host: str = None, port: int = None):
+        """Initialise the connection."""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='snapcontroller', daemon=True)
+        self.thread.start()
+        self.controller = AsyncSnapController(host, port)
+        self._wait(self.controller.connect())
+
+    def __enter__(self):  # noqa: D105 "Missing docstring in magic method"
+        return self
+
+    def __exit__(self, *exc_info):  # noqa: D105 "Missing docstring in magic method"
+        self.close()
+
+    def _wait(self, coroutine):
+        """Run coroutine in the background event loop, and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        """Close the connection and stop the background thread."""
+        self._wait(self.controller.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def is_connected(self):
+        """Return whether the connection is still up."""
+        return self.controller.is_connected()
+
+    def subscribe(self, callback, method: str = None):
+        """
+        Call callback(method, params) for each notification.
+
+        NOTE: callbacks run in the background thread, not the caller's.
+        """
+        self.loop.call_soon_threadsafe(self.controller.subscribe, callback, method)
+
+    def get_group_of_client(self, client_id):
+        """Find the group that has the given client as a member."""
+        return self._wait(self.controller.get_group_of_client(client_id))
+
+    def get_group(self, group_id):
+        """Get the given group (like Group.GetStatus), from the local mirror."""
+        return self._wait(self.controller.get_group(group_id))
+
+    def get_all_streams(self):
+        """Get all streams available on server."""
+        return self._wait(self.controller.get_all_streams())
+
+    def run_command(self, method: str, params: dict = {}):
+        """Send the specific command & params."""
+        return self._wait(self.controller.run_command(method, params))
+
+    def batch(self, calls: list):
+        """Send several (method, params) requests at once, and return all their results."""
+        return self._wait(self.controller.batch(calls))
+
+
+def get_broker_path():
+    """Where snapcontroller-broker.py listens (see snapcontroller-broker.socket)."""
+    return pathlib.Path(os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')) / 'snapcontroller.sock'
+
+
+class SnapBrokerClient(object):
+    """
+    Snapserver controller, via snapcontroller-broker.py.
+
+    The broker owns the one snapserver connection (and state mirror) for this user,
+    so each call is one local round trip, not DNS + TCP + Server.GetStatus.
+    Same API as SnapController, except subscribe(): the broker doesn't forward notifications.
+    """
+
+    timeout = 15                # seconds, a bit longer than the broker's own timeout
+
+    def __init__(self, path: pathlib.Path = None):
+        """Connect to the broker's socket."""
+        self.path = path or get_broker_path()
+        self.last_command_id = 42
+        self.sock = self.file = None
+        self._connect()
+
+    def __enter__(self):  # noqa: D105 "Missing docstring in magic method"
+        return self
+
+    def __exit__(self, *exc_info):  # noqa: D105 "Missing docstring in magic method"
+        self.close()
+
+    def _connect(self):
+        """Open the connection to the broker."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(str(self.path))
+        except OSError:
+            self.close()
+            raise
+        self.file = self.sock.makefile('rb')
+
+    def close(self):
+        """Close the connection (the broker's connection to snapserver stays up)."""
+        if self.file:
+            self.file.close()
+        if self.sock:
+            self.sock.close()
+        self.sock = self.file = None
+
+    def is_connected(self):
+        """Return whether the connection is still up (as far as we know)."""
+        return self.sock is not None
+
+    def _call(self, method: str, params: dict = None):
+        """Send one request to the broker and wait for its result."""
+        if self.sock is None:
+            self._connect()
+        data = {"jsonrpc": "2.0", "id": self.last_command_id, "method": method, "params": params or {}}
+        self.last_command_id += 1
+        try:
+            self.sock.sendall(json.dumps(data).encode() + b'\n')
+            line = self.file.readline()
+            if not line:
+                raise ConnectionResetError('snapcontroller-broker closed the connection')
+        except OSError:
+            # Don't retry here, it might have already happened (e.g. a mute toggle).
+            # Just reconnect next time (e.g. the broker was restarted).
+            self.close()
+            raise
+        response = json.loads(line)
         if 'error' in response:
             raise SnapException(**response['error'])
-        elif 'result' in response:
-            return response['result']
-        else:
-            raise NotImplementedError(response)
+        return response['result']
+
+    def get_group_of_client(self, client_id):
+        """Find the group that has the given client as a member."""
+        return self._call('Broker.GetGroupOfClient', {'id': client_id})
+
+    def get_group(self, group_id):
+        """Get the given group (like Group.GetStatus), from the broker's mirror."""
+        return self._call('Broker.GetGroup', {'id': group_id})
+
+    def get_all_streams(self):
+        """Get all streams available on server."""
+        return self._call('Broker.GetAllStreams')
+
+    def run_command(self, method: str, params: dict = {}):
+        """Send the specific command & params."""
+        return self._call(method, params)
+
+    def batch(self, calls: list):
+        """Send several (method, params) requests at once, and return all their results."""
+        return self._call('Broker.Batch', {'calls': calls})
+
+
+def connect(host: str = None, port: int = None):
+    """
+    Return a snapserver controller.
+
+    Via snapcontroller-broker.py if it's there (and no particular server was asked for),
+    otherwise a direct connection of our own.
+    """
+    if not (host or port):
+        try:
+            return SnapBrokerClient()
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+    return SnapController(host, port)
 
 
 def help_all(parser, top_level=True):
@@ -318,28 +710,17 @@ def help_all(parser, top_level=True):
 
 def get_defaults_from_srv():
     """Query DNS SRV records for default snapcast server."""
-    # Python was doing some really weird & stupid things when trying to get the search domain.
-    # So I gave up and called out to resolvectl instead
-    # FIXME: Why the fuck didn't python's socket module work?!?
-    #        Often gethostname & getfqdn swapped responses,
-    #        and when they did the fqdn (returned by gethostname) was cut short such that it couldn't fit the full domain
-    #        NOTE: the 'hostname' command does the same thing
-    domains = subprocess.check_output(['resolvectl', 'domain'], text=True)
-    for line in domains.splitlines():
-        _, domain = line.split(':', 1)
-        domain = domain.strip()
-
-        if domain:
-            break
-
-    # Get all SRV records and sort them by weight,
-    # then grab only the first one
+    import srvdiscovery
+
     # FIXME: Try them in order until 1 works?
-    # FIXME: Is this sorted in the right order?
-    srv_records = list(dns.resolver.resolve(f'_snapcast_control._tcp.{domain}', 'SRV'))
-    srv_records.sort(key=lambda i: i.weight)
+    srv_record = srvdiscovery.resolve_srv('_snapcast_control._tcp')[0]
+    return srv_record.target, srv_record.port
+
 
-    return str(srv_records[0].target).rstrip('.'), srv_records[0].port
+def check_rpc_version(api_version: dict):
+    """Refuse to talk to a snapserver with a different API to what this was written for."""
+    if api_version != {'major': 2, 'minor': 0, 'patch': 0}:
+        raise NotImplementedError("RPC API version mismatch")
 
 
 def gen_argparser():
@@ -395,10 +776,10 @@ if __name__ == '__main__':
 
     method = f"{params.pop('method_group')}.{params.pop('method')}"
 
-    with SnapController(params.pop('host'), params.pop('port')) as ctrl:
-        api_version = ctrl.run_command('Server.GetRPCVersion')
-        if api_version != {'major': 2, 'minor': 0, 'patch': 0}:
-            raise NotImplementedError("RPC API version mismatch")
+    with connect(params.pop('host'), params.pop('port')) as ctrl:
+        # The broker already checked this when it connected.
+        if not isinstance(ctrl, SnapBrokerClient):
+            check_rpc_version(ctrl.run_command('Server.GetRPCVersion'))
 
         # FIXME: This is dumping to json data that was only just recently loaded from json
         print(json.dumps(ctrl.run_command(method, params), indent=4, sort_keys=True))
@@ -0,0 +1,124 @@
+"""
+Find services from DNS SRV records (e.g. _snapcast_control._tcp), without paying for it every time.
+
+snapcontroller.py, set-jellyfin-server.py & tasmota_controller.py each used to fork `resolvectl domain`,
+parse its output, then query DNS, on every run.
+This asks systemd-resolved for the search domain over D-Bus instead,
+and keeps each SRV answer for as long as its TTL says,
+both in memory and in a small file in $XDG_RUNTIME_DIR shared by every process.
+
+ref: https://www.rfc-editor.org/rfc/rfc2782
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import pathlib
+import random
+import time
+
+# NOTE: dns.resolver & dbus are imported where they're used,
+#       so that a cache hit doesn't pay to load them.
+
+SRVRecord = collections.namedtuple('SRVRecord', 'priority weight port target')
+
+cache = {}                      # qname => (expiration, [SRVRecord, ...])
+
+
+def get_cache_path():
+    """Where the answers are shared between processes."""
+    return pathlib.Path(os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')) / 'srvdiscovery.json'
+
+
+@functools.cache
+def get_search_domain():
+    """Get the first search domain from systemd-resolved (like `resolvectl domain`)."""
+    import dbus
+
+    with contextlib.closing(dbus.SystemBus()) as system_bus:
+        resolve1 = system_bus.get_object('org.freedesktop.resolve1', '/org/freedesktop/resolve1')
+        domains = resolve1.Get('org.freedesktop.resolve1.Manager', 'Domains',
+                               dbus_interface='org.freedesktop.DBus.Properties')
+    # ifindex 0 is the "Global" line of `resolvectl domain`, which comes first there too.
+    # Route-only domains (shown as ~example.com) aren't search domains, so skip them.
+    for ifindex, domain, route_only in sorted(domains, key=lambda d: d[0]):
+        if domain and not route_only:
+            return str(domain)
+    raise LookupError('systemd-resolved has no search domain')
+
+
+def load_cache_file():
+    """Merge the unexpired answers from the shared file into the in-memory cache."""
+    try:
+        shared = json.loads(get_cache_path().read_text())
+    except (OSError, ValueError):
+        return                  # Not there yet, or half-written/garbled, just ask DNS.
+    now = time.time()
+    for qname, (expiration, records) in shared.items():
+        if expiration > now and expiration > cache.get(qname, (0, None))[0]:
+            cache[qname] = (expiration, [SRVRecord(*record) for record in records])
+
+
+def save_cache_file():
+    """Write the unexpired in-memory answers to the shared file, for the next process."""
+    now = time.time()
+    path = get_cache_path()
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}')
+    try:
+        tmp_path.write_text(json.dumps({qname: answer for qname, answer in cache.items() if answer[0] > now}))
+        tmp_path.replace(path)  # atomic, so nobody reads half of it
+    except OSError:
+        pass                    # e.g. no $XDG_RUNTIME_DIR, we'll just ask DNS next time.
+
+
+def query(qname: str):
+    """Return the SRV records for qname, from the cache if they haven't expired."""
+    if cache.get(qname, (0, None))[0] <= time.time():
+        load_cache_file()
+    if cache.get(qname, (0, None))[0] <= time.time():
+        import dns.resolver
+
+        answer = dns.resolver.resolve(qname, 'SRV')
+        cache[qname] = (answer.expiration,
+                        [SRVRecord(record.priority, record.weight, record.port, str(record.target).rstrip('.'))
+                         for record in answer])
+        save_cache_file()
+    return cache[qname][1]
+
+
+def rfc2782_order(records: list):
+    """
+    Order records the way RFC 2782 says clients should try them.
+
+    Lowest priority first; within a priority, a weighted random shuffle,
+    so that heavier targets are *usually* first, but the load is still spread out.
+    """
+    ordered = []
+    for priority in sorted({record.priority for record in records}):
+        # Zero-weight records go first, so they only get picked when the random number is 0.
+        remaining = sorted([record for record in records if record.priority == priority], key=lambda r: r.weight)
+        while remaining:
+            pick = random.randint(0, sum(record.weight for record in remaining))
+            running_sum = 0
+            for record in remaining:
+                running_sum += record.weight
+                if running_sum >= pick:
+                    break
+            remaining.remove(record)
+            ordered.append(record)
+    return ordered
+
+
+def resolve_srv(service: str, domain: str = None):
+    """
+    Return the SRV records for service (e.g. '_mqtt._tcp') in the search domain, in the order to try them.
+
+    Raises LookupError if there are none, or the service is "decidedly not available" (target '.').
+    """
+    records = [record for record in query(f'{service}.{domain or get_search_domain()}')
+               # A lone '.' target means "decidedly not available at this domain".
+               if record.target]
+    if not records:
+        raise LookupError(f'No SRV records for {service}')
+    return rfc2782_order(records)
@@ -1,12 +1,10 @@
 #!/usr/bin/python3
 """Control specific Tasmota devices depending on the kernel command line parameters."""
 import argparse
-import dns.resolver
 import functools
 import json
 import pathlib
 import shlex
-import subprocess
 import time
 import urllib.parse
 import urllib.request
@@ -14,6 +12,8 @@ import urllib.request
 import systemd.daemon
 import paho.mqtt.client
 
+import srvdiscovery
+
 kernel_cmdline = shlex.split(pathlib.Path('/proc/cmdline').read_text())
 # The cmdline will look something like this::
 #     initrd=http://bootserver/netboot/jellyfin-media-player-latest/initrd.img  panic=10 boot=live
@@ -84,20 +84,15 @@ elif args.device_type in mqtt_devices:
     device_topic = mqtt_devices[args.device_type]
 
     # For some whacked-out reason, mqtt_client.connect_srv won't work even when socket.getfqdn() resolves properly.
-    # But socket.getfqdn() doesn't resolve properly anyway, so just work around it badly using resolvectl
-    domain = [domain.strip() for _, domain in (
-              line.split(':', 1) for line in
-              subprocess.check_output(['resolvectl', 'domain'], text=True).splitlines())
-              if domain][0]
-    sorted(dns.resolver.resolve(f'_mqtt._tcp.{domain}', 'SRV'), key=lambda i: i.weight)[0]
-    srv_record = sorted(dns.resolver.resolve(f'_mqtt._tcp.{domain}', 'SRV'), key=lambda i: i.weight)[0]
+    # But socket.getfqdn() doesn't resolve properly anyway, so just work around it using srvdiscovery.
+    srv_record = srvdiscovery.resolve_srv('_mqtt._tcp')[0]
 
     mqtt_client = paho.mqtt.client.Client()
     # I couldn't make "anonymous" connections work with my broker (Home Assistant addon)
     # but I could create a guest:guest account, so that'll do
     # FIXME: Try anonymous, and fallback on guest:guest when that fails
     mqtt_client.username_pw_set(username='guest', password='guest')
-    conn_resp = mqtt_client.connect(srv_record.target.to_text()[:-1], srv_record.port)
+    conn_resp = mqtt_client.connect(srv_record.target, srv_record.port)
 
     def send_command(cmnd, *args):
         """Send MQTT command to cmnd/... topic, and wait for response on stat/... topic."""